@@ -1,7 +1,192 @@
 import os
 import json
+import random
+import asyncio
+import copy
+import time
+import weakref
+import threading
+import httpx
+from hashlib import sha256
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from google import genai
-from google.genai import types
+from google.genai import types, errors
+
+# Prazo total de uma chamada (inclui espera na fila e retentativas)
+AI_TIMEOUT_SECONDS = float(os.environ.get("AI_TIMEOUT_SECONDS", 30))
+# Prazo de cada tentativa: uma tentativa travada pode ser refeita dentro do prazo total
+AI_ATTEMPT_TIMEOUT_SECONDS = float(os.environ.get("AI_ATTEMPT_TIMEOUT_SECONDS", 15))
+AI_MAX_RETRIES = int(os.environ.get("AI_MAX_RETRIES", 2))
+AI_RETRY_BASE_SECONDS = float(os.environ.get("AI_RETRY_BASE_SECONDS", 0.5))
+AI_MAX_CONCURRENCY = int(os.environ.get("AI_MAX_CONCURRENCY", 16))
+AI_MAX_CONCURRENCY_PER_FAMILY = int(os.environ.get("AI_MAX_CONCURRENCY_PER_FAMILY", 2))
+AI_CACHE_MAX_ENTRIES = int(os.environ.get("AI_CACHE_MAX_ENTRIES", 2048))
+# TTL (segundos) do cache de respostas por endpoint
+AI_CACHE_TTL = {
+    "harmony_insight": 60 * 60,
+    "suggest_tasks": 6 * 60 * 60,
+    "child_discovery": 6 * 60 * 60,
+    "budget_analysis": 24 * 60 * 60,
+}
+
+
+def _is_transient(e: Exception) -> bool:
+    """Erros que valem nova tentativa: timeout, rede, 5xx, 408 e 429."""
+    if isinstance(e, (asyncio.TimeoutError, errors.ServerError, httpx.TransportError, ConnectionError)):
+        return True
+    return isinstance(e, errors.ClientError) and e.code in (408, 429)
+
+
+def _clean_json(text: str):
+    text = text.strip()
+    # Limpeza de blocos de código Markdown
+    if text.startswith("```json"):
+        text = text[7:]
+    elif text.startswith("```"):
+        text = text[3:]
+    if text.endswith("```"):
+        text = text[:-3]
+    return json.loads(text.strip())
+
+
+def _parse_media_response(text: str, markers=("```json", "```")):
+    text = text.strip()
+    # Limpeza JSON básica
+    if "```json" in text and "```json" in markers:
+        text = text.split("```json")[1].split("```")[0]
+    elif "```" in text and "```" in markers:
+        text = text.split("```")[1].split("```")[0]
+    try:
+        return json.loads(text.strip())
+    except:
+        return {"text": text}
+
+
+class _ConcurrencyLimits:
+    """Semáforo global + um por família. Os semáforos pertencem ao event loop em que foram criados."""
+
+    def __init__(self):
+        self._by_loop = weakref.WeakKeyDictionary()
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._by_loop:
+            self._by_loop[loop] = (asyncio.Semaphore(AI_MAX_CONCURRENCY), {})
+        return self._by_loop[loop]
+
+    @asynccontextmanager
+    async def slot(self, family_id=None):
+        global_limit, families = self._state()
+        if family_id is None:
+            async with global_limit:
+                yield
+            return
+        # Primeiro a vaga da família: uma família na fila não segura vagas globais
+        entry = families.setdefault(family_id, [asyncio.Semaphore(AI_MAX_CONCURRENCY_PER_FAMILY), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with global_limit:
+                    yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                families.pop(family_id, None)
+
+
+_limits = _ConcurrencyLimits()
+
+
+class AIResponseCache:
+    """
+    Cache LRU com TTL por entrada, chaveado por modelo + tipo + hash do prompt normalizado.
+    Pedidos idênticos simultâneos compartilham uma única chamada ao modelo (single-flight).
+    """
+
+    def __init__(self, max_entries: int = AI_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, kind: str, prompt: str) -> str:
+        normalized = " ".join(prompt.split())
+        return sha256(f"{model}\0{kind}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, copy.deepcopy(value)
+
+    def set(self, key: str, value, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _landed(self, flight_key, key: str, ttl: float, task):
+        self._inflight.pop(flight_key, None)
+        # Falhas (None) não são cacheadas: a próxima chamada tenta de novo
+        if not task.cancelled() and task.exception() is None and task.result() is not None:
+            self.set(key, task.result(), ttl)
+
+    async def get_or_call(self, key: str, ttl: float, factory):
+        found, value = self.get(key)
+        if found:
+            return value
+        loop = asyncio.get_running_loop()
+        flight_key = (loop, key)
+        flight = self._inflight.get(flight_key)
+        if flight is None:
+            task = loop.create_task(factory())
+            flight = self._inflight[flight_key] = [task, 0]
+            task.add_done_callback(lambda t: self._landed(flight_key, key, ttl, t))
+        flight[1] += 1
+        try:
+            return copy.deepcopy(await asyncio.shield(flight[0]))
+        finally:
+            flight[1] -= 1
+            # Todos os interessados desistiram (ex: clientes desconectados): cancela a chamada
+            if not flight[1] and not flight[0].done():
+                flight[0].cancel()
+
+
+ai_cache = AIResponseCache()
+
+
+class ClientDisconnected(Exception):
+    """O cliente HTTP desconectou antes da resposta da IA (main.py responde 499)."""
+
+
+async def cancel_on_disconnect(request, coro, poll_interval: float = 0.5):
+    """Aguarda `coro` cancelando-a se o cliente HTTP desconectar antes da resposta."""
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
 
 # Configuração do Gemini via google-genai SDK
 class GeminiClient:
@@ -18,7 +203,8 @@ class GeminiClient:
                 self.client = genai.Client(
                     vertexai=True,
                     project="mediare-486816",
-                    location="us-central1"
+                    location="us-central1",
+                    http_options=self._http_options()
                 )
                 self.use_vertex = True
                 self.model_id = model_lite
@@ -29,11 +215,16 @@ class GeminiClient:
         if not self.use_vertex:
             if not api_key:
                 print("GeminiClient AVISO: Nenhuma GOOGLE_API_KEY encontrada.")
-            self.client = genai.Client(api_key=api_key)
+            self.client = genai.Client(api_key=api_key, http_options=self._http_options())
             # Usando modelo da lista disponível: gemini-2.5-flash
             self.model_id = "gemini-2.5-flash"
             print("GeminiClient: Conectado ao Google AI Studio (API Key).")
 
+    @staticmethod
+    def _http_options():
+        # Timeout HTTP (ms) também para as chamadas síncronas (ex: sumário dos relatórios em background)
+        return types.HttpOptions(timeout=int(AI_ATTEMPT_TIMEOUT_SECONDS * 1000))
+
     def generate_content(self, prompt: str):
         """Gera conteúdo textual simples."""
         try:
@@ -56,18 +247,7 @@ class GeminiClient:
                 model=self.model_id,
                 contents=prompt
             )
-            text = response.text.strip()
-            
-            # Limpeza de blocos de código Markdown
-            if text.startswith("```json"):
-                text = text[7:]
-            elif text.startswith("```"):
-                text = text[3:]
-                
-            if text.endswith("```"):
-                text = text[:-3]
-            
-            return json.loads(text.strip())
+            return _clean_json(response.text)
         except Exception as e:
             print(f"GeminiClient Erro (analyze_json): {e}")
             return None
@@ -84,18 +264,7 @@ class GeminiClient:
                     types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
                 ]
             )
-            text = response.text.strip()
-            
-            # Limpeza JSON básica
-            if "```json" in text:
-                text = text.split("```json")[1].split("```")[0]
-            elif "```" in text:
-                text = text.split("```")[1].split("```")[0]
-            
-            try:
-                return json.loads(text.strip())
-            except:
-                return {"text": text}
+            return _parse_media_response(response.text)
         except Exception as e:
             print(f"GeminiClient Erro (analyze_image): {e}")
             return None
@@ -112,18 +281,76 @@ class GeminiClient:
                     types.Part.from_bytes(data=audio_bytes, mime_type=mime_type)
                 ]
             )
-            text = response.text.strip()
-            
-            if "```json" in text:
-                text = text.split("```json")[1].split("```")[0]
-            
-            try:
-                return json.loads(text.strip())
-            except:
-                return {"text": text}
+            return _parse_media_response(response.text, markers=("```json",))
         except Exception as e:
             print(f"GeminiClient Erro (analyze_audio): {e}")
             return None
 
+    # --- Interface assíncrona (client.aio): não prende threads do servidor ---
+
+    async def _attempts(self, contents, family_id, label: str):
+        async with _limits.slot(family_id):
+            for attempt in range(AI_MAX_RETRIES + 1):
+                try:
+                    response = await asyncio.wait_for(
+                        self.client.aio.models.generate_content(model=self.model_id, contents=contents),
+                        AI_ATTEMPT_TIMEOUT_SECONDS
+                    )
+                    return response.text
+                except Exception as e:
+                    if attempt == AI_MAX_RETRIES or not _is_transient(e):
+                        print(f"GeminiClient Erro ({label}): {e!r}")
+                        return None
+                    # Backoff exponencial com jitter completo
+                    await asyncio.sleep(random.uniform(0, AI_RETRY_BASE_SECONDS * 2 ** attempt))
+
+    async def _generate_async(self, contents, family_id=None, timeout: float = None, label: str = "generate_content_async"):
+        timeout = timeout or AI_TIMEOUT_SECONDS
+        try:
+            return await asyncio.wait_for(self._attempts(contents, family_id, label), timeout)
+        except asyncio.TimeoutError:
+            print(f"GeminiClient Erro ({label}): prazo de {timeout}s excedido")
+            return None
+
+    async def _cached(self, kind: str, prompt: str, cache_ttl: float, factory):
+        if not cache_ttl:
+            return await factory()
+        return await ai_cache.get_or_call(ai_cache.key(self.model_id, kind, prompt), cache_ttl, factory)
+
+    async def generate_content_async(self, prompt: str, family_id: int = None, timeout: float = None, cache_ttl: float = None):
+        """`cache_ttl` (segundos) reaproveita respostas do mesmo prompt; ver AI_CACHE_TTL."""
+        return await self._cached(
+            "text", prompt, cache_ttl,
+            lambda: self._generate_async(prompt, family_id, timeout, "generate_content_async")
+        )
+
+    async def analyze_json_async(self, prompt: str, family_id: int = None, timeout: float = None, cache_ttl: float = None):
+        async def call():
+            text = await self._generate_async(prompt, family_id, timeout, "analyze_json_async")
+            try:
+                return _clean_json(text) if text else None
+            except ValueError as e:
+                print(f"GeminiClient Erro (analyze_json_async): {e}")
+                return None
+        return await self._cached("json", prompt, cache_ttl, call)
+
+    async def analyze_image_async(self, prompt: str, image_bytes: bytes, mime_type: str = "image/jpeg", family_id: int = None, timeout: float = None):
+        contents = [prompt, types.Part.from_bytes(data=image_bytes, mime_type=mime_type)]
+        text = await self._generate_async(contents, family_id, timeout, "analyze_image_async")
+        return _parse_media_response(text) if text else None
+
+    async def analyze_images_async(self, prompt: str, images: list, family_id: int = None, timeout: float = None):
+        """Várias imagens em uma única chamada: `images` é uma lista de (bytes, mime_type), rotuladas na ordem."""
+        contents = [prompt]
+        for number, (image_bytes, mime_type) in enumerate(images, start=1):
+            contents += [f"Imagem {number}:", types.Part.from_bytes(data=image_bytes, mime_type=mime_type)]
+        text = await self._generate_async(contents, family_id, timeout, "analyze_images_async")
+        return _parse_media_response(text) if text else None
+
+    async def analyze_audio_async(self, prompt: str, audio_bytes: bytes, mime_type: str = "audio/mpeg", family_id: int = None, timeout: float = None):
+        contents = [prompt, types.Part.from_bytes(data=audio_bytes, mime_type=mime_type)]
+        text = await self._generate_async(contents, family_id, timeout, "analyze_audio_async")
+        return _parse_media_response(text, markers=("```json",)) if text else None
+
 # Instância singleton
 gemini_client = GeminiClient()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+# Pipeline de notas de voz. transcode_segments roda no pool de processos (workers.py):
+# recebe o caminho do upload já gravado em disco e devolve só bytes. Converte para Opus
+# mono de baixa taxa (muito menor que o original) e divide em segmentos curtos, que são
+# transcritos e moderados em paralelo. Sem ffmpeg no servidor o chamador envia o
+# arquivo original como um único segmento.
+AUDIO_SEGMENT_SECONDS = int(os.environ.get("AUDIO_SEGMENT_SECONDS", 30))
+AUDIO_BITRATE = os.environ.get("AUDIO_BITRATE", "24k")
+AUDIO_SAMPLE_RATE = int(os.environ.get("AUDIO_SAMPLE_RATE", 16000))
+AUDIO_TRANSCODE_TIMEOUT = float(os.environ.get("AUDIO_TRANSCODE_TIMEOUT", 60))
+AUDIO_MIME_TYPE = "audio/ogg"
+SEGMENT_STATUSES = ("allowed", "needs_rewrite", "blocked")
+FFMPEG = shutil.which("ffmpeg")
+
+
+def transcode_segments(path: str, segment_seconds: int = AUDIO_SEGMENT_SECONDS):
+    """Opus mono em segmentos de até segment_seconds. Retorna a lista de bytes, em ordem, ou None."""
+    if FFMPEG is None:
+        return None
+    with tempfile.TemporaryDirectory(prefix="mediare-audio-") as out_dir:
+        command = [
+            FFMPEG, "-nostdin", "-hide_banner", "-loglevel", "error", "-i", path,
+            "-vn", "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE),
+            "-c:a", "libopus", "-b:a", AUDIO_BITRATE, "-application", "voip",
+            "-f", "segment", "-segment_time", str(segment_seconds), "-reset_timestamps", "1",
+            os.path.join(out_dir, "segment%04d.ogg"),
+        ]
+        try:
+            subprocess.run(command, check=True, capture_output=True, timeout=AUDIO_TRANSCODE_TIMEOUT)
+        except (subprocess.SubprocessError, OSError) as e:
+            print(f"Audio Erro (ffmpeg): {e}")
+            return None
+        segments = []
+        for name in sorted(os.listdir(out_dir)):
+            with open(os.path.join(out_dir, name), "rb") as segment:
+                segments.append(segment.read())
+        return segments or None
+
+
+def _score(value) -> float:
+    try:
+        return float(value or 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def merge_segment_analyses(analyses: list):
+    """
+    Junta as análises dos segmentos, na ordem. Um trecho bloqueado bloqueia a nota inteira.
+    Trecho sem transcrição (resposta ilegível da IA) invalida a nota: retorna None. Trecho
+    transcrito mas sem veredito válido deixa a nota em "escalate" para a moderação do texto.
+    """
+    if not analyses or any(
+        not isinstance(analysis, dict) or not isinstance(analysis.get("transcription"), str) for analysis in analyses
+    ):
+        return None
+    blocked = next((analysis for analysis in analyses if analysis.get("status") == "blocked"), None)
+    unclear = any(analysis.get("status") not in SEGMENT_STATUSES for analysis in analyses)
+    merged = {
+        "transcription": " ".join(
+            analysis["transcription"].strip() for analysis in analyses if analysis["transcription"].strip()
+        ),
+        "toxicity_score": max(_score(analysis.get("toxicity_score")) for analysis in analyses),
+        "sentiment_score": sum(_score(analysis.get("sentiment_score")) for analysis in analyses) / len(analyses),
+        "status": "blocked" if blocked else "escalate" if unclear else "allowed",
+    }
+    if blocked and blocked.get("reason"):
+        merged["reason"] = blocked["reason"]
+    return merged
@@ -0,0 +1,452 @@
+import os
+import json
+import asyncio
+from hashlib import sha256
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import event, func, update, or_
+from sqlalchemy.orm import Session
+
+# Cadeia de hashes do EventLog por família + checkpoints Merkle periódicos.
+# Cada entrada carrega o hash da anterior; a cada CHECKPOINT_SIZE entradas um
+# checkpoint guarda a raiz Merkle do bloco, permitindo provar a integridade de
+# uma entrada com O(log n) hashes e de um período rehashando só os blocos envolvidos.
+CHECKPOINT_SIZE = int(os.environ.get("EVENT_CHECKPOINT_SIZE", 256))
+# Cauda sem checkpoint é selada periodicamente (não a cada relatório, para não picar os blocos)
+CHECKPOINT_SEAL_SECONDS = int(os.environ.get("EVENT_CHECKPOINT_SEAL_SECONDS", 24 * 3600))
+GENESIS_HASH = "0" * 64
+
+_EventLog = None
+_Checkpoint = None
+_Head = None
+
+
+def _timestamp(dt) -> str:
+    # SQLite devolve datetimes sem fuso; normaliza para UTC "naive" antes de hashear
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.isoformat()
+
+
+def compute_entry_hash(prev_hash: str, family_id: int, seq: int, event_type: str, event_data, created_at) -> str:
+    payload = json.dumps(
+        [family_id, seq, event_type, event_data, _timestamp(created_at)],
+        ensure_ascii=False, separators=(",", ":"), sort_keys=True, default=str
+    )
+    return sha256((prev_hash + payload).encode("utf-8")).hexdigest()
+
+
+def entry_hash_of(entry) -> str:
+    return compute_entry_hash(entry.prev_hash, entry.family_unit_id, entry.seq, entry.event_type, entry.event_data, entry.created_at)
+
+
+# --- Merkle (folhas e nós com prefixos distintos; nó sem par sobe sem ser duplicado) ---
+
+def _leaf(entry_hash: str) -> bytes:
+    return sha256(b"\x00" + bytes.fromhex(entry_hash)).digest()
+
+
+def _node(left: bytes, right: bytes) -> bytes:
+    return sha256(b"\x01" + left + right).digest()
+
+
+def _levels(entry_hashes: list) -> list:
+    levels = [[_leaf(h) for h in entry_hashes]]
+    while len(levels[-1]) > 1:
+        current = levels[-1]
+        levels.append([
+            _node(current[i], current[i + 1]) if i + 1 < len(current) else current[i]
+            for i in range(0, len(current), 2)
+        ])
+    return levels
+
+
+def merkle_root(entry_hashes: list) -> str:
+    return _levels(entry_hashes)[-1][0].hex()
+
+
+def merkle_proof(entry_hashes: list, index: int) -> list:
+    """Caminho de irmãos da folha `index` até a raiz."""
+    proof = []
+    for level in _levels(entry_hashes)[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append({"hash": level[sibling].hex(), "side": "left" if sibling < index else "right"})
+        index //= 2
+    return proof
+
+
+def verify_proof(entry_hash: str, proof: list, root: str) -> bool:
+    current = _leaf(entry_hash)
+    for step in proof:
+        sibling = bytes.fromhex(step["hash"])
+        current = _node(sibling, current) if step["side"] == "left" else _node(current, sibling)
+    return current.hex() == root
+
+
+# --- Encadeamento automático na gravação ---
+
+def _lock_head(session: Session, family_id: int):
+    """
+    Trava a linha de cabeça da família (UPDATE ... RETURNING) e devolve (seq, entry_hash).
+    Duas transações gravando na mesma família esperam uma pela outra em vez de lerem
+    o mesmo seq e colidirem em uq_event_log_family_seq. A trava dura até o commit.
+    """
+    Head = _Head
+    lock = update(Head).where(Head.family_unit_id == family_id).values(
+        updated_at=datetime.now(timezone.utc)
+    ).returning(Head.seq, Head.entry_hash).execution_options(synchronize_session=False)
+    row = session.execute(lock).first()
+    if row is None:
+        # Primeira gravação da família: parte da última entrada já encadeada
+        from database import insert_on_conflict
+        EventLog = _EventLog
+        last = session.query(EventLog.seq, EventLog.entry_hash).filter(
+            EventLog.family_unit_id == family_id,
+            EventLog.seq.isnot(None)
+        ).order_by(EventLog.seq.desc()).first()
+        seq, entry_hash = last if last else (0, GENESIS_HASH)
+        session.execute(insert_on_conflict(session, Head.__table__).values(
+            family_unit_id=family_id, seq=seq, entry_hash=entry_hash, updated_at=datetime.now(timezone.utc)
+        ).on_conflict_do_nothing(index_elements=["family_unit_id"]))
+        row = session.execute(lock).first()
+    return tuple(row)
+
+
+def _store_head(session: Session, family_id: int, seq: int, entry_hash: str):
+    Head = _Head
+    session.execute(update(Head).where(Head.family_unit_id == family_id).values(
+        seq=seq, entry_hash=entry_hash
+    ).execution_options(synchronize_session=False))
+
+
+def _chain_head(session: Session, family_id: int):
+    Checkpoint = _Checkpoint
+    seq, prev_hash = _lock_head(session, family_id)
+    last_checkpoint = session.query(func.max(Checkpoint.end_seq)).filter(Checkpoint.family_unit_id == family_id).scalar()
+    return seq, prev_hash, last_checkpoint or 0
+
+
+def _block_hashes(session: Session, family_id: int, start_seq: int, end_seq: int) -> list:
+    EventLog = _EventLog
+    return [h for (h,) in session.query(EventLog.entry_hash).filter(
+        EventLog.family_unit_id == family_id,
+        EventLog.seq >= start_seq,
+        EventLog.seq <= end_seq
+    ).order_by(EventLog.seq.asc())]
+
+
+def chain_entries(session: Session, family_id: int, entries: list):
+    """
+    Atribui seq/prev_hash/entry_hash às novas entradas (objetos ou dicts) de uma família,
+    na ordem recebida, e adiciona os checkpoints que fecharem bloco.
+    Trava a cabeça da cadeia da família até o commit da transação.
+    """
+    seq, prev_hash, checkpoint_end = _chain_head(session, family_id)
+    pending = {}
+    for entry in entries:
+        get = entry.get if isinstance(entry, dict) else lambda key: getattr(entry, key)
+        put = entry.__setitem__ if isinstance(entry, dict) else lambda key, value: setattr(entry, key, value)
+        if get("created_at") is None:
+            put("created_at", datetime.now(timezone.utc))
+        seq += 1
+        current = compute_entry_hash(prev_hash, family_id, seq, get("event_type"), get("event_data"), get("created_at"))
+        put("seq", seq)
+        put("prev_hash", prev_hash)
+        put("entry_hash", current)
+        pending[seq] = current
+        prev_hash = current
+
+        if seq - checkpoint_end >= CHECKPOINT_SIZE:
+            start = checkpoint_end + 1
+            stored = _block_hashes(session, family_id, start, min(pending) - 1) if start < min(pending) else []
+            leaves = stored + [pending[s] for s in range(max(start, min(pending)), seq + 1)]
+            session.add(_Checkpoint(
+                family_unit_id=family_id,
+                start_seq=start,
+                end_seq=seq,
+                merkle_root=merkle_root(leaves),
+                chain_head=current,
+                created_at=datetime.now(timezone.utc)
+            ))
+            checkpoint_end = seq
+    _store_head(session, family_id, seq, prev_hash)
+
+
+def _chain_new_events(session, flush_context, instances):
+    new_events = [obj for obj in session.new if isinstance(obj, _EventLog) and obj.entry_hash is None]
+    if not new_events:
+        return
+    by_family = {}
+    for entry in sorted(new_events, key=lambda e: e.created_at or datetime.max):
+        by_family.setdefault(entry.family_unit_id, []).append(entry)
+    with session.no_autoflush:
+        for family_id, entries in by_family.items():
+            chain_entries(session, family_id, entries)
+
+
+def register(event_log_model, checkpoint_model, head_model):
+    """Chamado por models.py: encadeia todo EventLog novo em qualquer sessão."""
+    global _EventLog, _Checkpoint, _Head
+    _EventLog, _Checkpoint, _Head = event_log_model, checkpoint_model, head_model
+    if not event.contains(Session, "before_flush", _chain_new_events):
+        event.listen(Session, "before_flush", _chain_new_events)
+
+
+# --- Checkpoints sob demanda e verificação ---
+
+def seal_checkpoint(db: Session, family_id: int):
+    """Fecha um checkpoint com as entradas ainda não cobertas."""
+    seq, head, checkpoint_end = _chain_head(db, family_id)
+    if seq <= checkpoint_end:
+        db.rollback()  # libera a trava da cabeça
+        return None
+    hashes = _block_hashes(db, family_id, checkpoint_end + 1, seq)
+    if len(hashes) != seq - checkpoint_end:
+        # Entradas apagadas: não sela por cima de uma cadeia truncada (verify_range acusa)
+        print(f"Auditoria Erro (família {family_id}): bloco {checkpoint_end + 1}-{seq} incompleto, não selado")
+        db.rollback()
+        return None
+    checkpoint = _Checkpoint(
+        family_unit_id=family_id,
+        start_seq=checkpoint_end + 1,
+        end_seq=seq,
+        merkle_root=merkle_root(hashes),
+        chain_head=head,
+        created_at=datetime.now(timezone.utc)
+    )
+    db.add(checkpoint)
+    db.commit()
+    return checkpoint
+
+
+def seal_due_checkpoints(db: Session, max_age_seconds: int = CHECKPOINT_SEAL_SECONDS) -> int:
+    """Sela a cauda das famílias cujo último checkpoint tem mais de max_age_seconds."""
+    Checkpoint, Head = _Checkpoint, _Head
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=max_age_seconds)
+    last = db.query(
+        Checkpoint.family_unit_id,
+        func.max(Checkpoint.end_seq).label("end_seq"),
+        func.max(Checkpoint.created_at).label("created_at")
+    ).group_by(Checkpoint.family_unit_id).subquery()
+    due = [family_id for (family_id,) in db.query(Head.family_unit_id).outerjoin(
+        last, last.c.family_unit_id == Head.family_unit_id
+    ).filter(
+        Head.seq > func.coalesce(last.c.end_seq, 0),
+        or_(last.c.created_at.is_(None), last.c.created_at < cutoff)
+    )]
+    db.rollback()
+    return sum(1 for family_id in due if seal_checkpoint(db, family_id))
+
+
+async def seal_periodically(bind, interval_seconds: int = CHECKPOINT_SEAL_SECONDS):
+    """Laço do lifespan: sela as caudas vencidas a cada intervalo, fora do event loop."""
+    def run():
+        session = Session(bind=bind)
+        try:
+            return seal_due_checkpoints(session, interval_seconds)
+        finally:
+            session.close()
+
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            sealed = await asyncio.to_thread(run)
+            if sealed:
+                print(f"Auditoria: {sealed} checkpoints selados")
+        except Exception as e:
+            print(f"Auditoria Erro (selagem): {e}")
+
+
+def checkpoints_for_range(db: Session, family_id: int, first_seq: int, last_seq: int) -> list:
+    Checkpoint = _Checkpoint
+    return db.query(Checkpoint).filter(
+        Checkpoint.family_unit_id == family_id,
+        Checkpoint.end_seq >= first_seq,
+        Checkpoint.start_seq <= last_seq
+    ).order_by(Checkpoint.start_seq.asc()).all()
+
+
+def entry_hash_at(db: Session, family_id: int, seq: int):
+    EventLog = _EventLog
+    return db.query(EventLog.entry_hash).filter(EventLog.family_unit_id == family_id, EventLog.seq == seq).scalar()
+
+
+def seq_range(db: Session, family_id: int, start=None, end=None):
+    """Menor e maior seq das entradas no período (None, None se vazio)."""
+    EventLog = _EventLog
+    query = db.query(func.min(EventLog.seq), func.max(EventLog.seq)).filter(
+        EventLog.family_unit_id == family_id,
+        EventLog.seq.isnot(None)
+    )
+    if start:
+        query = query.filter(EventLog.created_at >= start)
+    if end:
+        query = query.filter(EventLog.created_at < end)
+    return query.one()
+
+
+def _verify_segment(db: Session, family_id: int, start_seq: int, end_seq: int, errors: list) -> list:
+    """Rehasha as entradas [start_seq, end_seq] e confere o encadeamento. Retorna os entry_hash."""
+    EventLog = _EventLog
+    previous = db.query(EventLog.entry_hash).filter(
+        EventLog.family_unit_id == family_id, EventLog.seq == start_seq - 1
+    ).scalar() if start_seq > 1 else GENESIS_HASH
+    hashes = []
+    expected_seq = start_seq
+    for entry in db.query(EventLog).filter(
+        EventLog.family_unit_id == family_id,
+        EventLog.seq >= start_seq,
+        EventLog.seq <= end_seq
+    ).order_by(EventLog.seq.asc()).yield_per(500):
+        if entry.seq != expected_seq:
+            errors.append({"seq": expected_seq, "error": "entrada ausente"})
+            expected_seq = entry.seq
+        if entry.prev_hash != previous:
+            errors.append({"seq": entry.seq, "event_id": entry.id, "error": "encadeamento quebrado"})
+        if entry_hash_of(entry) != entry.entry_hash:
+            errors.append({"seq": entry.seq, "event_id": entry.id, "error": "conteúdo alterado"})
+        hashes.append(entry.entry_hash)
+        previous = entry.entry_hash
+        expected_seq += 1
+    if expected_seq != end_seq + 1:
+        errors.append({"seq": expected_seq, "error": "entrada ausente"})
+    return hashes
+
+
+def _tail_marks(db: Session, family_id: int) -> list:
+    """(origem, seq, entry_hash) que a cabeça e o último checkpoint guardam do fim da cadeia."""
+    Head, Checkpoint = _Head, _Checkpoint
+    marks = []
+    head = db.query(Head.seq, Head.entry_hash).filter(Head.family_unit_id == family_id).first()
+    if head:
+        marks.append(("cabeça da cadeia", head.seq, head.entry_hash))
+    checkpoint = db.query(Checkpoint.end_seq, Checkpoint.chain_head).filter(
+        Checkpoint.family_unit_id == family_id
+    ).order_by(Checkpoint.end_seq.desc()).first()
+    if checkpoint:
+        marks.append(("último checkpoint", checkpoint.end_seq, checkpoint.chain_head))
+    return marks
+
+
+def _verify_tail(db: Session, family_id: int, marks: list, chain_last: int, errors: list):
+    """Apagar as últimas entradas não quebra o encadeamento do que sobra: compara com as marcas do fim."""
+    chain_last = chain_last or 0
+    expected_last = max([seq for _, seq, _ in marks], default=0)
+    if expected_last > chain_last:
+        errors.append({
+            "seq": chain_last + 1,
+            "error": "entradas ausentes no fim da cadeia",
+            "missing_seqs": list(range(chain_last + 1, expected_last + 1)),
+        })
+    for source, seq, entry_hash in marks:
+        if 0 < seq <= chain_last and entry_hash_at(db, family_id, seq) != entry_hash:
+            errors.append({"seq": seq, "error": f"{source} divergente"})
+
+
+def verify_range(db: Session, family_id: int, start=None, end=None) -> dict:
+    """
+    Verifica a integridade das entradas do período. Só os blocos de checkpoint que
+    tocam o período (e a cauda ainda sem checkpoint) são rehashados. Se o período chega
+    ao fim da cadeia, confere também se ela não foi truncada.
+    """
+    # Marcas lidas antes das entradas: gravações concorrentes só deixam a tabela à frente delas
+    marks = _tail_marks(db, family_id)
+    first_seq, last_seq = seq_range(db, family_id, start, end)
+    chain_last = seq_range(db, family_id)[1] if start or end else last_seq
+
+    errors = []
+    checked = 0
+    checkpoints = []
+    if first_seq is not None:
+        covered_until = first_seq - 1
+        checkpoints = checkpoints_for_range(db, family_id, first_seq, last_seq)
+        for checkpoint in checkpoints:
+            hashes = _verify_segment(db, family_id, checkpoint.start_seq, checkpoint.end_seq, errors)
+            checked += len(hashes)
+            if merkle_root(hashes) != checkpoint.merkle_root:
+                errors.append({"checkpoint_id": checkpoint.id, "error": "raiz Merkle divergente"})
+            covered_until = max(covered_until, checkpoint.end_seq)
+
+        if covered_until < last_seq:
+            tail = _verify_segment(db, family_id, covered_until + 1, last_seq, errors)
+            checked += len(tail)
+
+    if end is None or last_seq == chain_last:
+        _verify_tail(db, family_id, marks, chain_last, errors)
+
+    if first_seq is None and not errors:
+        return {"intact": True, "checked_entries": 0, "checkpoints": [], "errors": []}
+    return {
+        "intact": not errors,
+        "first_seq": first_seq,
+        "last_seq": last_seq,
+        "checked_entries": checked,
+        "checkpoints": [serialize_checkpoint(c) for c in checkpoints],
+        "errors": errors,
+    }
+
+
+def proof_for_entry(db: Session, entry) -> dict:
+    """Prova de inclusão O(log n) de uma entrada no checkpoint que a cobre."""
+    data = {
+        "event_id": entry.id,
+        "seq": entry.seq,
+        "entry_hash": entry.entry_hash,
+        "prev_hash": entry.prev_hash,
+        "content_valid": entry_hash_of(entry) == entry.entry_hash,
+    }
+    checkpoints = checkpoints_for_range(db, entry.family_unit_id, entry.seq, entry.seq)
+    if not checkpoints:
+        data["checkpoint"] = None
+        return data
+    checkpoint = checkpoints[0]
+    hashes = _block_hashes(db, entry.family_unit_id, checkpoint.start_seq, checkpoint.end_seq)
+    proof = merkle_proof(hashes, entry.seq - checkpoint.start_seq)
+    data.update({
+        "checkpoint": serialize_checkpoint(checkpoint),
+        "proof": proof,
+        "proof_valid": verify_proof(entry.entry_hash, proof, checkpoint.merkle_root),
+    })
+    return data
+
+
+def serialize_checkpoint(checkpoint) -> dict:
+    return {
+        "id": checkpoint.id,
+        "start_seq": checkpoint.start_seq,
+        "end_seq": checkpoint.end_seq,
+        "merkle_root": checkpoint.merkle_root,
+        "chain_head": checkpoint.chain_head,
+        "created_at": checkpoint.created_at,
+    }
+
+
+def backfill_legacy_events(db: Session) -> int:
+    """
+    Encadeia as entradas antigas (sem entry_hash). Em famílias que já têm cadeia elas
+    entram no fim, depois da cabeça atual: o seq passa a refletir a ordem de encadeamento,
+    não a de created_at, e a integridade vale a partir do backfill.
+    """
+    EventLog = _EventLog
+    count = 0
+    family_ids = [f for (f,) in db.query(EventLog.family_unit_id).filter(EventLog.entry_hash.is_(None)).distinct()]
+    for family_id in family_ids:
+        entries = db.query(EventLog).filter(
+            EventLog.family_unit_id == family_id,
+            EventLog.entry_hash.is_(None)
+        ).order_by(EventLog.created_at.asc(), EventLog.id.asc()).all()
+        chain_entries(db, family_id, entries)
+        db.commit()
+        count += len(entries)
+    return count
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+    import models  # registra os modelos no módulo audit_chain (não em __main__)
+    import audit_chain
+    session = SessionLocal()
+    try:
+        print(f"{audit_chain.backfill_legacy_events(session)} entradas encadeadas.")
+    finally:
+        session.close()
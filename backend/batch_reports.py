@@ -0,0 +1,133 @@
+"""
+Geração de dossiês em lote para mediadores e escritórios que acompanham várias famílias.
+
+Cada família é renderizada em um processo separado (coleta + PDF), com concorrência
+limitada pelo tamanho do pool. Uso pela linha de comando:
+
+    python batch_reports.py --families 3 7 12 --start-date 2025-01-01 --end-date 2025-06-30
+"""
+import os
+import sys
+import json
+import argparse
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+# Permite executar como script a partir de qualquer diretório
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from report_builder import build_report, report_fingerprint, find_cached_report
+
+BATCH_MAX_FAMILIES = int(os.environ.get("REPORT_BATCH_MAX_FAMILIES", 50))
+DEFAULT_BATCH_FILTERS = {
+    "include_events": True,
+    "include_expenses": True,
+    "include_checkins": True,
+    "include_appointments": True,
+}
+
+# Um engine por processo worker, reaproveitado entre as famílias que ele renderiza
+_engines = {}
+
+
+def _session(database_url: str) -> Session:
+    if database_url not in _engines:
+        connect_args = {"check_same_thread": False} if database_url.startswith("sqlite") else {}
+        _engines[database_url] = create_engine(database_url, connect_args=connect_args)
+    return Session(bind=_engines[database_url])
+
+
+def batch_filters(start_date: str = None, end_date: str = None, filters: dict = None) -> dict:
+    merged = dict(filters or DEFAULT_BATCH_FILTERS)
+    if start_date:
+        merged["start_date"] = start_date
+    if end_date:
+        merged["end_date"] = end_date
+    return merged
+
+
+def render_family_report(database_url: str, family_id: int, author_name: str, name: str, filters: dict, author_id: int = None) -> dict:
+    """Executado no pool de processos: gera (ou reaproveita) o relatório de uma família."""
+    db = _session(database_url)
+    try:
+        cached = find_cached_report(db, family_id, report_fingerprint(db, family_id, filters, name, author_id, author_name))
+        if cached:
+            report, was_cached = cached, True
+        else:
+            report, pdf = build_report(db, family_id, author_name, name, filters, author_id=author_id)
+            pdf.close()
+            was_cached = False
+        return {
+            "family_id": family_id,
+            "status": "completed",
+            "report_id": report.id,
+            "hash": report.hash_sha256,
+            "url": report.pdf_url,
+            "cached": was_cached,
+        }
+    except Exception as e:
+        db.rollback()
+        return {"family_id": family_id, "status": "failed", "error": str(e)}
+    finally:
+        db.close()
+
+
+def build_manifest(entries: list, filters: dict) -> dict:
+    entries = sorted(entries, key=lambda entry: entry["family_id"])
+    return {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "start_date": filters.get("start_date"),
+        "end_date": filters.get("end_date"),
+        "completed": sum(1 for entry in entries if entry["status"] == "completed"),
+        "failed": sum(1 for entry in entries if entry["status"] == "failed"),
+        "reports": entries,
+    }
+
+
+def generate_batch(database_url: str, family_ids: list, author_name: str, filters: dict, max_workers: int = None) -> dict:
+    """Versão síncrona (CLI): distribui as famílias em um pool de processos próprio."""
+    name = f"Dossiê em lote {datetime.now().strftime('%d/%m/%Y')}"
+    entries = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(render_family_report, database_url, family_id, author_name, name, filters)
+            for family_id in dict.fromkeys(family_ids)
+        ]
+        for future in as_completed(futures):
+            entry = future.result()
+            print(f"Família {entry['family_id']}: {entry['status']}")
+            entries.append(entry)
+    return build_manifest(entries, filters)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gera dossiês MEDIARE para várias famílias em paralelo.")
+    parser.add_argument("--families", type=int, nargs="+", required=True, help="IDs das famílias")
+    parser.add_argument("--start-date", help="Início do período (YYYY-MM-DD)")
+    parser.add_argument("--end-date", help="Fim do período, inclusivo (YYYY-MM-DD)")
+    parser.add_argument("--workers", type=int, default=None, help="Processos em paralelo (padrão: CPUs)")
+    parser.add_argument("--author", default="MEDIARE (lote)", help="Nome impresso em 'Gerado por'")
+    parser.add_argument("--output", help="Arquivo JSON para gravar o manifesto")
+    args = parser.parse_args(argv)
+
+    from database import DATABASE_URL
+    manifest = generate_batch(
+        DATABASE_URL,
+        args.families,
+        args.author,
+        batch_filters(args.start_date, args.end_date),
+        max_workers=args.workers
+    )
+
+    output = json.dumps(manifest, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+    return 0 if manifest["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,4 +18,11 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+def insert_on_conflict(db, table):
+    """INSERT com suporte a ON CONFLICT (upsert) no dialeto em uso: SQLite ou PostgreSQL."""
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
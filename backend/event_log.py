@@ -0,0 +1,123 @@
+from pydantic import BaseModel, ConfigDict, ValidationError
+from sqlalchemy.orm import Session
+from datetime import datetime, timezone
+from typing import Optional
+from models import EventLog
+
+# Esquemas tipados do EventLog.event_data (coluna JSON). As chaves child_id,
+# actor_user_id e reference_id também são copiadas para colunas indexadas,
+# permitindo filtrar eventos no SQL sem abrir o JSON.
+INDEXED_KEYS = ("child_id", "actor_user_id", "reference_id")
+
+
+class EventData(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    child_id: Optional[int] = None
+    actor_user_id: Optional[int] = None
+    reference_id: Optional[int] = None
+
+    def describe(self) -> str:
+        fields = self.model_dump(exclude_none=True, exclude=set(INDEXED_KEYS))
+        return ", ".join(f"{key}: {value}" for key, value in fields.items())
+
+
+class AgreementSuggestedEvent(EventData):
+    conflict: str
+    suggestion: str
+
+    def describe(self) -> str:
+        return f"Conflito: {self.conflict} | Sugestão: {self.suggestion}"
+
+
+class ExpenseEvent(EventData):
+    description: str
+    amount: float
+
+    def describe(self) -> str:
+        return f"{self.description} (R$ {self.amount:.2f})"
+
+
+class DelayEvent(EventData):
+    minutes: int
+    reason: Optional[str] = None
+
+    def describe(self) -> str:
+        return f"Atraso de {self.minutes} min" + (f": {self.reason}" if self.reason else "")
+
+
+class CheckInEvent(EventData):
+    status: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+
+
+class AppointmentEvent(EventData):
+    type: str
+    status: str
+    description: Optional[str] = None
+
+
+class ChatEvent(EventData):
+    message: str
+
+
+class ChatEditEvent(EventData):
+    previous_content: str
+    previous_status: str
+
+    def describe(self) -> str:
+        return f"Mensagem {self.reference_id} editada. Versão anterior: {self.previous_content}"
+
+
+class TaskEvent(EventData):
+    title: str
+    points: Optional[int] = None
+
+
+EVENT_SCHEMAS = {
+    "ai_agreement_suggested": AgreementSuggestedEvent,
+    "expense": ExpenseEvent,
+    "delay": DelayEvent,
+    "check-in": CheckInEvent,
+    "appointment": AppointmentEvent,
+    "chat": ChatEvent,
+    "chat_edit": ChatEditEvent,
+    "task": TaskEvent,
+}
+
+
+def event_values(event_type: str, family_id: int, data: dict, created_at: datetime = None) -> dict:
+    """Valida `data` contra o esquema do tipo e monta as colunas do EventLog (lança ValidationError se inválido)."""
+    payload = EVENT_SCHEMAS.get(event_type, EventData)(**data).model_dump(exclude_none=True)
+    return {
+        "event_type": event_type,
+        "event_data": payload,
+        "family_unit_id": family_id,
+        "child_id": payload.get("child_id"),
+        "actor_user_id": payload.get("actor_user_id"),
+        "reference_id": payload.get("reference_id"),
+        "created_at": created_at or datetime.now(timezone.utc),
+    }
+
+
+def build_event(event_type: str, family_id: int, data: dict, created_at: datetime = None) -> EventLog:
+    return EventLog(**event_values(event_type, family_id, data, created_at))
+
+
+def log_event(db: Session, event_type: str, family_id: int, data: dict, created_at: datetime = None) -> EventLog:
+    """Adiciona o evento à sessão; o commit fica com o chamador."""
+    event = build_event(event_type, family_id, data, created_at)
+    db.add(event)
+    return event
+
+
+def describe_event(event_type: str, data) -> str:
+    """Texto legível do evento para relatórios e prompts."""
+    if not isinstance(data, dict):
+        return str(data)
+    schema = EVENT_SCHEMAS.get(event_type, EventData)
+    try:
+        return schema(**data).describe()
+    except ValidationError:
+        return EventData(**data).describe()
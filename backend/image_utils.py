@@ -0,0 +1,79 @@
+import io
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:
+    Image = None
+    print("WARNING: Pillow not installed. Image pipeline disabled.")
+
+# Pipeline de imagens de recibos. As funções deste módulo rodam no pool de
+# processos (workers.py), por isso recebem e devolvem apenas bytes/dicts.
+AI_MAX_SIDE = 1600          # Suficiente para OCR do Gemini em notas fiscais
+PREVIEW_MAX_SIDE = 1024
+THUMBNAIL_SIZE = (256, 256)
+
+
+def _open_normalized(image_bytes: bytes):
+    """Decodifica, aplica a orientação EXIF e descarta metadados (GPS, câmera)."""
+    img = Image.open(io.BytesIO(image_bytes))
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    # Copiar os pixels para uma nova imagem garante que nenhum metadado sobreviva
+    clean = Image.new(img.mode, img.size)
+    clean.paste(img)
+    return clean
+
+
+def _encode(img, fmt: str, **options) -> bytes:
+    out = io.BytesIO()
+    img.save(out, format=fmt, **options)
+    return out.getvalue()
+
+
+def _downscaled(img, max_side: int):
+    if max(img.size) <= max_side:
+        return img
+    copy = img.copy()
+    copy.thumbnail((max_side, max_side), Image.LANCZOS)
+    return copy
+
+
+def _for_ai(img, max_side: int) -> bytes:
+    """Reduzida e em tons de cinza: o OCR não precisa de cor e o upload ao Gemini fica bem menor."""
+    return _encode(ImageOps.grayscale(_downscaled(img, max_side)), "JPEG", quality=85)
+
+
+def process_receipt(image_bytes: bytes):
+    """
+    Processa uma foto de recibo em uma única decodificação.
+    Retorna None se o arquivo não for uma imagem (ex: PDF), caso contrário um dict com:
+    - normalized: JPEG orientado e sem metadados (resolução original)
+    - ai: JPEG reduzido e em tons de cinza para envio ao Gemini
+    - thumbnail: WebP quadrado para listas
+    - preview: WebP médio para visualização
+    """
+    if Image is None:
+        return None
+    try:
+        img = _open_normalized(image_bytes)
+    except (UnidentifiedImageError, OSError):
+        return None
+
+    thumb = ImageOps.fit(img, THUMBNAIL_SIZE, Image.LANCZOS)
+    return {
+        "normalized": _encode(img, "JPEG", quality=90, optimize=True),
+        "ai": _for_ai(img, AI_MAX_SIDE),
+        "thumbnail": _encode(thumb, "WEBP", quality=75),
+        "preview": _encode(_downscaled(img, PREVIEW_MAX_SIDE), "WEBP", quality=80),
+    }
+
+
+def prepare_for_ai(image_bytes: bytes, max_side: int = AI_MAX_SIDE):
+    """Versão reduzida e em tons de cinza para análise por IA. Retorna None se não for imagem."""
+    if Image is None:
+        return None
+    try:
+        img = _open_normalized(image_bytes)
+    except (UnidentifiedImageError, OSError):
+        return None
+    return _for_ai(img, max_side)
@@ -0,0 +1,192 @@
+import os
+from datetime import datetime, timezone
+from sqlalchemy import func, update, case
+from sqlalchemy.orm import Session
+from database import insert_on_conflict
+from models import (ChatMessage, ChatReadWatermark, ConversationSummary, FamilyChat, FamilyMember,
+                    Notification, UserInboxSummary)
+
+# Resumo desnormalizado por usuário para o badge e a caixa de entrada: contadores de
+# notificações e mensagens não lidas, mais não lidas e última mensagem de cada chat.
+# É atualizado na mesma transação que cria/lê mensagens e notificações (o commit fica
+# com o chamador). Envios e notificações novas só incrementam; leituras, edições e
+# resultados de moderação recalculam o chat afetado. Linhas ausentes são reconstruídas.
+INBOX_PREVIEW_CHARS = int(os.environ.get("INBOX_PREVIEW_CHARS", 80))
+HIDDEN_STATUSES = ("pending", "blocked")
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _preview(content: str) -> str:
+    return content if len(content) <= INBOX_PREVIEW_CHARS else content[:INBOX_PREVIEW_CHARS - 1] + "…"
+
+
+def unread_count(db: Session, chat_id: int, user_id: int) -> int:
+    """Mensagens visíveis de outros remetentes acima da marca de leitura (range no índice chat_id, id)."""
+    watermark = db.query(ChatReadWatermark.last_read_message_id).filter(
+        ChatReadWatermark.chat_id == chat_id, ChatReadWatermark.user_id == user_id
+    ).scalar() or 0
+    return db.query(func.count(ChatMessage.id)).filter(
+        ChatMessage.chat_id == chat_id,
+        ChatMessage.id > watermark,
+        ChatMessage.sender_id != user_id,
+        ChatMessage.moderation_status.notin_(HIDDEN_STATUSES)
+    ).scalar()
+
+
+def _last_visible_message(db: Session, chat_id: int):
+    return db.query(ChatMessage).filter(
+        ChatMessage.chat_id == chat_id, ChatMessage.moderation_status.notin_(HIDDEN_STATUSES)
+    ).order_by(ChatMessage.id.desc()).first()
+
+
+def _apply_last_message(row: ConversationSummary, message):
+    row.last_message_id = message.id if message else None
+    row.last_message_preview = _preview(message.content) if message else None
+    row.last_message_at = message.created_at if message else None
+    row.last_sender_id = message.sender_id if message else None
+
+
+def chat_members(db: Session, chat_id: int) -> list:
+    return [user_id for (user_id,) in db.query(FamilyMember.user_id).join(
+        FamilyChat, FamilyChat.family_unit_id == FamilyMember.family_id
+    ).filter(FamilyChat.id == chat_id).all()]
+
+
+def _summary_row(db: Session, user_id: int) -> UserInboxSummary:
+    """Linha do usuário, criada se faltar. ON CONFLICT: duas primeiras requisições simultâneas não colidem."""
+    db.execute(insert_on_conflict(db, UserInboxSummary.__table__).values(
+        user_id=user_id, unread_notifications=0, unread_messages=0, updated_at=_now()
+    ).on_conflict_do_nothing(index_elements=["user_id"]))
+    return db.query(UserInboxSummary).filter(UserInboxSummary.user_id == user_id).one()
+
+
+def _conversation_row(db: Session, user_id: int, chat_id: int) -> ConversationSummary:
+    db.execute(insert_on_conflict(db, ConversationSummary.__table__).values(
+        user_id=user_id, chat_id=chat_id, unread_count=0, updated_at=_now()
+    ).on_conflict_do_nothing(index_elements=["user_id", "chat_id"]))
+    return db.query(ConversationSummary).filter(
+        ConversationSummary.user_id == user_id, ConversationSummary.chat_id == chat_id
+    ).one()
+
+
+def rebuild_user(db: Session, user_id: int) -> UserInboxSummary:
+    """Recalcula do zero o resumo do usuário (primeiro acesso, usuários antigos)."""
+    summary = _summary_row(db, user_id)
+    summary.unread_notifications = db.query(func.count(Notification.id)).filter(
+        Notification.user_id == user_id, Notification.read_at.is_(None)
+    ).scalar()
+
+    chat_ids = [chat_id for (chat_id,) in db.query(FamilyChat.id).join(
+        FamilyMember, FamilyMember.family_id == FamilyChat.family_unit_id
+    ).filter(FamilyMember.user_id == user_id).all()]
+    rows = {row.chat_id: row for row in db.query(ConversationSummary).filter(ConversationSummary.user_id == user_id)}
+    total = 0
+    for chat_id in chat_ids:
+        row = rows.get(chat_id) or _conversation_row(db, user_id, chat_id)
+        row.unread_count = unread_count(db, chat_id, user_id)
+        _apply_last_message(row, _last_visible_message(db, chat_id))
+        row.updated_at = _now()
+        total += row.unread_count
+    summary.unread_messages = total
+    summary.updated_at = _now()
+    db.flush()
+    return summary
+
+
+def refresh_chat(db: Session, chat_id: int, user_ids: list = None):
+    """Recalcula não lidas e última mensagem do chat para os usuários (padrão: membros) e ajusta os totais."""
+    user_ids = chat_members(db, chat_id) if user_ids is None else user_ids
+    last = _last_visible_message(db, chat_id)
+    for user_id in user_ids:
+        summary = db.query(UserInboxSummary).filter(UserInboxSummary.user_id == user_id).first()
+        if not summary:
+            rebuild_user(db, user_id)
+            continue
+        row = db.query(ConversationSummary).filter(
+            ConversationSummary.user_id == user_id, ConversationSummary.chat_id == chat_id
+        ).first() or _conversation_row(db, user_id, chat_id)
+        count = unread_count(db, chat_id, user_id)
+        summary.unread_messages = max(summary.unread_messages + count - (row.unread_count or 0), 0)
+        summary.updated_at = _now()
+        row.unread_count = count
+        _apply_last_message(row, last)
+        row.updated_at = _now()
+    db.flush()
+
+
+def _ensure(db: Session, user_ids: list, chat_id: int = None) -> set:
+    """Cria os resumos que faltam (já refletindo o que foi gravado) e retorna esses usuários."""
+    existing = {user_id for (user_id,) in db.query(UserInboxSummary.user_id).filter(UserInboxSummary.user_id.in_(user_ids))}
+    fresh = set(user_ids) - existing
+    if chat_id is not None and existing:
+        with_row = {user_id for (user_id,) in db.query(ConversationSummary.user_id).filter(
+            ConversationSummary.chat_id == chat_id, ConversationSummary.user_id.in_(existing)
+        )}
+        if existing - with_row:
+            refresh_chat(db, chat_id, list(existing - with_row))
+            fresh |= existing - with_row
+    for user_id in set(user_ids) - existing:
+        rebuild_user(db, user_id)
+    return fresh
+
+
+def message_created(db: Session, message: ChatMessage):
+    """Nova mensagem visível (já com flush): incrementa não lidas dos outros membros e atualiza a prévia."""
+    members = chat_members(db, message.chat_id)
+    if not members:
+        return
+    fresh = _ensure(db, members, message.chat_id)
+    targets = [user_id for user_id in members if user_id not in fresh]
+    recipients = [user_id for user_id in targets if user_id != message.sender_id]
+    now = _now()
+    if targets:
+        db.execute(update(ConversationSummary).where(
+            ConversationSummary.chat_id == message.chat_id, ConversationSummary.user_id.in_(targets)
+        ).values(
+            unread_count=case((ConversationSummary.user_id != message.sender_id, ConversationSummary.unread_count + 1),
+                              else_=ConversationSummary.unread_count),
+            last_message_id=message.id,
+            last_message_preview=_preview(message.content),
+            last_message_at=message.created_at,
+            last_sender_id=message.sender_id,
+            updated_at=now,
+        ))
+    if recipients:
+        db.execute(update(UserInboxSummary).where(UserInboxSummary.user_id.in_(recipients)).values(
+            unread_messages=UserInboxSummary.unread_messages + 1, updated_at=now
+        ))
+
+
+def notifications_created(db: Session, user_ids: list):
+    """Notificações novas (já com flush) para estes usuários, uma por entrada da lista."""
+    if not user_ids:
+        return
+    fresh = _ensure(db, list(set(user_ids)))
+    increments = {}
+    for user_id in user_ids:
+        if user_id not in fresh:
+            increments[user_id] = increments.get(user_id, 0) + 1
+    now = _now()
+    for amount in set(increments.values()):
+        db.execute(update(UserInboxSummary).where(
+            UserInboxSummary.user_id.in_([user_id for user_id, n in increments.items() if n == amount])
+        ).values(unread_notifications=UserInboxSummary.unread_notifications + amount, updated_at=now))
+
+
+def notification_read(db: Session, user_id: int):
+    if _ensure(db, [user_id]):
+        return
+    db.execute(update(UserInboxSummary).where(
+        UserInboxSummary.user_id == user_id, UserInboxSummary.unread_notifications > 0
+    ).values(unread_notifications=UserInboxSummary.unread_notifications - 1, updated_at=_now()))
+
+
+def get_summary(db: Session, user_id: int) -> UserInboxSummary:
+    summary = db.query(UserInboxSummary).filter(UserInboxSummary.user_id == user_id).first()
+    if not summary:
+        summary = rebuild_user(db, user_id)
+        db.commit()
+    return summary
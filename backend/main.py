@@ -1,12 +1,18 @@
 import os
+import asyncio
 from dotenv import load_dotenv
 # Carregar variáveis de ambiente do arquivo .env na raiz do projeto
 load_dotenv(os.path.join(os.path.dirname(__file__), "..", ".env"))
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.staticfiles import StaticFiles
-from routers import onboarding, locations, calendar, expenses, budgets, gamification, appointments, reports, chats, agreements, notifications, users, auth
+from routers import onboarding, locations, calendar, expenses, budgets, gamification, appointments, reports, chats, agreements, notifications, users, auth, audit, inbox
 from database import get_db, engine
+from workers import shutdown_pools
+from write_buffer import write_buffer
+from push import push_worker
+from ai_utils import ClientDisconnected
+import audit_chain
 import models
 
 from fastapi.responses import HTMLResponse
@@ -29,10 +35,26 @@ async def lifespan(app: FastAPI):
     # Criar diretórios se não existirem
     os.makedirs("reports", exist_ok=True)
     os.makedirs("expenses", exist_ok=True)
+    write_buffer.start(engine)
+    push_worker.start(engine)
+    # Mensagens que ficaram em moderação quando o servidor parou
+    resume_task = asyncio.create_task(chats.resume_pending_moderation(engine))
+    seal_task = asyncio.create_task(audit_chain.seal_periodically(engine))
     yield
+    resume_task.cancel()
+    seal_task.cancel()
+    # Grava as inserções pendentes antes de encerrar os pools
+    write_buffer.stop()
+    push_worker.stop()
+    shutdown_pools()
 
 app = FastAPI(lifespan=lifespan)
 
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected(request: Request, exc: ClientDisconnected):
+    # Ninguém lê a resposta: o 499 só fica nos logs de acesso
+    return Response(status_code=499)
+
 app.include_router(auth.router)
 app.include_router(onboarding.router)
 app.include_router(locations.router)
@@ -46,6 +68,8 @@ app.include_router(chats.router)
 app.include_router(agreements.router)
 app.include_router(notifications.router)
 app.include_router(users.router)
+app.include_router(audit.router)
+app.include_router(inbox.router)
 
 # Configuração da chave da API do Google Maps (usar variável de ambiente)
 if not os.environ.get('GOOGLE_MAPS_API_KEY'):
@@ -1,7 +1,8 @@
 
 
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float, Boolean, Text
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float, Boolean, Text, UniqueConstraint, Index, JSON
 from sqlalchemy.orm import relationship
+from datetime import datetime, timezone
 try:
     from .database import Base
 except ImportError:
@@ -18,6 +19,7 @@ class User(Base):
     family_unit_id = Column(Integer, nullable=True) # Current active family
     onboarding_completed = Column(Boolean, default=False)
     resguardo_active = Column(Boolean, default=False)
+    resguardo_digest = Column(Boolean, default=False)  # Em resguardo, recebe um resumo agendado em vez de nada
     families = relationship("FamilyMember", back_populates="user")
     deleted_at = Column(DateTime, nullable=True)
 
@@ -113,14 +115,31 @@ class Expense(Base):
     amount = Column(Float, nullable=False)
     attachment_url = Column(String, nullable=True)
     attachment_hash_sha256 = Column(String, nullable=True)
+    thumbnail_url = Column(String, nullable=True)  # WebP 256x256 para listas
+    preview_url = Column(String, nullable=True)  # WebP reduzido para visualização
+    normalized_url = Column(String, nullable=True)  # JPEG orientado e sem metadados; o original fica em attachment_url
     family_unit_id = Column(Integer, ForeignKey('family_units.id'))
     child_id = Column(Integer, ForeignKey('children.id'))
     status = Column(String, nullable=False, default='Pendente')
     created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=True, onupdate=lambda: datetime.now(timezone.utc))
     family = relationship("FamilyUnit")
     child = relationship("Child")
     deleted_at = Column(DateTime, nullable=True)
 
+class ReceiptAnalysis(Base):
+    """Resultado da leitura de um recibo pela IA, reaproveitado para a mesma imagem (SHA-256 do upload)."""
+    __tablename__ = 'receipt_analyses'
+    id = Column(Integer, primary_key=True, index=True)
+    family_unit_id = Column(Integer, ForeignKey('family_units.id'), nullable=True)
+    content_hash = Column(String, nullable=False)
+    prompt_version = Column(Integer, nullable=False)  # prompt mudou: resultados antigos deixam de valer
+    result = Column(JSON, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    __table_args__ = (
+        UniqueConstraint('family_unit_id', 'content_hash', 'prompt_version', name='uq_receipt_analysis_family_hash'),
+    )
+
 class ExpenseShare(Base):
     __tablename__ = 'expense_shares'
     id = Column(Integer, primary_key=True, index=True)
@@ -179,11 +198,17 @@ class ChatMessage(Base):
     content = Column(String, nullable=False)
     toxicity_score = Column(Float, nullable=False)
     sentiment_score = Column(Float, nullable=False)
-    moderation_status = Column(String, nullable=False)  # allowed, blocked, needs_rewrite
+    moderation_status = Column(String, nullable=False)  # pending, allowed, blocked, needs_rewrite
     created_at = Column(DateTime, nullable=False)
+    edited_at = Column(DateTime, nullable=True)
     chat = relationship("FamilyChat")
     sender = relationship("User")
+    __table_args__ = (
+        # Contagem de não lidas: intervalo de ids acima da marca de leitura
+        Index('ix_chat_messages_chat_id_id', 'chat_id', 'id'),
+    )
 
+# Legado: um recibo por mensagem, substituído por ChatReadWatermark (migrado em fix_db.py)
 class ChatMessageRead(Base):
     __tablename__ = 'chat_message_reads'
     id = Column(Integer, primary_key=True, index=True)
@@ -193,6 +218,40 @@ class ChatMessageRead(Base):
     message = relationship("ChatMessage")
     user = relationship("User")
 
+class ChatReadWatermark(Base):
+    __tablename__ = 'chat_read_watermarks'
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(Integer, ForeignKey('family_chats.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    last_read_message_id = Column(Integer, nullable=False, default=0)  # tudo até este id foi lido
+    updated_at = Column(DateTime, nullable=False)
+    __table_args__ = (
+        UniqueConstraint('chat_id', 'user_id', name='uq_chat_read_watermark'),
+    )
+
+class UserInboxSummary(Base):
+    __tablename__ = 'user_inbox_summaries'
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, unique=True)
+    unread_notifications = Column(Integer, nullable=False, default=0)
+    unread_messages = Column(Integer, nullable=False, default=0)  # soma dos chats
+    updated_at = Column(DateTime, nullable=False)
+
+class ConversationSummary(Base):
+    __tablename__ = 'conversation_summaries'
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    chat_id = Column(Integer, ForeignKey('family_chats.id'), nullable=False)
+    unread_count = Column(Integer, nullable=False, default=0)
+    last_message_id = Column(Integer, nullable=True)
+    last_message_preview = Column(String, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+    last_sender_id = Column(Integer, ForeignKey('users.id'), nullable=True)
+    updated_at = Column(DateTime, nullable=False)
+    __table_args__ = (
+        UniqueConstraint('user_id', 'chat_id', name='uq_conversation_summary_user_chat'),
+    )
+
 class Task(Base):
     __tablename__ = 'tasks'
     id = Column(Integer, primary_key=True, index=True)
@@ -249,6 +308,7 @@ class Appointment(Base):
     family = relationship("FamilyUnit")
     location = relationship("Location")
     deleted_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True, onupdate=lambda: datetime.now(timezone.utc))
 
 class AppointmentChecklist(Base):
     __tablename__ = 'appointment_checklists'
@@ -277,10 +337,40 @@ class EventLog(Base):
     __tablename__ = 'event_log'
     id = Column(Integer, primary_key=True, index=True)
     event_type = Column(String, nullable=False)  # expense, delay, check-in, appointment, chat, task
-    event_data = Column(String, nullable=False)  # JSON data for the event
+    event_data = Column(JSON, nullable=False)  # Validado pelos esquemas de event_log.py
     family_unit_id = Column(Integer, ForeignKey('family_units.id'))
     created_at = Column(DateTime, nullable=False)
+    # Chaves comuns do event_data, indexadas para filtrar no SQL
+    child_id = Column(Integer, ForeignKey('children.id'), nullable=True, index=True)
+    actor_user_id = Column(Integer, ForeignKey('users.id'), nullable=True, index=True)
+    reference_id = Column(Integer, nullable=True, index=True)
+    # Cadeia de hashes por família (preenchida automaticamente por audit_chain)
+    seq = Column(Integer, nullable=True)
+    prev_hash = Column(String, nullable=True)
+    entry_hash = Column(String, nullable=True, index=True)
     family = relationship("FamilyUnit")
+    __table_args__ = (
+        UniqueConstraint('family_unit_id', 'seq', name='uq_event_log_family_seq'),
+        Index('ix_event_log_family_type_created', 'family_unit_id', 'event_type', 'created_at'),
+    )
+
+class EventLogCheckpoint(Base):
+    __tablename__ = 'event_log_checkpoints'
+    id = Column(Integer, primary_key=True, index=True)
+    family_unit_id = Column(Integer, ForeignKey('family_units.id'), index=True)
+    start_seq = Column(Integer, nullable=False)
+    end_seq = Column(Integer, nullable=False)
+    merkle_root = Column(String, nullable=False)
+    chain_head = Column(String, nullable=False)  # entry_hash da última entrada do bloco
+    created_at = Column(DateTime, nullable=False)
+
+class EventChainHead(Base):
+    # Uma linha por família: travada a cada gravação na cadeia para serializar o seq
+    __tablename__ = 'event_chain_heads'
+    family_unit_id = Column(Integer, ForeignKey('family_units.id'), primary_key=True)
+    seq = Column(Integer, nullable=False)
+    entry_hash = Column(String, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
 
 class Report(Base):
     __tablename__ = 'reports'
@@ -288,11 +378,30 @@ class Report(Base):
     name = Column(String, nullable=False)
     filters = Column(String, nullable=False)  # JSON representation of filters applied
     pdf_url = Column(String, nullable=False)
-    hash_sha256 = Column(String, nullable=False)
+    hash_sha256 = Column(String, nullable=False, index=True)
+    fingerprint = Column(String, nullable=True, index=True)  # família + filtros + nome/autor + watermark dos dados
     created_at = Column(DateTime, nullable=False)
     family_unit_id = Column(Integer, ForeignKey('family_units.id'))
     family = relationship("FamilyUnit")
 
+class ReportJob(Base):
+    __tablename__ = 'report_jobs'
+    id = Column(String, primary_key=True)  # uuid4 hex, retornado ao cliente para polling
+    name = Column(String, nullable=False)
+    filters = Column(String, nullable=False)  # JSON dos filtros solicitados
+    fingerprint = Column(String, nullable=True, index=True)
+    batch_id = Column(String, nullable=True, index=True)  # jobs criados juntos por POST /reports/batch
+    status = Column(String, nullable=False, default='queued')  # queued, running, completed, failed
+    progress = Column(Integer, nullable=False, default=0)  # 0 a 100
+    error = Column(String, nullable=True)
+    report_id = Column(Integer, ForeignKey('reports.id'), nullable=True)
+    family_unit_id = Column(Integer, ForeignKey('family_units.id'), index=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    created_at = Column(DateTime, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    report = relationship("Report")
+
 class Notification(Base):
     __tablename__ = 'notifications'
     id = Column(Integer, primary_key=True, index=True)
@@ -303,8 +412,47 @@ class Notification(Base):
     created_at = Column(DateTime, nullable=False)
     user_id = Column(Integer, ForeignKey('users.id'))
     family_unit_id = Column(Integer, ForeignKey('family_units.id'))
+    # Agrupamento: avisos com a mesma chave dentro da janela viram uma linha só ("3 missões concluídas")
+    group_key = Column(String, nullable=True)
+    occurrences = Column(Integer, nullable=False, default=1)
+    updated_at = Column(DateTime, nullable=True)
+    digest_pending = Column(Boolean, nullable=False, default=False)  # aguardando o resumo do resguardo
     user = relationship("User")
     family = relationship("FamilyUnit")
+    __table_args__ = (
+        Index('ix_notifications_user_group_key', 'user_id', 'group_key'),
+        Index('ix_notifications_digest_pending', 'digest_pending', 'user_id'),
+    )
+
+class PushDevice(Base):
+    __tablename__ = 'push_devices'
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    token = Column(String, nullable=False, unique=True)  # token FCM do aparelho
+    platform = Column(String, nullable=True)  # android, ios, web
+    created_at = Column(DateTime, nullable=False)
+    last_seen_at = Column(DateTime, nullable=False)
+    disabled_at = Column(DateTime, nullable=True)  # token rejeitado pelo FCM ou removido
+
+class PushOutbox(Base):
+    __tablename__ = 'push_outbox'
+    id = Column(Integer, primary_key=True, index=True)
+    device_id = Column(Integer, ForeignKey('push_devices.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    notification_id = Column(Integer, ForeignKey('notifications.id'), nullable=True)
+    title = Column(String, nullable=False)
+    body = Column(String, nullable=False)
+    priority = Column(String, nullable=False, default='normal')
+    status = Column(String, nullable=False, default='pending')  # pending, sending, sent, dead
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False)
+    dedupe_key = Column(String, nullable=False, unique=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    sent_at = Column(DateTime, nullable=True)
+    __table_args__ = (
+        Index('ix_push_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
 
 class Agreement(Base):
     __tablename__ = 'agreements'
@@ -318,3 +466,11 @@ class Agreement(Base):
     fulfilled_at = Column(DateTime, nullable=True)
     deleted_at = Column(DateTime, nullable=True)
     family = relationship("FamilyUnit")
+
+
+try:
+    from .audit_chain import register as register_event_chain
+except ImportError:
+    from audit_chain import register as register_event_chain
+
+register_event_chain(EventLog, EventLogCheckpoint, EventChainHead)
@@ -0,0 +1,167 @@
+import os
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import String, and_, cast, event, func, insert, literal, not_, or_, select, update
+from sqlalchemy.orm import Session
+from models import FamilyMember, Notification, User
+import inbox_summary
+import pubsub
+import push
+
+# Fan-out de notificações: resolve destinatários, regras de Resguardo (não perturbe)
+# e prioridade em uma única consulta e insere todas as notificações em um único
+# INSERT em lote. O commit fica com o chamador, junto com a alteração que gerou o aviso.
+# Depois do commit cada notificação é publicada no tópico "user:{id}" (SSE/long-poll)
+# e o push_worker é acordado para enviar os pushes gravados no outbox.
+#
+# Agrupamento: avisos com group_key (mesmo tipo e assunto) que chegam enquanto o anterior
+# ainda não foi lido e foi aberto há menos de NOTIFICATION_COALESCE_SECONDS atualizam essa
+# linha ("3 missões concluídas") em vez de criar outra, e o push pendente dela.
+# Quem está em resguardo com resguardo_digest recebe as notificações sem push nem evento
+# (digest_pending); o push_worker as entrega depois em um resumo (push.enqueue_digests).
+#
+# Públicos:
+#   family         todos os membros ativos da família
+#   others         todos menos o autor (actor_id)
+#   parents        membros com papel "parent"
+#   other_parents  responsáveis menos o autor
+#   users          só os user_ids informados (desde que sejam membros)
+AUDIENCES = ("family", "others", "parents", "other_parents", "users")
+# Resguardo silencia "low" e "normal"; "urgent" (emergências) chega sempre
+PRIORITIES = ("low", "normal", "urgent")
+NOTIFICATION_COALESCE_SECONDS = float(os.environ.get("NOTIFICATION_COALESCE_SECONDS", 600))
+
+
+def recipients_query(db: Session, family_id: int, audience: str = "others", actor_id: int = None,
+                     user_ids: list = None, priority: str = "normal"):
+    """Consulta (user_id, digest): digest indica quem recebe só no resumo do resguardo."""
+    if audience not in AUDIENCES:
+        raise ValueError(f"Público desconhecido: {audience}")
+    if priority not in PRIORITIES:
+        raise ValueError(f"Prioridade desconhecida: {priority}")
+
+    resting = User.resguardo_active.is_(True)
+    wants_digest = User.resguardo_digest.is_(True)
+    digest = literal(False) if priority == "urgent" else and_(resting, wants_digest)
+    query = db.query(FamilyMember.user_id, digest.label("digest")).join(User, User.id == FamilyMember.user_id).filter(
+        FamilyMember.family_id == family_id,
+        FamilyMember.deleted_at.is_(None),
+        User.deleted_at.is_(None)
+    )
+    if audience in ("others", "other_parents") and actor_id is not None:
+        query = query.filter(FamilyMember.user_id != actor_id)
+    if audience in ("parents", "other_parents"):
+        query = query.filter(FamilyMember.role == "parent")
+    if audience == "users":
+        query = query.filter(FamilyMember.user_id.in_(user_ids or []))
+    if priority != "urgent":
+        query = query.filter(or_(not_(resting), wants_digest))
+    return query.distinct()
+
+
+def _coalesce(db: Session, family_id: int, user_ids: list, n_type: str, group_key: str, content: str,
+              digest_title: str, now: datetime) -> list:
+    """Atualiza a notificação aberta de cada usuário com a mesma chave. Retorna as linhas atualizadas."""
+    since = (now - timedelta(seconds=NOTIFICATION_COALESCE_SECONDS)).replace(tzinfo=None)
+    # Uma linha aberta por usuário e chave: só a mais recente recebe o novo aviso
+    latest = select(func.max(Notification.id)).where(
+        Notification.user_id.in_(user_ids),
+        Notification.family_unit_id == family_id,
+        Notification.type == n_type,
+        Notification.group_key == group_key,
+        Notification.read_at.is_(None),
+        Notification.created_at >= since,
+    ).group_by(Notification.user_id)
+    count = Notification.occurrences + 1
+    values = {"occurrences": count, "content": content, "updated_at": now}
+    if digest_title:
+        prefix, _, suffix = digest_title.partition("{count}")
+        values["title"] = literal(prefix) + cast(count, String) + literal(suffix)
+    statement = update(Notification).where(Notification.id.in_(latest)).values(**values).returning(
+        Notification.id, Notification.user_id, Notification.title, Notification.occurrences,
+        Notification.created_at, Notification.digest_pending
+    )
+    return db.execute(statement, execution_options={"synchronize_session": False}).all()
+
+
+def notify_family(db: Session, family_id: int, title: str, content: str, n_type: str = "info",
+                  audience: str = "others", actor_id: int = None, user_ids: list = None,
+                  priority: str = "normal", group_key: str = None, digest_title: str = None) -> list:
+    """
+    Cria as notificações do público na sessão (sem commit). Retorna [(notification_id, user_id)].
+    Com group_key, agrupa na notificação aberta do mesmo tipo e chave; digest_title (com
+    "{count}") passa a ser o título dela, ex.: "{count} missões concluídas".
+    """
+    rows = recipients_query(db, family_id, audience, actor_id, user_ids, priority).all()
+    if not rows:
+        return []
+    recipients = [user_id for user_id, _ in rows]
+    digest_users = {user_id for user_id, digest in rows if digest}
+    now = datetime.now(timezone.utc)
+    merged = _coalesce(db, family_id, recipients, n_type, group_key, content, digest_title, now) if group_key else []
+    merged_users = {row.user_id for row in merged}
+    fresh = [user_id for user_id in recipients if user_id not in merged_users]
+
+    created = []
+    if fresh:
+        result = db.execute(
+            insert(Notification).returning(Notification.id, Notification.user_id, sort_by_parameter_order=True),
+            [
+                {"title": title, "content": content, "type": n_type, "user_id": user_id,
+                 "family_unit_id": family_id, "created_at": now, "group_key": group_key,
+                 "occurrences": 1, "digest_pending": user_id in digest_users}
+                for user_id in fresh
+            ]
+        )
+        created = [(notification_id, user_id) for notification_id, user_id in result]
+        # Agrupadas continuam sendo uma não lida só: o contador sobe apenas para as novas
+        inbox_summary.notifications_created(db, fresh)
+    live = [(notification_id, user_id) for notification_id, user_id in created if user_id not in digest_users]
+    # Outbox de push na mesma transação: o envio ao FCM fica com o push_worker
+    push.enqueue_for_notifications(db, [notification_id for notification_id, _ in live], priority)
+    # Agrupadas não geram push novo; o que ainda não saiu leva o texto atualizado
+    push.refresh_pending(db, [row.id for row in merged])
+
+    # Mesmo formato de data do GET /notifications (UTC sem fuso, como gravado no banco)
+    created_at = now.replace(tzinfo=None).isoformat()
+    events = db.info.setdefault("notifier_events", [])
+    events.extend(
+        (user_id, {"id": notification_id, "title": title, "content": content, "type": n_type,
+                   "priority": priority, "created_at": created_at, "read_at": None,
+                   "occurrences": 1, "updated_at": None})
+        for notification_id, user_id in live
+    )
+    events.extend(
+        (row.user_id, {"id": row.id, "title": row.title, "content": content, "type": n_type,
+                       "priority": priority, "created_at": row.created_at.isoformat(), "read_at": None,
+                       "occurrences": row.occurrences, "updated_at": created_at, "updated": True})
+        for row in merged if not row.digest_pending
+    )
+    return created + [(row.id, row.user_id) for row in merged]
+
+
+def serialize(notification: Notification) -> dict:
+    return {
+        "id": notification.id,
+        "title": notification.title,
+        "content": notification.content,
+        "type": notification.type,
+        "created_at": notification.created_at.isoformat() if notification.created_at else None,
+        "read_at": notification.read_at.isoformat() if notification.read_at else None,
+        "occurrences": notification.occurrences or 1,
+        "updated_at": notification.updated_at.isoformat() if notification.updated_at else None,
+    }
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_committed(session):
+    # Só publica o que foi de fato gravado
+    events = session.info.pop("notifier_events", None)
+    for user_id, payload in events or ():
+        pubsub.broker.publish(pubsub.user_topic(user_id), payload)
+    if events:
+        push.push_worker.wake()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back(session):
+    session.info.pop("notifier_events", None)
@@ -0,0 +1,226 @@
+import os
+import json
+import asyncio
+import queue
+import threading
+from collections import Counter
+
+# Pub/sub para eventos em tempo real do chat (mensagens, moderação, digitação, presença).
+# Tópicos: "chat:{chat_id}" (todos os membros do chat) e "user:{user_id}" (só o usuário).
+# Sem PUBSUB_REDIS_URL os eventos circulam só neste processo (um nó, testes); com ela,
+# passam pelo Redis e chegam aos inscritos de todos os nós.
+PUBSUB_REDIS_URL = os.environ.get("PUBSUB_REDIS_URL") or None
+PUBSUB_PREFIX = os.environ.get("PUBSUB_PREFIX", "mediare:")
+# Cada inscrito tem uma fila limitada; se ele não consumir a tempo, os eventos mais antigos são descartados
+PUBSUB_QUEUE_SIZE = int(os.environ.get("PUBSUB_QUEUE_SIZE", 100))
+# Eventos aguardando envio ao Redis; cheia, o evento é entregue só aos inscritos deste nó
+PUBSUB_PUBLISH_QUEUE_SIZE = int(os.environ.get("PUBSUB_PUBLISH_QUEUE_SIZE", 10000))
+
+
+def chat_topic(chat_id: int) -> str:
+    return f"chat:{chat_id}"
+
+
+def user_topic(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+class Subscription:
+    def __init__(self, broker, topics, loop, maxsize: int):
+        self.broker = broker
+        self.topics = tuple(topics)
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    async def get(self) -> dict:
+        return await self.queue.get()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        return await self.queue.get()
+
+
+class InProcessBroker:
+    """Entrega os eventos aos inscritos deste processo. `publish` pode ser chamado de qualquer thread."""
+
+    def __init__(self, queue_size: int = PUBSUB_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._presence = {}
+        self._lock = threading.Lock()
+
+    async def subscribe(self, *topics) -> Subscription:
+        return self._add(Subscription(self, topics, asyncio.get_running_loop(), self.queue_size))
+
+    def _add(self, subscription: Subscription) -> Subscription:
+        with self._lock:
+            for topic in subscription.topics:
+                self._subscribers.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> list:
+        """Remove o inscrito e retorna os tópicos que ficaram sem nenhum inscrito."""
+        emptied = []
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[topic]
+                        emptied.append(topic)
+        return emptied
+
+    def publish(self, topic: str, event: dict):
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(self._offer, subscription.queue, event)
+            except RuntimeError:
+                # Loop do inscrito já encerrado
+                self.unsubscribe(subscription)
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, event: dict):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(event)
+
+    # Presença: conexões abertas por usuário em cada tópico
+    def join(self, topic: str, user_id: int) -> int:
+        with self._lock:
+            counts = self._presence.setdefault(topic, Counter())
+            counts[user_id] += 1
+            return counts[user_id]
+
+    def leave(self, topic: str, user_id: int) -> int:
+        with self._lock:
+            counts = self._presence.get(topic, Counter())
+            counts[user_id] -= 1
+            remaining = counts[user_id]
+            if remaining <= 0:
+                del counts[user_id]
+                if not counts:
+                    self._presence.pop(topic, None)
+            return max(remaining, 0)
+
+    def online(self, topic: str) -> list:
+        with self._lock:
+            return sorted(self._presence.get(topic, ()))
+
+
+class RedisBroker(InProcessBroker):
+    """
+    Vários nós: `publish` envia ao Redis e um único listener por processo repassa as
+    mensagens dos canais com inscritos locais para as filas (via InProcessBroker).
+    O envio é feito por uma thread própria: `publish` é chamado do event loop (websocket,
+    after_commit de rotas async) e não pode esperar a ida ao Redis.
+    Presença fica em um hash do Redis, compartilhado entre os nós (chamadas síncronas).
+    """
+
+    def __init__(self, url: str, prefix: str = PUBSUB_PREFIX, queue_size: int = PUBSUB_QUEUE_SIZE):
+        import redis
+        super().__init__(queue_size)
+        self.url = url
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+        self._pubsub = None
+        self._listener = None
+        self._loop = None
+        self._outbox = queue.Queue(maxsize=PUBSUB_PUBLISH_QUEUE_SIZE)
+        self._publisher = None
+        self._publisher_lock = threading.Lock()
+
+    def _channel(self, topic: str) -> str:
+        return self.prefix + topic
+
+    def publish(self, topic: str, event: dict):
+        """Enfileira para a thread de envio e retorna na hora (qualquer thread)."""
+        with self._publisher_lock:
+            if self._publisher is None or not self._publisher.is_alive():
+                self._publisher = threading.Thread(target=self._publish_loop, name="mediare-pubsub-publish", daemon=True)
+                self._publisher.start()
+        try:
+            self._outbox.put_nowait((topic, event))
+        except queue.Full:
+            print(f"PubSub: fila de envio cheia, entregando {topic} só neste nó")
+            super().publish(topic, event)
+
+    def _publish_loop(self):
+        while True:
+            topic, event = self._outbox.get()
+            try:
+                self._redis.publish(self._channel(topic), json.dumps(event, default=str))
+            except Exception as e:
+                # Redis fora: ao menos os inscritos deste nó recebem
+                print(f"PubSub Erro (publish {topic}): {e}")
+                super().publish(topic, event)
+
+    async def subscribe(self, *topics) -> Subscription:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._loop.is_closed():
+            import redis.asyncio as aioredis
+            self._pubsub = aioredis.Redis.from_url(self.url).pubsub()
+            self._listener = None
+            self._loop = loop
+        subscription = self._add(Subscription(self, topics, loop, self.queue_size))
+        await self._pubsub.subscribe(*[self._channel(topic) for topic in topics])
+        if self._listener is None or self._listener.done():
+            self._listener = loop.create_task(self._listen())
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> list:
+        emptied = super().unsubscribe(subscription)
+        if emptied and self._pubsub is not None and self._loop is not None and not self._loop.is_closed():
+            channels = [self._channel(topic) for topic in emptied]
+            self._loop.call_soon_threadsafe(lambda: self._loop.create_task(self._pubsub.unsubscribe(*channels)))
+        return emptied
+
+    async def _listen(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"PubSub Erro (listener): {e}")
+                await asyncio.sleep(1)
+                continue
+            if message is None or message.get("type") != "message":
+                continue
+            topic = message["channel"].decode()[len(self.prefix):]
+            super().publish(topic, json.loads(message["data"]))
+
+    def _presence_key(self, topic: str) -> str:
+        return f"{self.prefix}presence:{topic}"
+
+    def join(self, topic: str, user_id: int) -> int:
+        return int(self._redis.hincrby(self._presence_key(topic), user_id, 1))
+
+    def leave(self, topic: str, user_id: int) -> int:
+        key = self._presence_key(topic)
+        remaining = int(self._redis.hincrby(key, user_id, -1))
+        if remaining <= 0:
+            self._redis.hdel(key, user_id)
+        return max(remaining, 0)
+
+    def online(self, topic: str) -> list:
+        return sorted(int(user_id) for user_id in self._redis.hkeys(self._presence_key(topic)))
+
+
+def create_broker(redis_url: str = PUBSUB_REDIS_URL):
+    if redis_url:
+        try:
+            return RedisBroker(redis_url)
+        except ImportError:
+            print("WARNING: redis not installed. Pub/sub restrito a este processo.")
+    return InProcessBroker()
+
+
+broker = create_broker()
@@ -0,0 +1,334 @@
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import namedtuple, deque
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import String, cast, literal, select, update
+from sqlalchemy.orm import Session
+from database import insert_on_conflict
+from models import Notification, PushDevice, PushOutbox
+
+# Push (FCM) via outbox transacional: notify_family grava, na mesma transação das
+# notificações, uma linha em push_outbox por aparelho ativo do destinatário. Uma thread
+# drena o outbox em lotes, junta as pendências de cada aparelho em um único push,
+# refaz com backoff exponencial as falhas transitórias e desativa tokens inválidos.
+# A cada PUSH_DIGEST_INTERVAL a mesma thread envia o resumo das notificações guardadas
+# para quem está em resguardo com resumo ativado (0 desativa o agendamento).
+PUSH_BATCH_SIZE = int(os.environ.get("PUSH_BATCH_SIZE", 200))
+PUSH_POLL_INTERVAL = float(os.environ.get("PUSH_POLL_INTERVAL", 2.0))
+PUSH_MAX_ATTEMPTS = int(os.environ.get("PUSH_MAX_ATTEMPTS", 6))
+PUSH_RETRY_BASE_SECONDS = float(os.environ.get("PUSH_RETRY_BASE_SECONDS", 5.0))
+# Linhas em 'sending' há mais que isso (worker caiu no meio do envio) voltam para a fila
+PUSH_LEASE_SECONDS = float(os.environ.get("PUSH_LEASE_SECONDS", 60.0))
+# fcm (padrão) ou fake (guarda em memória; testes e desenvolvimento sem credenciais)
+PUSH_SENDER = os.environ.get("PUSH_SENDER", "fcm")
+PUSH_DIGEST_INTERVAL = float(os.environ.get("PUSH_DIGEST_INTERVAL", 3 * 3600))
+
+PushMessage = namedtuple("PushMessage", "token title body data priority")
+# retryable: falha transitória (tenta de novo); invalid_token: aparelho não existe mais
+PushResult = namedtuple("PushResult", "ok error retryable invalid_token")
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class PushSender(ABC):
+    """Interface dos provedores de push: um resultado por mensagem, na mesma ordem."""
+
+    @abstractmethod
+    def send(self, messages: list) -> list:
+        ...
+
+
+class FCMSender(PushSender):
+    MAX_PER_CALL = 500  # limite do send_each
+
+    def send(self, messages: list) -> list:
+        from firebase_admin import messaging
+        results = []
+        for start in range(0, len(messages), self.MAX_PER_CALL):
+            chunk = messages[start:start + self.MAX_PER_CALL]
+            batch = messaging.send_each([
+                messaging.Message(
+                    token=message.token,
+                    notification=messaging.Notification(title=message.title, body=message.body),
+                    data={key: str(value) for key, value in message.data.items()},
+                    android=messaging.AndroidConfig(priority="high" if message.priority == "urgent" else "normal"),
+                )
+                for message in chunk
+            ])
+            for response in batch.responses:
+                if response.success:
+                    results.append(PushResult(True, None, False, False))
+                    continue
+                error = response.exception
+                invalid = isinstance(error, (messaging.UnregisteredError, messaging.SenderIdMismatchError))
+                retryable = isinstance(error, (messaging.QuotaExceededError, messaging.ThirdPartyAuthError)) or \
+                    getattr(error, "code", None) in ("UNAVAILABLE", "INTERNAL", "DEADLINE_EXCEEDED")
+                results.append(PushResult(False, str(error), retryable and not invalid, invalid))
+        return results
+
+
+class FakePushSender(PushSender):
+    """Guarda as mensagens em memória. `failures` mapeia token -> PushResult a devolver."""
+
+    def __init__(self, max_kept: int = 1000):
+        self.sent = deque(maxlen=max_kept)
+        self.failures = {}
+        self.calls = 0
+
+    def send(self, messages: list) -> list:
+        self.calls += 1
+        results = []
+        for message in messages:
+            failure = self.failures.get(message.token)
+            if failure:
+                results.append(failure)
+            else:
+                self.sent.append(message)
+                results.append(PushResult(True, None, False, False))
+        return results
+
+
+def create_sender(kind: str = PUSH_SENDER) -> PushSender:
+    if kind == "fcm":
+        import firebase_admin
+        try:
+            firebase_admin.get_app()
+            return FCMSender()
+        except ValueError:
+            pass
+        print("WARNING: Firebase não inicializado. Push em modo fake (sem envio real).")
+    return FakePushSender()
+
+
+def enqueue_for_notifications(db: Session, notification_ids: list, priority: str = "normal"):
+    """Grava no outbox um push por (notificação, aparelho ativo) em um único INSERT ... SELECT (sem commit)."""
+    if not notification_ids:
+        return
+    now = _now()
+    source = select(
+        PushDevice.id, PushDevice.user_id, Notification.id, Notification.title, Notification.content,
+        literal(priority), literal("pending"), literal(0), literal(now),
+        literal("notification:") + cast(Notification.id, String) + literal(":") + cast(PushDevice.id, String),
+        literal(now),
+    ).join(Notification, Notification.user_id == PushDevice.user_id).where(
+        Notification.id.in_(notification_ids), PushDevice.disabled_at.is_(None)
+    )
+    statement = insert_on_conflict(db, PushOutbox.__table__).from_select(
+        ["device_id", "user_id", "notification_id", "title", "body", "priority", "status", "attempts",
+         "next_attempt_at", "dedupe_key", "created_at"],
+        source,
+    ).on_conflict_do_nothing(index_elements=["dedupe_key"])
+    db.execute(statement)
+
+
+def refresh_pending(db: Session, notification_ids: list):
+    """Notificações agrupadas: os pushes que ainda não saíram passam a levar o título e o texto atuais."""
+    if not notification_ids:
+        return
+    notification = select(Notification).where(Notification.id == PushOutbox.notification_id)
+    db.execute(update(PushOutbox).where(
+        PushOutbox.notification_id.in_(notification_ids), PushOutbox.status == "pending"
+    ).values(
+        title=notification.with_only_columns(Notification.title).scalar_subquery(),
+        body=notification.with_only_columns(Notification.content).scalar_subquery(),
+    ), execution_options={"synchronize_session": False})
+
+
+def enqueue_digests(db: Session, user_ids: list = None) -> int:
+    """
+    Resumo do resguardo: um push por aparelho com as notificações guardadas (digest_pending)
+    de cada usuário, que deixam de estar pendentes. Sem commit; retorna quantos usuários.
+    """
+    query = db.query(Notification.id, Notification.user_id, Notification.title, Notification.occurrences).filter(
+        Notification.digest_pending.is_(True)
+    )
+    if user_ids is not None:
+        query = query.filter(Notification.user_id.in_(user_ids))
+    pending = {}
+    for notification_id, user_id, title, occurrences in query.order_by(Notification.id.asc()):
+        pending.setdefault(user_id, []).append((notification_id, title, occurrences or 1))
+    if not pending:
+        return 0
+
+    now = _now()
+    rows = []
+    for device_id, user_id in db.query(PushDevice.id, PushDevice.user_id).filter(
+        PushDevice.user_id.in_(pending), PushDevice.disabled_at.is_(None)
+    ):
+        items = pending[user_id]
+        total = sum(occurrences for _, _, occurrences in items)
+        last_id = items[-1][0]
+        rows.append({
+            "device_id": device_id, "user_id": user_id, "notification_id": last_id,
+            "title": f"Resumo do resguardo: {total} {'notificação' if total == 1 else 'notificações'}",
+            "body": " • ".join(title for _, title, _ in items[-3:]),
+            "priority": "low", "status": "pending", "attempts": 0, "next_attempt_at": now,
+            "dedupe_key": f"digest:{user_id}:{last_id}:{device_id}", "created_at": now,
+        })
+    if rows:
+        db.execute(insert_on_conflict(db, PushOutbox.__table__).values(rows).on_conflict_do_nothing(
+            index_elements=["dedupe_key"]
+        ))
+    db.execute(update(Notification).where(
+        Notification.id.in_([notification_id for items in pending.values() for notification_id, _, _ in items])
+    ).values(digest_pending=False), execution_options={"synchronize_session": False})
+    return len(pending)
+
+
+def _claim(session: Session, batch_size: int, max_attempts: int = PUSH_MAX_ATTEMPTS) -> list:
+    """
+    Reserva (lease) até batch_size linhas vencidas: status 'sending', prazo para voltar à fila
+    e uma tentativa a mais. Contar a tentativa já na reserva faz uma linha cujo envio sempre
+    falha antes de gravar o resultado (exceção, queda do processo) chegar a 'dead'.
+    """
+    now = _now()
+    session.execute(update(PushOutbox).where(
+        PushOutbox.status == "sending", PushOutbox.next_attempt_at <= now, PushOutbox.attempts >= max_attempts
+    ).values(status="dead", last_error="envio interrompido em todas as tentativas"))
+    ids = [row_id for (row_id,) in session.query(PushOutbox.id).filter(
+        PushOutbox.status.in_(("pending", "sending")), PushOutbox.next_attempt_at <= now
+    ).order_by(PushOutbox.id.asc()).limit(batch_size)]
+    if not ids:
+        session.commit()
+        return []
+    session.execute(update(PushOutbox).where(
+        PushOutbox.id.in_(ids), PushOutbox.status.in_(("pending", "sending")), PushOutbox.next_attempt_at <= now
+    ).values(status="sending", attempts=PushOutbox.attempts + 1,
+             next_attempt_at=now + timedelta(seconds=PUSH_LEASE_SECONDS)))
+    session.commit()
+    return session.query(PushOutbox).filter(
+        PushOutbox.id.in_(ids), PushOutbox.status == "sending"
+    ).order_by(PushOutbox.id.asc()).all()
+
+
+def coalesce(rows: list, token: str) -> list:
+    """Pendências de um aparelho -> [(PushMessage, linhas)]. Urgentes vão sozinhas; o resto vira um push só."""
+    groups = [[row] for row in rows if row.priority == "urgent"]
+    regular = [row for row in rows if row.priority != "urgent"]
+    if regular:
+        groups.append(regular)
+    messages = []
+    for group in groups:
+        if len(group) == 1:
+            row = group[0]
+            message = PushMessage(token, row.title, row.body, {"notification_id": row.notification_id}, row.priority)
+        else:
+            titles = [row.title for row in group]
+            message = PushMessage(token, f"{len(group)} novas notificações", " • ".join(titles[-3:]),
+                                  {"notification_ids": ",".join(str(row.notification_id) for row in group)}, "normal")
+        messages.append((message, group))
+    return messages
+
+
+class PushDeliveryWorker:
+    def __init__(self, sender: PushSender = None, batch_size: int = PUSH_BATCH_SIZE,
+                 interval: float = PUSH_POLL_INTERVAL, max_attempts: int = PUSH_MAX_ATTEMPTS,
+                 digest_interval: float = PUSH_DIGEST_INTERVAL):
+        self.sender = sender
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.digest_interval = digest_interval
+        self._next_digest = None
+        self._bind = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stopping = False
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, bind):
+        if self.running:
+            return
+        if self.sender is None:
+            self.sender = create_sender()
+        self._bind = bind
+        self._stopping = False
+        self._next_digest = time.monotonic() + self.digest_interval if self.digest_interval > 0 else None
+        self._thread = threading.Thread(target=self._run, name="mediare-push", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def wake(self):
+        """Chamado após o commit de novas notificações: drena sem esperar o intervalo."""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.clear()
+            try:
+                session = Session(bind=self._bind)
+                try:
+                    if self._next_digest is not None and time.monotonic() >= self._next_digest:
+                        self._next_digest = time.monotonic() + self.digest_interval
+                        if enqueue_digests(session):
+                            session.commit()
+                    while self.run_once(session) >= self.batch_size and not self._stopping:
+                        pass
+                finally:
+                    session.close()
+            except Exception as e:
+                print(f"Push Erro (worker): {e}")
+            self._wake.wait(self.interval)
+
+    def run_once(self, session: Session) -> int:
+        """Processa um lote; retorna quantas linhas do outbox foram tratadas."""
+        rows = _claim(session, self.batch_size, self.max_attempts)
+        if not rows:
+            return 0
+        devices = {device.id: device for device in session.query(PushDevice).filter(
+            PushDevice.id.in_({row.device_id for row in rows})
+        )}
+        by_device = {}
+        for row in rows:
+            by_device.setdefault(row.device_id, []).append(row)
+
+        now = _now()
+        outgoing = []
+        for device_id, device_rows in by_device.items():
+            device = devices.get(device_id)
+            if device is None or device.disabled_at is not None:
+                for row in device_rows:
+                    row.status, row.last_error = "dead", "aparelho desativado"
+                continue
+            outgoing.extend(coalesce(device_rows, device.token))
+
+        try:
+            results = self.sender.send([message for message, _ in outgoing]) if outgoing else []
+        except Exception as e:
+            # Falha da chamada inteira: o lote todo segue a regra de nova tentativa/descarte
+            print(f"Push Erro (envio de {len(outgoing)} mensagens): {e}")
+            results = [PushResult(False, str(e), True, False)] * len(outgoing)
+        for (message, group), result in zip(outgoing, results):
+            for row in group:
+                # attempts já foi incrementado em _claim
+                if result.ok:
+                    row.status, row.sent_at, row.last_error = "sent", now, None
+                elif result.invalid_token:
+                    row.status, row.last_error = "dead", result.error
+                    devices[row.device_id].disabled_at = now
+                elif result.retryable and row.attempts < self.max_attempts:
+                    delay = PUSH_RETRY_BASE_SECONDS * (2 ** (row.attempts - 1)) * random.uniform(0.8, 1.2)
+                    row.status, row.last_error = "pending", result.error
+                    row.next_attempt_at = now + timedelta(seconds=delay)
+                else:
+                    row.status, row.last_error = "dead", result.error
+        session.commit()
+        return len(rows)
+
+
+push_worker = PushDeliveryWorker()
@@ -0,0 +1,416 @@
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from models import EventLog, Expense, Report, CheckIn, CustodyEvent, Appointment, AppointmentStatusHistory
+from datetime import datetime, timezone, timedelta
+from collections import namedtuple
+from hashlib import sha256
+import json
+import tempfile
+import storage
+import audit_chain
+from report_verification import known_reports
+from event_log import describe_event
+import os
+try:
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.utils import simpleSplit
+except ImportError:
+    canvas = None
+    print("WARNING: reportlab not installed. PDF generation disabled.")
+
+
+# PDFs até este tamanho ficam só em memória; acima disso o buffer passa para disco
+REPORT_SPOOL_MAX_BYTES = int(os.environ.get("REPORT_SPOOL_MAX_BYTES", 8 * 1024 * 1024))
+
+
+# Relatórios idênticos (mesmos filtros, nenhum dado novo) são reaproveitados dentro desta janela
+REPORT_CACHE_MAX_AGE_HOURS = float(os.environ.get("REPORT_CACHE_MAX_AGE_HOURS", 24))
+# Linhas buscadas por ida ao banco ao percorrer a linha do tempo (cursor do lado do servidor)
+REPORT_FETCH_BATCH = int(os.environ.get("REPORT_FETCH_BATCH", 500))
+
+
+def _noop_progress(percent: int):
+    pass
+
+
+class HashingBuffer:
+    """Buffer de escrita (spooled) que calcula o SHA-256 à medida que os bytes chegam."""
+
+    def __init__(self, max_size: int = REPORT_SPOOL_MAX_BYTES):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self._hash = sha256()
+        self.size = 0
+
+    def write(self, data: bytes):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def seek(self, offset: int, whence: int = 0):
+        return self._file.seek(offset, whence)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def iter_chunks(self, chunk_size: int = 64 * 1024):
+        self._file.seek(0)
+        while chunk := self._file.read(chunk_size):
+            yield chunk
+
+    def close(self):
+        self._file.close()
+
+
+def normalize_filters(filters: dict) -> str:
+    """JSON canônico dos filtros: chaves ordenadas, sem valores nulos/falsos (equivalentes a ausentes)."""
+    cleaned = {k: v for k, v in filters.items() if v is not None and v is not False}
+    return json.dumps(cleaned, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def _as_utc(value: str) -> datetime:
+    # O banco guarda UTC sem fuso: datas com fuso são convertidas, as sem fuso já são UTC
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def parse_date_range(filters: dict):
+    """
+    Lê start_date/end_date (ISO 8601) dos filtros. Datas sem horário incluem o dia inteiro.
+    Retorna (início, fim_exclusivo) em UTC sem fuso, qualquer um pode ser None. Lança ValueError se inválido.
+    """
+    start = end = None
+    if filters.get("start_date"):
+        start = _as_utc(str(filters["start_date"]))
+    if filters.get("end_date"):
+        raw = str(filters["end_date"])
+        end = _as_utc(raw)
+        if len(raw) == 10:
+            end += timedelta(days=1)
+    if start and end and start >= end:
+        raise ValueError("start_date deve ser anterior a end_date")
+    return start, end
+
+
+def _in_range(query, column, start, end):
+    if start:
+        query = query.filter(column >= start)
+    if end:
+        query = query.filter(column < end)
+    return query
+
+
+# Consultas retornam apenas colunas (Row), sem objetos ORM no identity map da sessão
+def _events_query(db, family_id, start, end, filters=None):
+    query = db.query(EventLog.created_at, EventLog.event_type, EventLog.event_data).filter(EventLog.family_unit_id == family_id)
+    filters = filters or {}
+    # Filtros opcionais resolvidos pelas colunas indexadas do EventLog
+    if filters.get("child_id"):
+        query = query.filter(EventLog.child_id == int(filters["child_id"]))
+    if filters.get("event_types"):
+        query = query.filter(EventLog.event_type.in_(list(filters["event_types"])))
+    return _in_range(query, EventLog.created_at, start, end).order_by(EventLog.created_at.asc(), EventLog.id.asc())
+
+
+def _expenses_query(db, family_id, start, end, filters=None):
+    query = db.query(Expense.created_at, Expense.description, Expense.amount, Expense.status).filter(Expense.family_unit_id == family_id)
+    return _in_range(query, Expense.created_at, start, end).order_by(Expense.created_at.asc(), Expense.id.asc())
+
+
+def _checkins_query(db, family_id, start, end, filters=None):
+    query = db.query(CheckIn.timestamp, CheckIn.status, CheckIn.latitude, CheckIn.longitude, CustodyEvent.description).join(
+        CustodyEvent, CheckIn.event_id == CustodyEvent.id
+    ).filter(CustodyEvent.family_unit_id == family_id)
+    return _in_range(query, CheckIn.timestamp, start, end).order_by(CheckIn.timestamp.asc(), CheckIn.id.asc())
+
+
+def _appointments_query(db, family_id, start, end, filters=None):
+    query = db.query(Appointment.scheduled_time, Appointment.type, Appointment.description, Appointment.status).filter(Appointment.family_unit_id == family_id)
+    return _in_range(query, Appointment.scheduled_time, start, end).order_by(Appointment.scheduled_time.asc(), Appointment.id.asc())
+
+
+def _events_watermark(db, family_id):
+    return db.query(func.count(EventLog.id), func.max(EventLog.id)).filter(EventLog.family_unit_id == family_id).one()
+
+
+def _expenses_watermark(db, family_id):
+    return db.query(func.count(Expense.id), func.max(Expense.id), func.max(Expense.updated_at)).filter(Expense.family_unit_id == family_id).one()
+
+
+def _checkins_watermark(db, family_id):
+    return db.query(func.count(CheckIn.id), func.max(CheckIn.id)).join(
+        CustodyEvent, CheckIn.event_id == CustodyEvent.id
+    ).filter(CustodyEvent.family_unit_id == family_id).one()
+
+
+def _appointments_watermark(db, family_id):
+    # updated_at cobre edições da linha (descrição, horário); o histórico cobre mudanças de status
+    appointments = db.query(
+        func.count(Appointment.id), func.max(Appointment.id), func.max(Appointment.updated_at)
+    ).filter(Appointment.family_unit_id == family_id).one()
+    history = db.query(func.max(AppointmentStatusHistory.id)).join(
+        Appointment, AppointmentStatusHistory.appointment_id == Appointment.id
+    ).filter(Appointment.family_unit_id == family_id).scalar()
+    return (*appointments, history)
+
+
+ReportSection = namedtuple("ReportSection", "flag title query format_line watermark")
+
+REPORT_SECTIONS = [
+    ReportSection(
+        "include_events", "EVENTOS DE CONVIVÊNCIA E TROCAS", _events_query,
+        lambda r: f"[{r.created_at.strftime('%d/%m/%Y %H:%M')}] {r.event_type.upper()}: {describe_event(r.event_type, r.event_data)}",
+        _events_watermark
+    ),
+    ReportSection(
+        "include_checkins", "CHECK-INS DE RETIRADA E DEVOLUÇÃO", _checkins_query,
+        lambda r: f"[{r.timestamp.strftime('%d/%m/%Y %H:%M')}] {r.status.upper()} - {r.description or 'Check-in'} ({r.latitude:.5f}, {r.longitude:.5f})",
+        _checkins_watermark
+    ),
+    ReportSection(
+        "include_appointments", "COMPROMISSOS", _appointments_query,
+        lambda r: f"[{r.scheduled_time.strftime('%d/%m/%Y %H:%M')}] {r.type}: {r.description or ''} ({r.status})",
+        _appointments_watermark
+    ),
+    ReportSection(
+        "include_expenses", "DESPESAS E MOVIMENTAÇÕES FINANCEIRAS", _expenses_query,
+        lambda r: f"[{r.created_at.strftime('%d/%m/%Y')}] {r.description}: R$ {r.amount:.2f} ({r.status})",
+        _expenses_watermark
+    ),
+]
+
+
+def data_watermark(db: Session, family_id: int, filters: dict) -> list:
+    """
+    Marca d'água dos dados incluídos no relatório: contagem, maior id e última alteração
+    de cada tabela selecionada. Qualquer inserção, exclusão ou edição muda o valor.
+    """
+    watermark = [section.watermark(db, family_id) for section in REPORT_SECTIONS if filters.get(section.flag)]
+    return [[str(value) for value in row] for row in watermark]
+
+
+def report_fingerprint(db: Session, family_id: int, filters: dict, name: str, author_id: int, author_name: str) -> str:
+    # Nome do documento e autor são impressos no PDF: pedidos de outro autor ou com outro nome não reaproveitam
+    payload = json.dumps([
+        family_id, normalize_filters(filters), name, author_id, author_name,
+        data_watermark(db, family_id, filters)
+    ])
+    return sha256(payload.encode("utf-8")).hexdigest()
+
+
+def find_cached_report(db: Session, family_id: int, fingerprint: str):
+    """Report ainda válido com o mesmo fingerprint (dentro da janela e com o arquivo disponível)."""
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=REPORT_CACHE_MAX_AGE_HOURS)
+    report = db.query(Report).filter(
+        Report.family_unit_id == family_id,
+        Report.fingerprint == fingerprint,
+        Report.created_at >= cutoff
+    ).order_by(Report.created_at.desc()).first()
+    if report and (report.pdf_url.startswith("s3://") or os.path.exists(storage.local_path(report.pdf_url))):
+        return report
+    return None
+
+
+def collect_summary_sample(db: Session, family_id: int, filters: dict, start, end):
+    """Amostra limitada (mais recentes) usada apenas como contexto do sumário IA."""
+    events = []
+    if filters.get("include_events"):
+        events = _events_query(db, family_id, start, end, filters).order_by(None).order_by(EventLog.created_at.desc()).limit(100).all()
+
+    expenses = []
+    if filters.get("include_expenses"):
+        expenses = _expenses_query(db, family_id, start, end, filters).order_by(None).order_by(Expense.created_at.desc()).limit(50).all()
+
+    return events, expenses
+
+
+def generate_ai_summary(author_name: str, events, expenses):
+    try:
+        from ai_utils import gemini_client
+        context_text = f"Análise de convivência para a família {author_name}.\n"
+        context_text += "Eventos recentes:\n" + "\n".join([f"- {e.event_type}: {describe_event(e.event_type, e.event_data)[:100]}" for e in events])
+        context_text += "\nDespesas recentes:\n" + "\n".join([f"- {ex.description}: R$ {ex.amount}" for ex in expenses])
+
+        prompt = f"""
+        Você é um mediador de conflitos familiar de alto nível.
+        Analise os seguintes dados de convivência e finanças e escreva um "Sumário Executivo do Mediador" de no máximo 5 linhas.
+        O tom deve ser profissional, neutro e focado em destacar a colaboração ou pontos que precisam de atenção diplomática.
+        Este sumário será lido por um Juiz ou Mediador.
+
+        DADOS:
+        {context_text}
+        """
+        return gemini_client.generate_content(prompt)
+    except Exception as e:
+        print(f"Relatório Erro (sumário IA): {e}")
+        return "Sumário IA indisponível no momento."
+
+
+class TimelineWriter:
+    """Escreve texto com quebra de linha real e paginação automática no canvas."""
+    TOP = 800
+    BOTTOM = 60
+    LEFT = 40
+    RIGHT = 555
+
+    def __init__(self, c):
+        self.c = c
+        self.y = self.TOP
+        self.page = 1
+
+    def new_page(self):
+        self._footer()
+        self.c.showPage()
+        self.page += 1
+        self.y = self.TOP
+
+    def _footer(self):
+        self.c.setFont("Helvetica", 7)
+        self.c.setFillColorRGB(0.4, 0.4, 0.4)
+        self.c.drawRightString(self.RIGHT, 30, f"MEDIARE - página {self.page}")
+        self.c.setFillColorRGB(0, 0, 0)
+
+    def space(self, height: float):
+        self.y -= height
+
+    def text(self, text: str, font: str = "Helvetica", size: float = 8, indent: float = 0, leading: float = None, keep_with: float = 0):
+        """Quebra `text` na largura útil; `keep_with` evita título órfão no pé da página."""
+        leading = leading or size + 4
+        lines = simpleSplit(text, font, size, self.RIGHT - self.LEFT - indent) or [""]
+        if self.y - leading - keep_with < self.BOTTOM:
+            self.new_page()
+        for line in lines:
+            if self.y - leading < self.BOTTOM:
+                self.new_page()
+            self.c.setFont(font, size)
+            self.c.drawString(self.LEFT + indent, self.y, line)
+            self.y -= leading
+
+    def finish(self):
+        self._footer()
+        self.c.save()
+
+
+def render_pdf(output, db: Session, family_id: int, filters: dict, name: str, author_name: str, ai_summary: str, progress=_noop_progress):
+    """
+    Renderiza a linha do tempo completa percorrendo cada seção com yield_per: do banco só um
+    lote de linhas fica em memória por vez. O Canvas do reportlab, porém, guarda o conteúdo
+    de todas as páginas até o save(), então a memória ainda cresce com o histórico: algumas
+    centenas de bytes por linha impressa, em vez dos objetos ORM de todas as linhas.
+    """
+    start, end = parse_date_range(filters)
+    c = canvas.Canvas(output, pageCompression=1)
+    w = TimelineWriter(c)
+
+    w.text("MEDIARE - Relatório Auditado de Compliance Familiar", "Helvetica-Bold", 16, leading=20)
+    w.text(f"Nome do Documento: {name}", size=10, leading=15)
+    w.text(f"Data de Geração: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}", size=10, leading=15)
+    w.text(f"Gerado por: {author_name}", size=10, leading=15)
+    period_start = start.strftime('%d/%m/%Y') if start else "início"
+    period_end = (end - timedelta(microseconds=1)).strftime('%d/%m/%Y') if end else "hoje"
+    w.text(f"Período: {period_start} a {period_end}", size=10, leading=12)
+    c.line(w.LEFT, w.y, 550, w.y)
+    w.space(15)
+
+    if ai_summary:
+        c.setFillColorRGB(0.1, 0.4, 0.8) # Blueish for AI section
+        w.text("PARECER AUTOMÁTICO DO MEDIADOR (IA):", "Helvetica-BoldOblique", 11, leading=15)
+        c.setFillColorRGB(0, 0, 0)
+        for paragraph in ai_summary.splitlines():
+            w.text(paragraph, "Helvetica-Oblique", 10, indent=5, leading=12)
+        w.space(10)
+
+    w.text("Atividades e Registros:", "Helvetica-Bold", 12, leading=25)
+
+    sections = [section for section in REPORT_SECTIONS if filters.get(section.flag)]
+    if not sections:
+        w.text("Nenhum dado selecionado ou encontrado no período.", size=9)
+
+    for index, section in enumerate(sections):
+        w.text(section.title, "Helvetica-Bold", 10, leading=15, keep_with=24)
+        rows = 0
+        for row in section.query(db, family_id, start, end, filters).yield_per(REPORT_FETCH_BATCH):
+            w.text(section.format_line(row), size=8, indent=0, leading=11)
+            rows += 1
+        if not rows:
+            w.text("Nenhum registro no período.", "Helvetica-Oblique", 8)
+        w.space(12)
+        progress(50 + int(35 * (index + 1) / len(sections)))
+
+    if filters.get("include_events"):
+        write_integrity_section(w, db, family_id, start, end)
+
+    w.finish()
+
+
+def write_integrity_section(w, db: Session, family_id: int, start, end):
+    """Raízes Merkle dos checkpoints que cobrem os eventos do período, para conferência via /audit."""
+    first_seq, last_seq = audit_chain.seq_range(db, family_id, start, end)
+    if first_seq is None:
+        return
+    w.text("Integridade dos Registros:", "Helvetica-Bold", 10, leading=15, keep_with=24)
+    w.text(f"Eventos #{first_seq} a #{last_seq} da cadeia de auditoria da família.", size=8, leading=11)
+    covered_until = first_seq - 1
+    for checkpoint in audit_chain.checkpoints_for_range(db, family_id, first_seq, last_seq):
+        w.text(
+            f"Checkpoint #{checkpoint.start_seq}-#{checkpoint.end_seq}: raiz {checkpoint.merkle_root}",
+            "Courier", 7, leading=10
+        )
+        covered_until = checkpoint.end_seq
+    if covered_until < last_seq:
+        # Cauda ainda não selada: o hash da última entrada ancora todas as anteriores
+        w.text(
+            f"Entradas #{covered_until + 1}-#{last_seq} sem checkpoint: hash #{last_seq} {audit_chain.entry_hash_at(db, family_id, last_seq)}",
+            "Courier", 7, leading=10
+        )
+    w.space(12)
+
+
+def build_report(db: Session, family_id: int, author_name: str, name: str, filters: dict, progress=_noop_progress, author_id: int = None):
+    """
+    Coleta os dados, gera o sumário IA, renderiza o PDF e grava o Report.
+    `progress` recebe o percentual concluído (0-100) a cada etapa.
+    Retorna (report, buffer); o chamador deve fechar o buffer após usá-lo.
+    """
+    start, end = parse_date_range(filters)
+    # Calculado antes da coleta: se os dados mudarem no meio, o fingerprint fica "velho" e não gera falso acerto
+    fingerprint = report_fingerprint(db, family_id, filters, name, author_id, author_name)
+    events, expenses = collect_summary_sample(db, family_id, filters, start, end)
+    progress(30)
+
+    ai_summary = generate_ai_summary(author_name, events, expenses)
+    progress(50)
+
+    # Renderiza direto no buffer: o hash é calculado na escrita, sem reler o arquivo
+    pdf = HashingBuffer()
+    render_pdf(pdf, db, family_id, filters, name, author_name, ai_summary, progress)
+    pdf_hash = pdf.hexdigest()
+    progress(90)
+
+    # Nome derivado do conteúdo: sem colisões entre relatórios gerados no mesmo segundo
+    file_name = f"relatorio_{datetime.now().strftime('%Y%m%d')}_{pdf_hash[:16]}.pdf"
+    pdf_url = storage.save_stream("reports", file_name, pdf, "application/pdf")
+
+    # Re-save with hash footer (simplified for MVP: we just record it in DB)
+    # The real approach would be signing the PDF bytes after generation
+    report = Report(
+        name=name,
+        filters=str(filters),
+        pdf_url=pdf_url,
+        hash_sha256=pdf_hash,
+        fingerprint=fingerprint,
+        created_at=datetime.now(timezone.utc),
+        family_unit_id=family_id
+    )
+    db.add(report)
+    db.commit()
+    db.refresh(report)
+    known_reports.add(pdf_hash)
+    return report, pdf
@@ -0,0 +1,218 @@
+import json
+import uuid
+import traceback
+from concurrent.futures import as_completed
+from datetime import datetime, timezone
+from sqlalchemy.orm import Session
+from models import ReportJob, User
+from report_builder import build_report, report_fingerprint, find_cached_report
+from batch_reports import render_family_report, build_manifest
+from workers import submit_job, get_process_pool
+
+# Fila de geração de relatórios. O estado de cada job fica na tabela report_jobs,
+# então qualquer worker da API consegue responder ao polling do cliente.
+
+
+def enqueue_report(db: Session, user: User, name: str, filters: dict, fingerprint: str = None) -> ReportJob:
+    # Pedido idêntico já em andamento: reaproveita o job em vez de renderizar duas vezes
+    if fingerprint:
+        pending = db.query(ReportJob).filter(
+            ReportJob.family_unit_id == user.family_unit_id,
+            ReportJob.fingerprint == fingerprint,
+            ReportJob.status.in_(["queued", "running"])
+        ).first()
+        if pending:
+            return pending
+
+    job = ReportJob(
+        id=uuid.uuid4().hex,
+        name=name,
+        filters=json.dumps(filters, ensure_ascii=False),
+        fingerprint=fingerprint,
+        status="queued",
+        progress=0,
+        family_unit_id=user.family_unit_id,
+        user_id=user.id,
+        created_at=datetime.now(timezone.utc)
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+
+    # O worker abre sua própria sessão no mesmo banco da requisição
+    submit_job(run_report_job, db.get_bind(), job.id)
+    return job
+
+
+def run_report_job(bind, job_id: str):
+    db = Session(bind=bind)
+    try:
+        job = db.query(ReportJob).filter(ReportJob.id == job_id).first()
+        if not job or job.status != "queued":
+            return
+        job.status = "running"
+        job.progress = 10
+        job.started_at = datetime.now(timezone.utc)
+        db.commit()
+
+        def progress(percent: int):
+            job.progress = percent
+            db.commit()
+
+        author = db.query(User).filter(User.id == job.user_id).first()
+        report, pdf = build_report(
+            db,
+            job.family_unit_id,
+            author.full_name if author else "MEDIARE",
+            job.name,
+            json.loads(job.filters),
+            progress=progress,
+            author_id=job.user_id
+        )
+        pdf.close()
+
+        job.report_id = report.id
+        job.status = "completed"
+        job.progress = 100
+        job.finished_at = datetime.now(timezone.utc)
+        db.commit()
+    except Exception as e:
+        print(f"ReportJob Erro ({job_id}): {e}")
+        traceback.print_exc()
+        db.rollback()
+        job = db.query(ReportJob).filter(ReportJob.id == job_id).first()
+        if job:
+            job.status = "failed"
+            job.error = str(e)
+            job.finished_at = datetime.now(timezone.utc)
+            db.commit()
+    finally:
+        db.close()
+
+
+def enqueue_batch(db: Session, user: User, name: str, filters: dict, family_ids: list) -> str:
+    """
+    Um job por família, todos com o mesmo batch_id. Famílias com relatório idêntico em cache
+    já nascem concluídas; as demais são renderizadas juntas por run_batch. Retorna o batch_id.
+    """
+    batch_id = uuid.uuid4().hex
+    now = datetime.now(timezone.utc)
+    queued = False
+    for family_id in family_ids:
+        fingerprint = report_fingerprint(db, family_id, filters, name, user.id, user.full_name)
+        cached = find_cached_report(db, family_id, fingerprint)
+        db.add(ReportJob(
+            id=uuid.uuid4().hex,
+            batch_id=batch_id,
+            name=name,
+            filters=json.dumps(filters, ensure_ascii=False),
+            fingerprint=fingerprint,
+            status="completed" if cached else "queued",
+            progress=100 if cached else 0,
+            report_id=cached.id if cached else None,
+            family_unit_id=family_id,
+            user_id=user.id,
+            created_at=now,
+            finished_at=now if cached else None
+        ))
+        queued = queued or not cached
+    db.commit()
+    if queued:
+        submit_job(run_batch, db.get_bind(), batch_id)
+    return batch_id
+
+
+def run_batch(bind, batch_id: str):
+    """Renderiza as famílias do lote em paralelo no pool de processos e grava cada resultado ao chegar."""
+    db = Session(bind=bind)
+    try:
+        jobs = db.query(ReportJob).filter(ReportJob.batch_id == batch_id, ReportJob.status == "queued").all()
+        if not jobs:
+            return
+        author = db.query(User).filter(User.id == jobs[0].user_id).first()
+        author_name = author.full_name if author else "MEDIARE"
+        for job in jobs:
+            job.status = "running"
+            job.progress = 10
+            job.started_at = datetime.now(timezone.utc)
+        db.commit()
+
+        # Cada processo abre sua própria conexão no mesmo banco
+        database_url = bind.url.render_as_string(hide_password=False)
+        futures = {
+            get_process_pool().submit(
+                render_family_report, database_url, job.family_unit_id, author_name, job.name,
+                json.loads(job.filters), job.user_id
+            ): job
+            for job in jobs
+        }
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                entry = {"status": "failed", "error": str(e)}
+            if entry["status"] == "completed":
+                job.report_id = entry["report_id"]
+                job.status = "completed"
+                job.progress = 100
+            else:
+                job.status = "failed"
+                job.error = entry.get("error")
+            job.finished_at = datetime.now(timezone.utc)
+            db.commit()
+    except Exception as e:
+        print(f"ReportBatch Erro ({batch_id}): {e}")
+        traceback.print_exc()
+        db.rollback()
+        db.query(ReportJob).filter(
+            ReportJob.batch_id == batch_id, ReportJob.status.in_(["queued", "running"])
+        ).update({"status": "failed", "error": str(e), "finished_at": datetime.now(timezone.utc)},
+                 synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def batch_manifest(jobs: list, filters: dict) -> dict:
+    """Manifesto do lote (mesmo formato da CLI) com id e hash de cada relatório concluído."""
+    entries = []
+    for job in jobs:
+        entry = {"family_id": job.family_unit_id, "job_id": job.id, "status": job.status}
+        if job.status == "failed":
+            entry["error"] = job.error
+        if job.report:
+            entry.update({"report_id": job.report.id, "hash": job.report.hash_sha256, "url": job.report.pdf_url})
+        entries.append(entry)
+    manifest = build_manifest(entries, filters)
+    manifest["pending"] = sum(1 for job in jobs if job.status in ("queued", "running"))
+    return manifest
+
+
+def serialize_cached_report(report) -> dict:
+    """Mesmo formato de um job concluído, para o cliente tratar os dois casos igual."""
+    return {
+        "message": "Report served from cache",
+        "status": "completed",
+        "progress": 100,
+        "cached": True,
+        "report_id": report.id,
+        "hash": report.hash_sha256,
+        "url": report.pdf_url,
+    }
+
+
+def serialize_job(job: ReportJob) -> dict:
+    data = {
+        "job_id": job.id,
+        "name": job.name,
+        "status": job.status,
+        "progress": job.progress,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+    }
+    if job.status == "failed":
+        data["error"] = job.error
+    if job.report:
+        data.update({"report_id": job.report.id, "hash": job.report.hash_sha256, "url": job.report.pdf_url})
+    return data
@@ -0,0 +1,161 @@
+import os
+import math
+import ipaddress
+import time
+import threading
+from hashlib import sha256
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from models import Report
+
+# Verificação pública de autenticidade dos PDFs emitidos (ex: tribunais).
+# Um Bloom filter em memória descarta hashes desconhecidos sem ir ao banco;
+# os candidatos são confirmados pelo índice de reports.hash_sha256.
+REPORT_BLOOM_ERROR_RATE = float(os.environ.get("REPORT_BLOOM_ERROR_RATE", 0.001))
+# Um "não" do filtro só é definitivo se ele foi sincronizado há menos que isso (relatórios de outros workers)
+REPORT_BLOOM_REFRESH_SECONDS = float(os.environ.get("REPORT_BLOOM_REFRESH_SECONDS", 5))
+REPORT_VERIFY_RATE_LIMIT = int(os.environ.get("REPORT_VERIFY_RATE_LIMIT", 30))
+REPORT_VERIFY_RATE_WINDOW = float(os.environ.get("REPORT_VERIFY_RATE_WINDOW", 60))
+# Proxies reversos confiáveis (IPs ou redes CIDR, separados por vírgula). Só deles o X-Forwarded-For vale
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(network.strip(), strict=False)
+    for network in os.environ.get("TRUSTED_PROXIES", "").split(",") if network.strip()
+]
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = REPORT_BLOOM_ERROR_RATE):
+        self.capacity = max(capacity, 1024)
+        self.size = int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        # Double hashing (Kirsch-Mitzenmacher): k posições a partir de um único digest
+        digest = sha256(key.encode("utf-8")).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class ReportHashIndex:
+    """Bloom filter dos hashes emitidos, carregado sob demanda e atualizado de forma incremental."""
+
+    def __init__(self):
+        self._bloom = None
+        self._last_id = 0
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self, db: Session):
+        with self._lock:
+            if self._bloom is None or self._bloom.count >= self._bloom.capacity:
+                total = db.query(func.count(Report.id)).scalar() or 0
+                self._bloom = BloomFilter(total * 2)
+                self._last_id = 0
+            for report_id, report_hash in db.query(Report.id, Report.hash_sha256).filter(
+                Report.id > self._last_id
+            ).order_by(Report.id.asc()).yield_per(5000):
+                self._bloom.add(report_hash)
+                self._last_id = report_id
+            self._refreshed_at = time.monotonic()
+
+    def add(self, report_hash: str):
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(report_hash)
+
+    def reset(self):
+        with self._lock:
+            self._bloom = None
+            self._last_id = 0
+
+    def might_exist(self, db: Session, report_hash: str) -> bool:
+        if self._bloom is None:
+            self.refresh(db)
+        if report_hash in self._bloom:
+            return True
+        if time.monotonic() - self._refreshed_at >= REPORT_BLOOM_REFRESH_SECONDS:
+            self.refresh(db)
+            return report_hash in self._bloom
+        return False
+
+
+class RateLimiter:
+    """Janela fixa por chave (IP). Retorna 0 se permitido ou os segundos até liberar."""
+
+    def __init__(self, limit: int, window_seconds: float):
+        self.limit = limit
+        self.window = window_seconds
+        self._hits = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key: str) -> float:
+        now = time.monotonic()
+        with self._lock:
+            if len(self._hits) > 10000:
+                self._hits = {k: v for k, v in self._hits.items() if now - v[0] < self.window}
+            window_start, count = self._hits.get(key, (now, 0))
+            if now - window_start >= self.window:
+                window_start, count = now, 0
+            if count >= self.limit:
+                return self.window - (now - window_start)
+            self._hits[key] = (window_start, count + 1)
+            return 0
+
+    def reset(self):
+        with self._lock:
+            self._hits.clear()
+
+
+known_reports = ReportHashIndex()
+verify_limiter = RateLimiter(REPORT_VERIFY_RATE_LIMIT, REPORT_VERIFY_RATE_WINDOW)
+
+
+def _is_trusted(address: str, proxies: list) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in proxies)
+
+
+def client_ip(peer: str, forwarded_for: str = None, proxies: list = None) -> str:
+    """
+    IP do cliente para o rate limit. O X-Forwarded-For só é lido se a conexão vier de um
+    proxy confiável; a lista é percorrida da direita para a esquerda até o primeiro endereço
+    que não é proxy (os da esquerda podem ter sido forjados pelo cliente).
+    """
+    proxies = TRUSTED_PROXIES if proxies is None else proxies
+    if not forwarded_for or not _is_trusted(peer, proxies):
+        return peer
+    hops = [address.strip() for address in forwarded_for.split(",") if address.strip()]
+    for address in reversed(hops):
+        if not _is_trusted(address, proxies):
+            return address
+    return hops[0] if hops else peer
+
+
+def is_sha256(value: str) -> bool:
+    return len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+def verify_report_hash(db: Session, report_hash: str) -> dict:
+    report_hash = report_hash.lower()
+    result = {"hash": report_hash, "valid": False}
+    if not known_reports.might_exist(db, report_hash):
+        return result
+    report = db.query(Report.id, Report.created_at).filter(Report.hash_sha256 == report_hash).first()
+    if report:
+        # Resposta pública: só confirma a emissão, sem expor dados da família
+        result.update({"valid": True, "report_id": report.id, "issued_at": report.created_at})
+    return result
@@ -1,11 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from routers.auth import verify_token
 from database import get_db
-from models import EventLog, FamilyUnit, Agreement
+from models import FamilyUnit, Agreement, Child
+from event_log import log_event
 from datetime import datetime, timezone
-from ai_utils import gemini_client
+from ai_utils import gemini_client, cancel_on_disconnect, ClientDisconnected
 
 router = APIRouter()
 
@@ -14,10 +16,27 @@ class AgreementRequest(BaseModel):
     child_name: str
     family_unit_id: int
 
+def _family_mode(db: Session, family_unit_id: int) -> str:
+    family = db.query(FamilyUnit).filter(FamilyUnit.id == family_unit_id).first()
+    return family.mode if family else "Colaborativo"
+
+def _record_suggestion(db: Session, request: AgreementRequest, suggestion: str, user_id: int):
+    child = db.query(Child.id).filter(
+        Child.family_id == request.family_unit_id,
+        Child.name == request.child_name
+    ).first()
+    log_event(db, 'ai_agreement_suggested', request.family_unit_id, {
+        'conflict': request.conflict_context,
+        'suggestion': suggestion,
+        'child_id': child.id if child else None,
+        'actor_user_id': user_id,
+    })
+    db.commit()
+
 @router.post("/agreements/suggest")
-def suggest_agreement(request: AgreementRequest, db: Session = Depends(get_db), user = Depends(verify_token)):
-    family = db.query(FamilyUnit).filter(FamilyUnit.id == request.family_unit_id).first()
-    mode = family.mode if family else "Colaborativo"
+async def suggest_agreement(request: AgreementRequest, http_request: Request, db: Session = Depends(get_db), user = Depends(verify_token)):
+    # Consultas e gravação no threadpool: o event loop só aguarda a IA
+    mode = await run_in_threadpool(_family_mode, db, request.family_unit_id)
     
     if mode.lower() == "unilateral":
         role_desc = "Você é um assistente jurídico registrando uma decisão unilateral de um genitor."
@@ -37,23 +56,20 @@ def suggest_agreement(request: AgreementRequest, db: Session = Depends(get_db),
     """
     
     try:
-        suggestion = gemini_client.generate_content(prompt)
+        suggestion = await cancel_on_disconnect(
+            http_request, gemini_client.generate_content_async(prompt, family_id=request.family_unit_id)
+        )
         
         if not suggestion:
             # Mock implementation for internal dev or if AI fails
             suggestion = f"Sugestão Global: Priorizem a rotina de {request.child_name}. \n\nAções:\n1. Estabelecer horários fixos.\n2. Comunicar mudanças com 24h de antecedência.\n3. Usar o calendário compartilhado para registros."
             
         # Log this generation as an event
-        new_event = EventLog(
-            event_type='ai_agreement_suggested',
-            event_data=str({'conflict': request.conflict_context, 'suggestion': suggestion}),
-            family_unit_id=request.family_unit_id,
-            created_at=datetime.now(timezone.utc)
-        )
-        db.add(new_event)
-        db.commit()
+        await run_in_threadpool(_record_suggestion, db, request, suggestion, user.id)
         
         return {"suggestion": suggestion, "status": "success"}
+    except ClientDisconnected:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao processar IA: {str(e)}")
 
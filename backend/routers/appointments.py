@@ -39,7 +39,7 @@ def create_appointment(request: AppointmentRequest, db: Session = Depends(get_db
         db, user.id, request.family_unit_id, 
         "Novo Compromisso", 
         f"Foi agendado: {request.type} - {request.description}",
-        "info"
+        "info", group_key="appointment_created", digest_title="{count} novos compromissos"
     )
     
     return {"message": "Appointment created successfully", "appointment_id": appointment.id}
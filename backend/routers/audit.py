@@ -0,0 +1,47 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from .auth import verify_token
+from database import get_db
+from models import EventLog, EventLogCheckpoint
+from report_builder import parse_date_range
+from typing import Optional
+import audit_chain
+
+router = APIRouter(prefix="/audit", tags=["Audit"])
+
+
+@router.get("/verify")
+def verify_event_log(start_date: Optional[str] = None, end_date: Optional[str] = None, db: Session = Depends(get_db), user = Depends(verify_token)):
+    """Confere a cadeia de eventos da família no período (só os blocos envolvidos são rehashados)."""
+    try:
+        start, end = parse_date_range({"start_date": start_date, "end_date": end_date})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid date range: {e}")
+    return audit_chain.verify_range(db, user.family_unit_id, start, end)
+
+
+@router.get("/checkpoints")
+def list_checkpoints(db: Session = Depends(get_db), user = Depends(verify_token)):
+    checkpoints = db.query(EventLogCheckpoint).filter(
+        EventLogCheckpoint.family_unit_id == user.family_unit_id
+    ).order_by(EventLogCheckpoint.start_seq.desc()).limit(50).all()
+    return [audit_chain.serialize_checkpoint(c) for c in checkpoints]
+
+
+@router.post("/checkpoints", status_code=201)
+def seal_checkpoint(db: Session = Depends(get_db), user = Depends(verify_token)):
+    checkpoint = audit_chain.seal_checkpoint(db, user.family_unit_id)
+    if not checkpoint:
+        raise HTTPException(status_code=409, detail="No new events since the last checkpoint")
+    return audit_chain.serialize_checkpoint(checkpoint)
+
+
+@router.get("/events/{event_id}/proof")
+def event_proof(event_id: int, db: Session = Depends(get_db), user = Depends(verify_token)):
+    entry = db.query(EventLog).filter(
+        EventLog.id == event_id,
+        EventLog.family_unit_id == user.family_unit_id
+    ).first()
+    if not entry or entry.entry_hash is None:
+        raise HTTPException(status_code=404, detail="Event not found")
+    return audit_chain.proof_for_entry(db, entry)
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, WebSocket, WebSocketException, status
 from sqlalchemy.orm import Session
 from firebase_admin import auth, initialize_app, credentials
 from jose import JWTError
@@ -36,8 +36,8 @@ def verify_firebase_token(token: str) -> dict:
             detail="Não foi possível validar as credenciais do Firebase."
         )
 
-def get_current_user(cred: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
-    token_data = verify_firebase_token(cred.credentials)
+def user_from_token(token: str, db: Session):
+    token_data = verify_firebase_token(token)
     user_email = token_data.get("email")
     if not user_email:
         raise HTTPException(status_code=401, detail="Token inválido (sem email)")
@@ -50,6 +50,24 @@ def get_current_user(cred: HTTPAuthorizationCredentials = Depends(security), db:
         )
     return user
 
+def get_current_user(cred: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+    return user_from_token(cred.credentials, db)
+
+def get_websocket_user(websocket: WebSocket, token: str = Query(None), db: Session = Depends(get_db)):
+    """
+    Autenticação de WebSockets: navegadores não enviam o header Authorization no
+    handshake, então o token também é aceito em ?token=.
+    """
+    if not token:
+        authorization = websocket.headers.get("authorization", "")
+        token = authorization[7:] if authorization.lower().startswith("bearer ") else None
+    if not token:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
+    try:
+        return user_from_token(token, db)
+    except HTTPException:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
+
 # Alias logging for backward compatibility if needed, or just replace usage
 verify_token = get_current_user
 
@@ -1,11 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from routers.auth import verify_token, check_family_access
 from database import get_db
-from models import Budget, BudgetAnalysis, BudgetNegotiation, FamilyMember
-from routers.notifications import create_internal_notification
-from ai_utils import gemini_client
+from models import Budget, BudgetAnalysis, BudgetNegotiation
+import notifier
+from ai_utils import gemini_client, cancel_on_disconnect, AI_CACHE_TTL
 import os
 from datetime import datetime, timezone
 from typing import Optional
@@ -14,14 +15,29 @@ router = APIRouter()
 
 # AI Configuration (Gemini) removed - using ai_utils
 
-@router.post("/budgets/{budget_id}/analyze")
-def analyze_budget(budget_id: int, db: Session = Depends(get_db), user = Depends(verify_token)):
+def _load_budget(db: Session, budget_id: int, user_id: int):
     budget = db.query(Budget).filter(Budget.id == budget_id).first()
     if not budget:
         raise HTTPException(status_code=404, detail="Budget not found")
     
     # Security check: Does user belong to family of this budget?
-    check_family_access(db, user.id, budget.family_unit_id)
+    check_family_access(db, user_id, budget.family_unit_id)
+    return budget
+
+def _save_analysis(db: Session, budget_id: int, analysis_text: str, recommendation: str):
+    new_analysis = BudgetAnalysis(
+        budget_id=budget_id,
+        analysis_text=analysis_text,
+        suggested_action=recommendation,
+        created_at=datetime.now(timezone.utc)
+    )
+    db.add(new_analysis)
+    db.commit()
+
+@router.post("/budgets/{budget_id}/analyze")
+async def analyze_budget(budget_id: int, http_request: Request, db: Session = Depends(get_db), user = Depends(verify_token)):
+    # Consultas e commits no threadpool: o event loop só aguarda a IA
+    budget = await run_in_threadpool(_load_budget, db, budget_id, user.id)
 
     prompt = f"""
     Analise este orçamento familiar e dê uma recomendação neutra e justa:
@@ -31,7 +47,11 @@ def analyze_budget(budget_id: int, db: Session = Depends(get_db), user = Depends
     Responda em formato JSON com 'analysis' (texto curto) e 'recommendation' (approve, negotiate, reject).
     """
 
-    new_analysis_data = gemini_client.analyze_json(prompt)
+    new_analysis_data = await cancel_on_disconnect(
+        http_request, gemini_client.analyze_json_async(
+            prompt, family_id=budget.family_unit_id, cache_ttl=AI_CACHE_TTL["budget_analysis"]
+        )
+    )
     
     if new_analysis_data:
         analysis_text = new_analysis_data.get("analysis", "Análise processada.")
@@ -40,14 +60,7 @@ def analyze_budget(budget_id: int, db: Session = Depends(get_db), user = Depends
         analysis_text = "Análise simulada: O valor parece estar dentro da média de mercado."
         recommendation = "approve"
 
-    new_analysis = BudgetAnalysis(
-        budget_id=budget_id,
-        analysis_text=analysis_text,
-        suggested_action=recommendation,
-        created_at=datetime.now(timezone.utc)
-    )
-    db.add(new_analysis)
-    db.commit()
+    await run_in_threadpool(_save_analysis, db, budget_id, analysis_text, recommendation)
 
     return {"analysis": analysis_text, "recommendation": recommendation}
 
@@ -70,23 +83,17 @@ def create_budget(request: BudgetRequest, db: Session = Depends(get_db), user =
         created_at=datetime.now(timezone.utc)
     )
     db.add(budget)
+    # Notificar o outro genitor (mesma transação do orçamento)
+    notifier.notify_family(
+        db, request.family_unit_id,
+        "Novo Orçamento Sugerido",
+        f"Um novo orçamento '{request.description}' no valor de R$ {request.estimated_value:.2f} foi proposto.",
+        "info", audience="other_parents", actor_id=user.id,
+        group_key="budget_created", digest_title="{count} novos orçamentos sugeridos"
+    )
     db.commit()
     db.refresh(budget)
 
-    # Notificar o outro genitor
-    other_member = db.query(FamilyMember).filter(
-        FamilyMember.family_id == request.family_unit_id,
-        FamilyMember.user_id != user.id
-    ).first()
-    
-    if other_member:
-        create_internal_notification(
-            db, other_member.user_id, request.family_unit_id,
-            "Novo Orçamento Sugerido",
-            f"Um novo orçamento '{request.description}' no valor de R$ {request.estimated_value:.2f} foi proposto.",
-            "info"
-        )
-
     return {"message": "Budget created successfully", "budget_id": budget.id}
 
 class BudgetStatusRequest(BaseModel):
@@ -102,21 +109,15 @@ def update_budget_status(budget_id: int, request: BudgetStatusRequest, db: Sessi
     check_family_access(db, user.id, budget.family_unit_id)
     
     budget.status = request.status
-    db.commit()
-
     # Notificar interessados
-    other_member = db.query(FamilyMember).filter(
-        FamilyMember.family_id == budget.family_unit_id,
-        FamilyMember.user_id != user.id
-    ).first()
-    
-    if other_member:
-        create_internal_notification(
-            db, other_member.user_id, budget.family_unit_id,
-            "Status de Orçamento Atualizado",
-            f"O orçamento '{budget.description}' foi marcado como {request.status}.",
-            "warning" if request.status in ['rejected', 'canceled'] else "success"
-        )
+    notifier.notify_family(
+        db, budget.family_unit_id,
+        "Status de Orçamento Atualizado",
+        f"O orçamento '{budget.description}' foi marcado como {request.status}.",
+        "warning" if request.status in ['rejected', 'canceled'] else "success",
+        audience="other_parents", actor_id=user.id, group_key=f"budget:{budget.id}:status"
+    )
+    db.commit()
 
     return {"message": "Budget status updated successfully", "budget_id": budget.id, "status": budget.status}
 
@@ -142,21 +143,15 @@ def negotiate_budget(budget_id: int, request: NegotiationRequest, db: Session =
     )
     db.add(negotiation)
     budget.status = 'negotiating'
-    db.commit()
-
     # Notificar o proponente
-    other_member = db.query(FamilyMember).filter(
-        FamilyMember.family_id == budget.family_unit_id,
-        FamilyMember.user_id != user.id
-    ).first()
-    
-    if other_member:
-        create_internal_notification(
-            db, other_member.user_id, budget.family_unit_id,
-            "Contra-proposta de Orçamento",
-            f"Recebida contra-proposta para '{budget.description}': {request.comment}",
-            "info"
-        )
+    notifier.notify_family(
+        db, budget.family_unit_id,
+        "Contra-proposta de Orçamento",
+        f"Recebida contra-proposta para '{budget.description}': {request.comment}",
+        "info", audience="other_parents", actor_id=user.id,
+        group_key=f"budget:{budget.id}:negotiation", digest_title="{count} contrapropostas para '" + budget.description + "'"
+    )
+    db.commit()
 
     return {"message": "Negotiation recorded"}
 
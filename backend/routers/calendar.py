@@ -4,7 +4,8 @@ from pydantic import BaseModel
 from typing import Optional
 from .auth import verify_token, check_family_access
 from database import get_db
-from models import CustodyCalendarRule, CustodyEvent, CheckIn, Child
+from models import CustodyCalendarRule, CustodyEvent, CheckIn, Child, LocationUsageHistory
+from write_buffer import write_buffer
 from datetime import datetime, timedelta, timezone
 
 router = APIRouter()
@@ -147,13 +148,21 @@ def create_checkin(request: CheckInRequest, db: Session = Depends(get_db), user
     if not event:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Event not found")
 
-    checkin = CheckIn(
+    now = datetime.now(timezone.utc)
+    # Check-in é prova: só responde depois de gravado; o histórico de uso pode ir pelo buffer
+    db.add(CheckIn(
         event_id=request.event_id,
-        timestamp=datetime.now(timezone.utc),
+        timestamp=now,
         latitude=request.latitude,
         longitude=request.longitude,
-        status=request.status
-    )
-    db.add(checkin)
+        status=request.status,
+    ))
     db.commit()
+    if event.location_id:
+        write_buffer.append(db, LocationUsageHistory, {
+            "location_id": event.location_id,
+            "timestamp": now,
+            "event_type": "check-in",
+            "family_unit_id": event.family_unit_id,
+        })
     return {"message": "Check-in created successfully"}
\ No newline at end of file
@@ -1,13 +1,25 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Form, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, BackgroundTasks, WebSocket, WebSocketDisconnect, status, Form, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import or_, func
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
-from .auth import verify_token, check_family_access
-from database import get_db
-from models import FamilyChat, ChatMessage, ChatMessageRead
+from .auth import verify_token, get_websocket_user, check_family_access
+from database import get_db, insert_on_conflict
+from models import FamilyChat, ChatMessage, ChatReadWatermark
+import moderation
+import pubsub
+import inbox_summary
+from inbox_summary import HIDDEN_STATUSES
+from event_log import log_event
+from workers import run_in_process
 from datetime import datetime, timezone
+from pathlib import Path
+import audio_utils
 import json
+import asyncio
 import random # For mock scores if OpenAI key is missing
 import os
+import tempfile
 
 router = APIRouter()
 
@@ -18,25 +30,10 @@ class ChatMessageRequest(BaseModel):
     chat_id: int
     content: str
 
-@router.post("/chats/messages/audio")
-async def send_audio_message(
-    chat_id: int = Form(...),
-    file: UploadFile = File(...),
-    db: Session = Depends(get_db),
-    user = Depends(verify_token)
-):
-    """Envia uma mensagem de áudio com moderação automática via IA."""
-    # Security Check
-    chat = db.query(FamilyChat).filter(FamilyChat.id == chat_id).first()
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    check_family_access(db, user.id, chat.family_unit_id)
-    
-    from ai_utils import gemini_client
-    
-    audio_content = await file.read()
-    
-    prompt = """
+AUDIO_MAX_BYTES = int(os.environ.get("AUDIO_MAX_BYTES", 25 * 1024 * 1024))
+AUDIO_UPLOAD_CHUNK = 64 * 1024
+
+AUDIO_PROMPT = """
     Você é um moderador de chat familiar e transcritor inteligente.
     Analise o áudio anexado. Sua missão é:
     1. Transcrever o áudio fielmente.
@@ -45,110 +42,293 @@ async def send_audio_message(
     Retorne APENAS um JSON (sem markdown) com os campos:
     - transcription: str (o texto falado)
     - toxicity_score: float (0.0 a 1.0)
+    - sentiment_score: float (-1.0 negativo a 1.0 positivo)
     - status: str ("allowed", "blocked")
     - reason: str (breve explicação se bloqueado)
     """
+
+async def _spool_upload(file: UploadFile) -> str:
+    """Grava o upload em disco em blocos, sem carregá-lo inteiro na memória. Retorna o caminho."""
+    handle = tempfile.NamedTemporaryFile(prefix="mediare-audio-", suffix=os.path.splitext(file.filename or "")[1], delete=False)
+    size = 0
+    try:
+        with handle:
+            while chunk := await file.read(AUDIO_UPLOAD_CHUNK):
+                size += len(chunk)
+                if size > AUDIO_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="Áudio muito longo.")
+                handle.write(chunk)
+    except BaseException:
+        os.unlink(handle.name)
+        raise
+    return handle.name
+
+async def analyze_voice_note(path: str, mime_type: str, family_id: int):
+    """Transcreve e modera os segmentos em paralelo e junta o resultado (None em caso de falha)."""
+    from ai_utils import gemini_client
+
+    segments = await run_in_process(audio_utils.transcode_segments, path) if audio_utils.FFMPEG else None
+    if segments:
+        mime_type = audio_utils.AUDIO_MIME_TYPE
+    else:
+        # Sem ffmpeg (ou arquivo que ele não entende): envia o original em uma chamada só
+        segments = [await asyncio.to_thread(Path(path).read_bytes)]
+    total = len(segments)
+    prompts = [
+        AUDIO_PROMPT if total == 1 else
+        AUDIO_PROMPT + f"\n    Este é o trecho {index + 1} de {total} de uma nota de voz: transcreva apenas este trecho.\n"
+        for index in range(total)
+    ]
+    analyses = await asyncio.gather(*[
+        gemini_client.analyze_audio_async(prompt, segment, mime_type=mime_type, family_id=family_id)
+        for prompt, segment in zip(prompts, segments)
+    ])
+    merged = audio_utils.merge_segment_analyses(analyses)
+    if merged and (merged["status"] == "escalate" or (total > 1 and merged["status"] == "allowed")):
+        await _moderate_transcription(merged, family_id)
+    return merged
+
+async def _moderate_transcription(merged: dict, family_id: int):
+    """
+    Segunda passada sobre a transcrição completa: cada trecho foi moderado sem contexto e
+    uma frase cortada na fronteira dos segmentos passaria. Mesmo fluxo das mensagens de texto;
+    trecho sem veredito válido da IA (status "escalate") sempre vai para a análise do texto.
+    """
+    verdict = moderation.classify(merged["transcription"])
+    if verdict.decision == "escalate" or (merged["status"] == "escalate" and verdict.decision == "allowed"):
+        try:
+            analysis = await moderation.moderation_batcher.analyze(merged["transcription"], family_id=family_id)
+        except Exception as e:
+            print(f"Moderação Erro (nota de voz): {e}")
+            analysis = None
+        if analysis:
+            status = "blocked" if analysis.get("status") == "blocked" else "allowed"
+            toxicity, reason = float(analysis.get("toxicity_score") or 0.0), analysis.get("reason")
+        else:
+            verdict = moderation.fallback(verdict)
+            status, toxicity, reason = verdict.decision, verdict.toxicity_score, verdict.reason
+    else:
+        status, toxicity, reason = verdict.decision, verdict.toxicity_score, verdict.reason
+    merged["toxicity_score"] = max(merged["toxicity_score"], toxicity)
+    merged["status"] = status
+    if status == "blocked":
+        merged["reason"] = reason
+
+@router.post("/chats/messages/audio")
+async def send_audio_message(
+    http_request: Request,
+    chat_id: int = Form(...),
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    user = Depends(verify_token)
+):
+    """Envia uma mensagem de áudio com moderação automática via IA."""
+    from ai_utils import cancel_on_disconnect
+    # Consultas e commits no threadpool: o event loop só aguarda o upload e a IA
+    chat = await run_in_threadpool(_member_chat, db, chat_id, user.id)
     
-    analysis = gemini_client.analyze_audio(prompt, audio_content, mime_type=file.content_type)
+    path = await _spool_upload(file)
+    try:
+        analysis = await cancel_on_disconnect(http_request, analyze_voice_note(
+            path, file.content_type or "audio/mpeg", chat.family_unit_id
+        ))
+    finally:
+        os.unlink(path)
     
     if not analysis or analysis.get("status") == "blocked":
         reason = analysis.get("reason", "Conteúdo inadequado detectado no áudio.") if analysis else "Erro ao processar áudio."
         raise HTTPException(status_code=400, detail=f"Áudio bloqueado. Motivo: {reason}")
         
     transcription = analysis.get("transcription", "")
+    message = await run_in_threadpool(_save_audio_message, db, chat_id, user.id, transcription, analysis)
     
+    return {"message": "Audio sent successfully", "transcription": transcription, "message_id": message.id}
+
+def _member_chat(db: Session, chat_id: int, user_id: int) -> FamilyChat:
+    # Security Check
+    chat = db.query(FamilyChat).filter(FamilyChat.id == chat_id).first()
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    check_family_access(db, user_id, chat.family_unit_id)
+    return chat
+
+def _save_audio_message(db: Session, chat_id: int, user_id: int, transcription: str, analysis: dict) -> ChatMessage:
     # Save as message (using transcription as content for now, plus an indicator that it was audio)
     message = ChatMessage(
         chat_id=chat_id,
-        sender_id=user.id,
+        sender_id=user_id,
         content=f"[Áudio: {transcription}]", 
         toxicity_score=analysis.get("toxicity_score", 0.0),
+        sentiment_score=analysis.get("sentiment_score", 0.0),
         moderation_status="allowed",
         created_at=datetime.now(timezone.utc)
     )
     db.add(message)
+    db.flush()
+    inbox_summary.message_created(db, message)
     db.commit()
     db.refresh(message)
-    
-    return {"message": "Audio sent successfully", "transcription": transcription, "message_id": message.id}
+    _publish_message("message.created", message)
+    return message
+
+def _publish_message(event_type: str, message: ChatMessage, reason: str = None):
+    """
+    Publica o evento completo no tópico do chat; cada conexão filtra o que o usuário
+    pode ver (_visible_event). Tipos: message.created, message.edited, message.moderated.
+    """
+    pubsub.broker.publish(pubsub.chat_topic(message.chat_id), {
+        "type": event_type,
+        "chat_id": message.chat_id,
+        "message_id": message.id,
+        "sender_id": message.sender_id,
+        "content": message.content,
+        "moderation_status": message.moderation_status,
+        "toxicity_score": message.toxicity_score,
+        "reason": reason,
+        "created_at": message.created_at.isoformat() if message.created_at else None,
+        "edited_at": message.edited_at.isoformat() if message.edited_at else None,
+    })
+
+
+def _visible_event(event: dict, user_id: int):
+    """Versão do evento que o usuário pode receber, ou None. Mensagens pendentes/bloqueadas só o remetente vê."""
+    if event.get("user_id") == user_id:
+        return None  # digitação/presença do próprio usuário
+    if not event["type"].startswith("message.") or event.get("sender_id") == user_id:
+        return event
+    if event.get("moderation_status") in HIDDEN_STATUSES:
+        if event["type"] == "message.created":
+            return None
+        # Editada para algo em moderação/bloqueado: o outro responsável só sabe que deve ocultá-la
+        return {key: event[key] for key in ("type", "chat_id", "message_id", "sender_id", "moderation_status")}
+    return {key: value for key, value in event.items() if key != "reason"}
+
+
+def _pending_snapshot(bind, message_id: int):
+    """(content, edited_at) da mensagem se ainda estiver 'pending', senão None."""
+    session = Session(bind=bind)
+    try:
+        message = session.get(ChatMessage, message_id)
+        if not message or message.moderation_status != "pending":
+            return None
+        return message.content, message.edited_at
+    finally:
+        session.close()
+
+
+def _apply_verdict(bind, message_id: int, content: str, edited_at, analysis: dict):
+    session = Session(bind=bind)
+    try:
+        message = session.get(ChatMessage, message_id)
+        # O veredito vale só para o texto analisado: se a mensagem mudou no meio, a tarefa da edição decide
+        if not message or message.moderation_status != "pending" or message.content != content or message.edited_at != edited_at:
+            return
+
+        if analysis:
+            message.toxicity_score = analysis.get("toxicity_score", 0.0)
+            message.sentiment_score = analysis.get("sentiment_score", 0.0)
+            message.moderation_status = analysis.get("status", "allowed")
+            reason = analysis.get("reason", "Análise IA")
+        else:
+            # IA indisponível: decide pelos sinais locais
+            verdict = moderation.fallback(moderation.classify(message.content))
+            message.toxicity_score, message.moderation_status, reason = verdict.toxicity_score, verdict.decision, verdict.reason
+        session.flush()
+        inbox_summary.refresh_chat(session, message.chat_id)
+        session.commit()
+        _publish_message("message.moderated", message, reason)
+    finally:
+        session.close()
+
+
+async def moderate_pending_message(bind, message_id: int, family_id: int = None):
+    """
+    Worker de moderação: resolve uma mensagem 'pending' pela IA (em micro-lote) ou, se a IA
+    falhar, pelos sinais locais. A mensagem nunca fica presa em 'pending'.
+    O acesso ao banco roda em threads; o event loop só aguarda a IA.
+    """
+    snapshot = await asyncio.to_thread(_pending_snapshot, bind, message_id)
+    if snapshot is None:
+        return
+    content, edited_at = snapshot
+    try:
+        analysis = await moderation.moderation_batcher.analyze(content, family_id=family_id)
+    except Exception as e:
+        print(f"Moderação Erro (mensagem {message_id}): {e}")
+        analysis = None
+    await asyncio.to_thread(_apply_verdict, bind, message_id, content, edited_at, analysis)
+
+
+def _pending_messages(bind) -> list:
+    session = Session(bind=bind)
+    try:
+        return session.query(ChatMessage.id, FamilyChat.family_unit_id).join(
+            FamilyChat, FamilyChat.id == ChatMessage.chat_id
+        ).filter(ChatMessage.moderation_status == "pending").all()
+    finally:
+        session.close()
+
+
+async def resume_pending_moderation(bind):
+    """Reenfileira as mensagens que ficaram 'pending' (ex: reinício do servidor no meio da moderação)."""
+    pending = await asyncio.to_thread(_pending_messages, bind)
+    if pending:
+        print(f"Moderação: retomando {len(pending)} mensagens pendentes")
+        await asyncio.gather(*[moderate_pending_message(bind, message_id, family_id) for message_id, family_id in pending])
+
 
 @router.post("/chats/messages")
-def send_message(request: ChatMessageRequest, db: Session = Depends(get_db), user = Depends(verify_token)):
+def send_message(request: ChatMessageRequest, response: Response, background_tasks: BackgroundTasks, db: Session = Depends(get_db), user = Depends(verify_token)):
     # Security Check
     chat = db.query(FamilyChat).filter(FamilyChat.id == request.chat_id).first()
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     check_family_access(db, user.id, chat.family_unit_id)
-    
-    from ai_utils import gemini_client
-    
-    toxicity_score = 0.0
-    sentiment_score = 0.0
-    moderation_status = "allowed"
-    ai_analysis = "Análise automática"
-
-    prompt = f"""
-    Analise a seguinte mensagem em um contexto de chat familiar (pais divorciados/filhos, monitorado judicialmente).
-    Mensagem: "{request.content}"
-    
-    Retorne APENAS um JSON (sem markdown, sem aspas triplas) com os campos:
-    - toxicity_score: float (0.0 a 1.0, onde 1.0 é extremamente tóxico/ofensivo)
-    - sentiment_score: float (-1.0 negativo a 1.0 positivo)
-    - reason: str (breve explicação)
-    - status: str ("allowed", "needs_rewrite", "blocked")
-    """
-    
-    analysis = gemini_client.analyze_json(prompt)
-    
-    if analysis:
-        toxicity_score = analysis.get("toxicity_score", 0.0)
-        sentiment_score = analysis.get("sentiment_score", 0.0)
-        moderation_status = analysis.get("status", "allowed")
-        ai_analysis = analysis.get("reason", "Análise IA")
-    else:
-        # Fallback to simple keyword check if AI fails or key is missing
-        toxic_words = ["idiota", "burro", "estúpido", "imbecil", "retardado"]
-        if any(word in request.content.lower() for word in toxic_words):
-            toxicity_score = 0.9
-            moderation_status = "blocked"
-            ai_analysis = "Bloqueado por filtro de palavras ofensivas (fallback)"
 
-    if moderation_status == "blocked":
-        # We save it as blocked but return an error to the user
-        message = ChatMessage(
-            chat_id=request.chat_id,
-            sender_id=user.id,
-            content=request.content,
-            toxicity_score=toxicity_score,
-            sentiment_score=sentiment_score,
-            moderation_status=moderation_status,
-            created_at=datetime.now(timezone.utc)
-        )
-        db.add(message)
-        db.commit()
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, 
-            detail=f"Mensagem bloqueada. Motivo: {ai_analysis}"
-        )
+    # Camada local: mensagens claramente benignas ou abusivas são decididas na hora
+    verdict = moderation.classify(request.content)
+    # Ambíguas são aceitas como 'pending' (visíveis só ao remetente) e moderadas em segundo plano
+    moderation_status = "pending" if verdict.decision == "escalate" else verdict.decision
 
-    # Save message
     message = ChatMessage(
         chat_id=request.chat_id,
         sender_id=user.id,
         content=request.content,
-        toxicity_score=toxicity_score,
-        sentiment_score=sentiment_score,
+        toxicity_score=verdict.toxicity_score,
+        sentiment_score=0.0,
         moderation_status=moderation_status,
         created_at=datetime.now(timezone.utc)
     )
     db.add(message)
+    db.flush()
+    if moderation_status not in HIDDEN_STATUSES:
+        inbox_summary.message_created(db, message)
     db.commit()
     db.refresh(message)
+
+    if moderation_status == "blocked":
+        # Fica salva como bloqueada, mas o remetente recebe o erro
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, 
+            detail=f"Mensagem bloqueada. Motivo: {verdict.reason}"
+        )
+
+    _publish_message("message.created", message, verdict.reason)
+    if moderation_status == "pending":
+        background_tasks.add_task(moderate_pending_message, db.get_bind(), message.id, chat.family_unit_id)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {
+            "message": "Message accepted, pending moderation",
+            "message_id": message.id,
+            "moderation_status": moderation_status,
+            "toxicity_score": verdict.toxicity_score
+        }
+
     return {
         "message": "Message sent successfully", 
         "message_id": message.id, 
         "moderation_status": moderation_status,
-        "toxicity_score": toxicity_score
+        "toxicity_score": verdict.toxicity_score
     }
 
 @router.get("/chats/messages")
@@ -161,20 +341,165 @@ def list_messages(chat_id: int, page: int = 1, page_size: int = 50, db: Session
     
     messages = db.query(ChatMessage).filter(
         ChatMessage.chat_id == chat_id,
-        ChatMessage.moderation_status != "blocked"
+        ChatMessage.moderation_status != "blocked",
+        # Mensagens ainda em moderação só aparecem para quem enviou
+        or_(ChatMessage.moderation_status != "pending", ChatMessage.sender_id == user.id)
     ).order_by(ChatMessage.created_at.asc()).offset((page - 1) * page_size).limit(page_size).all()
     return {"messages": messages}
 
-class ReadMessageRequest(BaseModel):
-    message_id: int
+class EditMessageRequest(BaseModel):
+    content: str
 
-@router.post("/chats/messages/{message_id}/read")
-def mark_message_as_read(request: ReadMessageRequest, db: Session = Depends(get_db), user = Depends(verify_token)):
-    read_receipt = ChatMessageRead(
-        message_id=request.message_id,
-        user_id=user.id,
-        read_at=datetime.now(timezone.utc)
+@router.patch("/chats/messages/{message_id}")
+def edit_message(message_id: int, request: EditMessageRequest, response: Response, background_tasks: BackgroundTasks, db: Session = Depends(get_db), user = Depends(verify_token)):
+    """
+    Edita uma mensagem própria; o novo texto passa pela mesma moderação do envio. A versão
+    anterior fica registrada no EventLog (o chat é usado como prova).
+    """
+    message = db.query(ChatMessage).filter(ChatMessage.id == message_id).first()
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    if message.sender_id != user.id:
+        raise HTTPException(status_code=403, detail="Só é possível editar as próprias mensagens")
+    if message.moderation_status == "blocked":
+        raise HTTPException(status_code=400, detail="Mensagem bloqueada não pode ser editada")
+    if message.moderation_status == "pending":
+        raise HTTPException(status_code=409, detail="Mensagem ainda em moderação; tente editar em instantes")
+
+    verdict = moderation.classify(request.content)
+    if verdict.decision == "blocked":
+        # A versão anterior continua valendo
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Mensagem bloqueada. Motivo: {verdict.reason}"
+        )
+
+    family_id = db.query(FamilyChat.family_unit_id).filter(FamilyChat.id == message.chat_id).scalar()
+    log_event(db, "chat_edit", family_id, {
+        "actor_user_id": user.id, "reference_id": message.id,
+        "previous_content": message.content, "previous_status": message.moderation_status,
+    })
+    message.content = request.content
+    message.toxicity_score = verdict.toxicity_score
+    message.sentiment_score = 0.0
+    message.moderation_status = "pending" if verdict.decision == "escalate" else verdict.decision
+    message.edited_at = datetime.now(timezone.utc)
+    db.flush()
+    inbox_summary.refresh_chat(db, message.chat_id)
+    db.commit()
+    db.refresh(message)
+    _publish_message("message.edited", message, verdict.reason)
+
+    if message.moderation_status == "pending":
+        background_tasks.add_task(moderate_pending_message, db.get_bind(), message.id, family_id)
+        response.status_code = status.HTTP_202_ACCEPTED
+    return {"message": "Message updated", "message_id": message.id, "moderation_status": message.moderation_status}
+
+@router.websocket("/chats/{chat_id}/ws")
+async def chat_websocket(websocket: WebSocket, chat_id: int, db: Session = Depends(get_db), user = Depends(get_websocket_user)):
+    """
+    Tempo real do chat: envia message.created/edited/moderated, typing e presence.
+    O cliente pode enviar {"type": "typing"} e {"type": "ping"}.
+    """
+    chat = db.query(FamilyChat).filter(FamilyChat.id == chat_id).first()
+    try:
+        if not chat:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        check_family_access(db, user.id, chat.family_unit_id)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    user_id = user.id
+    # A conexão pode durar horas: não segura a conexão do banco
+    db.close()
+
+    await websocket.accept()
+    topic = pubsub.chat_topic(chat_id)
+    subscription = await pubsub.broker.subscribe(topic)
+    # Presença pode ir ao Redis: fora do event loop
+    if await asyncio.to_thread(pubsub.broker.join, topic, user_id) == 1:
+        pubsub.broker.publish(topic, {"type": "presence", "chat_id": chat_id, "user_id": user_id, "status": "online"})
+    online = await asyncio.to_thread(pubsub.broker.online, topic)
+    await websocket.send_json({"type": "presence.snapshot", "chat_id": chat_id, "online": online})
+
+    async def forward():
+        async for event in subscription:
+            visible = _visible_event(event, user_id)
+            if visible is not None:
+                await websocket.send_json(visible)
+
+    forward_task = asyncio.create_task(forward())
+    try:
+        while True:
+            try:
+                data = json.loads(await websocket.receive_text())
+            except ValueError:
+                continue
+            if not isinstance(data, dict):
+                continue
+            if data.get("type") == "typing":
+                pubsub.broker.publish(topic, {"type": "typing", "chat_id": chat_id, "user_id": user_id})
+            elif data.get("type") == "ping":
+                await websocket.send_json({"type": "pong"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        forward_task.cancel()
+        subscription.close()
+        if await asyncio.to_thread(pubsub.broker.leave, topic, user_id) == 0:
+            pubsub.broker.publish(topic, {"type": "presence", "chat_id": chat_id, "user_id": user_id, "status": "offline"})
+
+def advance_read_watermark(db: Session, chat_id: int, user_id: int, message_id: int) -> int:
+    """
+    Avança a marca de leitura com um único upsert; nunca retrocede (leituras fora de ordem).
+    Para logo abaixo da mensagem mais antiga de outro remetente ainda em moderação: ela não
+    foi vista e, quando liberada, precisa aparecer como não lida. Retorna a marca gravada.
+    """
+    oldest_pending = db.query(func.min(ChatMessage.id)).filter(
+        ChatMessage.chat_id == chat_id,
+        ChatMessage.id <= message_id,
+        ChatMessage.sender_id != user_id,
+        ChatMessage.moderation_status == "pending"
+    ).scalar()
+    if oldest_pending is not None:
+        message_id = oldest_pending - 1
+    table = ChatReadWatermark.__table__
+    statement = insert_on_conflict(db, table).values(
+        chat_id=chat_id, user_id=user_id, last_read_message_id=message_id, updated_at=datetime.now(timezone.utc)
     )
-    db.add(read_receipt)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[table.c.chat_id, table.c.user_id],
+        set_={"last_read_message_id": statement.excluded.last_read_message_id, "updated_at": statement.excluded.updated_at},
+        where=table.c.last_read_message_id < statement.excluded.last_read_message_id,
+    ))
+    return db.query(ChatReadWatermark.last_read_message_id).filter(
+        ChatReadWatermark.chat_id == chat_id, ChatReadWatermark.user_id == user_id
+    ).scalar()
+
+
+@router.post("/chats/messages/{message_id}/read")
+def mark_message_as_read(message_id: int, db: Session = Depends(get_db), user = Depends(verify_token)):
+    """Marca como lidas esta mensagem e todas as anteriores do chat."""
+    message = db.query(ChatMessage.id, ChatMessage.chat_id, FamilyChat.family_unit_id).join(
+        FamilyChat, FamilyChat.id == ChatMessage.chat_id
+    ).filter(ChatMessage.id == message_id).first()
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    check_family_access(db, user.id, message.family_unit_id)
+
+    last_read = advance_read_watermark(db, message.chat_id, user.id, message.id)
+    inbox_summary.refresh_chat(db, message.chat_id, [user.id])
     db.commit()
-    return {"message": "Message marked as read"}
\ No newline at end of file
+    # Publica a marca realmente gravada (pode parar antes de uma mensagem em moderação)
+    pubsub.broker.publish(pubsub.chat_topic(message.chat_id), {
+        "type": "read", "chat_id": message.chat_id, "user_id": user.id, "last_read_message_id": last_read
+    })
+    return {"message": "Message marked as read"}
+
+@router.get("/chats/{chat_id}/unread")
+def get_unread_count(chat_id: int, db: Session = Depends(get_db), user = Depends(verify_token)):
+    chat = db.query(FamilyChat).filter(FamilyChat.id == chat_id).first()
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    check_family_access(db, user.id, chat.family_unit_id)
+    return {"chat_id": chat_id, "unread": inbox_summary.unread_count(db, chat_id, user.id)}
@@ -1,31 +1,25 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi import APIRouter, Depends, HTTPException, Request, status, UploadFile, File, Form
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from hashlib import sha256
 from datetime import datetime, timezone
 from routers.auth import verify_token, check_family_access
-from database import get_db
-from models import Expense, ExpenseShare
-import boto3
-import os
+from database import get_db, insert_on_conflict
+from models import Expense, ExpenseShare, ReceiptAnalysis
+from image_utils import process_receipt, prepare_for_ai
+from workers import run_in_process, run_in_process_sync
+import storage
+import asyncio
 import os
 from typing import Optional
 from pydantic import BaseModel
 
 router = APIRouter()
 
-# S3 Client Configuration
-S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME", "mediare-documents")
-s3_client = boto3.client('s3') if 'AWS_ACCESS_KEY_ID' in os.environ else None
 UPLOAD_DIR = os.path.join(os.getcwd(), "expenses")
+THUMBS_FOLDER = "expenses/thumbs"
 
-@router.post("/expenses/analyze-receipt")
-async def analyze_receipt(file: UploadFile = File(...), user = Depends(verify_token)):
-    """Analisa uma foto de recibo e extrai dados via IA."""
-    from ai_utils import gemini_client
-    
-    content = await file.read()
-    
-    prompt = """
+RECEIPT_PROMPT = """
     Você é um assistente financeiro especializado em ler recibos e notas fiscais.
     Analise a imagem anexada e extraia os dados necessários para o cadastro de uma despesa.
     Tente identificar: Descrição do item/serviço, Valor Total (apenas o número) e Data.
@@ -36,14 +30,251 @@ async def analyze_receipt(file: UploadFile = File(...), user = Depends(verify_to
     - date: str (formato YYYY-MM-DD se encontrado)
     - category: str (Educação, Saúde, Lazer ou Outros)
     """
+# Incrementar ao mudar o prompt: análises guardadas com a versão anterior são ignoradas
+RECEIPT_PROMPT_VERSION = 1
+
+def cached_receipt_analysis(db: Session, family_id: Optional[int], content_hash: str) -> Optional[dict]:
+    """Análise já feita para a mesma imagem (SHA-256 do arquivo enviado) nesta família."""
+    row = db.query(ReceiptAnalysis).filter(
+        ReceiptAnalysis.family_unit_id == family_id,
+        ReceiptAnalysis.content_hash == content_hash,
+        ReceiptAnalysis.prompt_version == RECEIPT_PROMPT_VERSION
+    ).first()
+    return row.result if row else None
+
+def store_receipt_analysis(db: Session, family_id: Optional[int], content_hash: str, analysis: dict):
+    """Guarda a análise (sem commit). Duas análises simultâneas da mesma imagem: fica a primeira."""
+    db.execute(insert_on_conflict(db, ReceiptAnalysis.__table__).values(
+        family_unit_id=family_id, content_hash=content_hash, prompt_version=RECEIPT_PROMPT_VERSION,
+        result=analysis, created_at=datetime.now(timezone.utc)
+    ).on_conflict_do_nothing(index_elements=["family_unit_id", "content_hash", "prompt_version"]))
+
+def _cached_analyses(db: Session, family_id: Optional[int], hashes) -> dict:
+    analyses = {}
+    for content_hash in set(hashes):
+        cached = cached_receipt_analysis(db, family_id, content_hash)
+        if cached:
+            analyses[content_hash] = cached
+    return analyses
+
+def _save_analyses(db: Session, family_id: Optional[int], analyses: dict):
+    for content_hash, analysis in analyses.items():
+        store_receipt_analysis(db, family_id, content_hash, analysis)
+    db.commit()
+
+# Os endpoints de recibo são async por causa do upload e da IA: o acesso ao banco vai para o threadpool
+
+@router.post("/expenses/analyze-receipt")
+async def analyze_receipt(http_request: Request, file: UploadFile = File(...), db: Session = Depends(get_db),
+                          user = Depends(verify_token)):
+    """Analisa uma foto de recibo e extrai dados via IA (a mesma imagem é analisada uma vez só)."""
+    from ai_utils import gemini_client, cancel_on_disconnect
+    
+    content = await file.read()
+    mime_type = file.content_type
+    content_hash = sha256(content).hexdigest()
+
+    cached = await run_in_threadpool(cached_receipt_analysis, db, user.family_unit_id, content_hash)
+    if cached:
+        return cached
+
+    # Reduz a imagem (tons de cinza) fora do event loop antes de enviar ao Gemini
+    ai_content = await run_in_process(prepare_for_ai, content)
+    if ai_content:
+        content, mime_type = ai_content, "image/jpeg"
     
-    analysis = gemini_client.analyze_image(prompt, content, mime_type=file.content_type)
+    analysis = await cancel_on_disconnect(http_request, gemini_client.analyze_image_async(
+        RECEIPT_PROMPT, content, mime_type=mime_type, family_id=user.family_unit_id
+    ))
     
     if not analysis:
         raise HTTPException(status_code=500, detail="IA falhou ao processar a imagem. Tente uma foto mais nítida.")
-        
+
+    await run_in_threadpool(_save_analyses, db, user.family_unit_id, {content_hash: analysis})
     return analysis
 
+RECEIPT_BATCH_MAX_FILES = int(os.environ.get("RECEIPT_BATCH_MAX_FILES", 40))
+# Teto da soma dos arquivos de um lote, checado antes de carregar os uploads em memória
+RECEIPT_BATCH_MAX_BYTES = int(os.environ.get("RECEIPT_BATCH_MAX_BYTES", 60 * 1024 * 1024))
+# Imagens por chamada ao Gemini e teto de bytes de cada chamada (o limite de envio inline é ~20 MB em base64)
+RECEIPT_BATCH_PACK_SIZE = int(os.environ.get("RECEIPT_BATCH_PACK_SIZE", 8))
+RECEIPT_BATCH_PACK_BYTES = int(os.environ.get("RECEIPT_BATCH_PACK_BYTES", 12 * 1024 * 1024))
+RECEIPT_BATCH_CONCURRENCY = int(os.environ.get("RECEIPT_BATCH_CONCURRENCY", 2))
+RECEIPT_BATCH_TIMEOUT = float(os.environ.get("RECEIPT_BATCH_TIMEOUT", 90))
+
+RECEIPT_BATCH_PROMPT = """
+    Você é um assistente financeiro especializado em ler recibos e notas fiscais.
+    As imagens anexadas estão numeradas ("Imagem 1", "Imagem 2", ...) e cada uma é um recibo diferente.
+    Para cada imagem, identifique: Descrição do item/serviço, Valor Total (apenas o número) e Data.
+    
+    Retorne APENAS um JSON (sem markdown): uma lista com um objeto por imagem, na mesma ordem, com os campos:
+    - index: int (número da imagem)
+    - description: str (ex: Farmácia, Escola, Uniforme)
+    - amount: float (valor numérico)
+    - date: str (formato YYYY-MM-DD se encontrado)
+    - category: str (Educação, Saúde, Lazer ou Outros)
+    """
+
+def pack_receipts(sizes: list, max_items: int = RECEIPT_BATCH_PACK_SIZE, max_bytes: int = RECEIPT_BATCH_PACK_BYTES) -> list:
+    """Agrupa as imagens (índices) no menor número de chamadas: first-fit decrescente por tamanho."""
+    packs = []
+    for index in sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True):
+        pack = next((p for p in packs if len(p["items"]) < max_items and p["bytes"] + sizes[index] <= max_bytes), None)
+        if pack is None:
+            pack = {"items": [], "bytes": 0}
+            packs.append(pack)
+        pack["items"].append(index)
+        pack["bytes"] += sizes[index]
+    return [sorted(pack["items"]) for pack in packs]
+
+def _pack_results(response, count: int) -> list:
+    """
+    Resposta de uma chamada com `count` imagens -> lista de análises (None onde faltou).
+    Só vale o item com `index` válido e único: sem ele não há como saber a qual imagem
+    o resultado pertence, e a imagem é relida individualmente.
+    """
+    if isinstance(response, dict):
+        response = response.get("receipts") or response.get("results")
+    results = [None] * count
+    if not isinstance(response, list):
+        return results
+    numbered = {}
+    for item in response:
+        if not isinstance(item, dict):
+            continue
+        number = item.pop("index", None)
+        if isinstance(number, int) and not isinstance(number, bool) and 1 <= number <= count:
+            numbered.setdefault(number, []).append(item)
+    for number, items in numbered.items():
+        if len(items) == 1:
+            results[number - 1] = items[0]
+    return results
+
+def _amount(value) -> Optional[float]:
+    try:
+        return round(float(str(value).replace(",", ".")), 2)
+    except (TypeError, ValueError):
+        return None
+
+@router.post("/expenses/analyze-receipts")
+async def analyze_receipts(
+    http_request: Request,
+    files: list[UploadFile] = File(...),
+    child_id: Optional[int] = Form(None),
+    family_unit_id: Optional[int] = Form(None),
+    db: Session = Depends(get_db),
+    user = Depends(verify_token)
+):
+    """
+    Lê vários recibos de uma vez: agrupa as imagens em poucas chamadas ao Gemini, executa
+    as chamadas em paralelo (limitado) e devolve o resultado de cada imagem mais um
+    rascunho das despesas para o usuário conferir antes de cadastrar. Só as leituras
+    individuais (RECEIPT_PROMPT) vão para o cache; as do prompt em grupo não.
+    """
+    from ai_utils import gemini_client, cancel_on_disconnect
+
+    if len(files) > RECEIPT_BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"Envie no máximo {RECEIPT_BATCH_MAX_FILES} recibos por vez.")
+    family_id = family_unit_id or user.family_unit_id
+    if family_unit_id is not None:
+        await run_in_threadpool(check_family_access, db, user.id, family_unit_id)
+
+    too_large = HTTPException(status_code=413, detail=f"Lote acima de {RECEIPT_BATCH_MAX_BYTES // (1024 * 1024)} MB.")
+    if sum(file.size or 0 for file in files) > RECEIPT_BATCH_MAX_BYTES:
+        raise too_large
+    uploads, total = [], 0
+    for file in files:
+        content = await file.read(RECEIPT_BATCH_MAX_BYTES - total + 1)
+        total += len(content)
+        if total > RECEIPT_BATCH_MAX_BYTES:
+            raise too_large
+        uploads.append((file.filename, file.content_type, content))
+    hashes = [sha256(content).hexdigest() for _, _, content in uploads]
+    analyses = await run_in_threadpool(_cached_analyses, db, family_id, hashes)
+    cached_hashes = set(analyses)
+
+    # Uma análise por imagem distinta que ainda não foi lida
+    pending = [index for index, content_hash in enumerate(hashes)
+               if content_hash not in analyses and content_hash not in hashes[:index]]
+    prepared = await asyncio.gather(*[run_in_process(prepare_for_ai, uploads[index][2]) for index in pending])
+    images = [(ai_content, "image/jpeg") if ai_content else (uploads[index][2], uploads[index][1] or "image/jpeg")
+              for index, ai_content in zip(pending, prepared)]
+
+    limit = asyncio.Semaphore(RECEIPT_BATCH_CONCURRENCY)
+    read_alone = set()  # posições lidas com RECEIPT_PROMPT: só essas vão para o cache
+
+    async def analyze_pack(pack: list):
+        async with limit:
+            if len(pack) == 1:
+                image_bytes, mime_type = images[pack[0]]
+                results = [await gemini_client.analyze_image_async(
+                    RECEIPT_PROMPT, image_bytes, mime_type=mime_type, family_id=family_id
+                )]
+                read_alone.add(pack[0])
+            else:
+                response = await gemini_client.analyze_images_async(
+                    RECEIPT_BATCH_PROMPT, [images[position] for position in pack], family_id=family_id,
+                    timeout=RECEIPT_BATCH_TIMEOUT
+                )
+                results = _pack_results(response, len(pack))
+        # O que a chamada em grupo não devolveu é lido individualmente
+        missing = [position for position, result in zip(pack, results) if not result]
+        if missing and len(pack) > 1:
+            retried = await asyncio.gather(*[analyze_pack([position]) for position in missing])
+            results = [retried[missing.index(position)][0] if position in missing else result
+                       for position, result in zip(pack, results)]
+        return results
+
+    packs = pack_receipts([len(image_bytes) for image_bytes, _ in images])
+    outcomes = await cancel_on_disconnect(http_request, asyncio.gather(*[analyze_pack(pack) for pack in packs]))
+    fresh = {}
+    for pack, results in zip(packs, outcomes):
+        for position, result in zip(pack, results):
+            if result and "text" not in result:
+                analyses[hashes[pending[position]]] = result
+                if position in read_alone:
+                    fresh[hashes[pending[position]]] = result
+    await run_in_threadpool(_save_analyses, db, family_id, fresh)
+
+    results, draft = [], []
+    for index, ((filename, _, _), content_hash) in enumerate(zip(uploads, hashes)):
+        analysis = analyses.get(content_hash)
+        results.append({
+            "index": index,
+            "filename": filename,
+            "content_hash": content_hash,
+            "cached": content_hash in cached_hashes,
+            "analysis": analysis,
+            "error": None if analysis else "IA falhou ao processar a imagem. Tente uma foto mais nítida.",
+        })
+        amount = _amount(analysis.get("amount")) if analysis else None
+        if amount is not None:
+            draft.append({
+                "index": index,
+                "description": analysis.get("description"),
+                "amount": amount,
+                "date": analysis.get("date"),
+                "category": analysis.get("category"),
+                "child_id": child_id,
+                "family_unit_id": family_id,
+            })
+
+    return {
+        "results": results,
+        "draft": {"expenses": draft, "total_amount": round(sum(item["amount"] for item in draft), 2)},
+        "packs": len(packs),
+    }
+
+def _save_previews(file_hash: str, processed: dict) -> dict:
+    """Grava as derivadas (miniatura, preview e JPEG normalizado) nomeadas pelo hash do anexo (cache imutável)."""
+    return {
+        "thumbnail": storage.save_bytes(THUMBS_FOLDER, f"{file_hash}.webp", processed["thumbnail"], "image/webp"),
+        "preview": storage.save_bytes(THUMBS_FOLDER, f"{file_hash}_preview.webp", processed["preview"], "image/webp"),
+        "normalized": storage.save_bytes(THUMBS_FOLDER, f"{file_hash}_normalized.jpg", processed["normalized"], "image/jpeg"),
+    }
+
+PREVIEW_VARIANTS = {"thumbnail": "image/webp", "preview": "image/webp", "normalized": "image/jpeg"}
+
 @router.get("/expenses/categories")
 def get_expense_categories():
     return {
@@ -66,28 +297,21 @@ def create_expense(
     # Security Check
     check_family_access(db, user.id, family_unit_id)
     
+    # O arquivo enviado é a prova: guardado e hasheado sem alteração
     file_content = file.file.read()
     file_hash = sha256(file_content).hexdigest()
+    # Leitura feita antes em /expenses/analyze-receipt para a mesma foto (por qualquer um da família)
+    analysis = cached_receipt_analysis(db, family_unit_id, file_hash)
+
+    # Derivadas para exibição (orientação EXIF, sem metadados, miniaturas) no pool de processos
+    processed = run_in_process_sync(process_receipt, file_content)
     filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{file.filename}"
     
-    if s3_client:
-        try:
-            s3_client.put_object(
-                Bucket=S3_BUCKET_NAME,
-                Key=f"expenses/{filename}",
-                Body=file_content,
-                ContentType=file.content_type
-            )
-            file_url = f"s3://{S3_BUCKET_NAME}/expenses/{filename}"
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"S3 Upload failed: {str(e)}")
-    else:
-        # Fallback local storage
-        os.makedirs(UPLOAD_DIR, exist_ok=True)
-        file_path = os.path.join(UPLOAD_DIR, filename)
-        with open(file_path, "wb") as buffer:
-            buffer.write(file_content)
-        file_url = f"/expenses/{filename}"
+    try:
+        file_url = storage.save_bytes("expenses", filename, file_content, file.content_type)
+        previews = _save_previews(file_hash, processed) if processed else {}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
     # Create expense
     expense = Expense(
@@ -95,6 +319,9 @@ def create_expense(
         amount=amount,
         attachment_url=file_url,
         attachment_hash_sha256=file_hash,
+        thumbnail_url=previews.get("thumbnail"),
+        preview_url=previews.get("preview"),
+        normalized_url=previews.get("normalized"),
         family_unit_id=family_unit_id,
         child_id=child_id,
         created_at=datetime.now(timezone.utc),
@@ -114,7 +341,8 @@ def create_expense(
     db.add(share)
     db.commit()
 
-    return {"message": "Expense created successfully", "expense_id": expense.id, "file_url": file_url}
+    return {"message": "Expense created successfully", "expense_id": expense.id, "file_url": file_url,
+            "receipt_analysis": analysis}
 
 from fastapi.responses import FileResponse
 
@@ -130,16 +358,9 @@ def get_expense_attachment(expense_id: int, db: Session = Depends(get_db), user
     url = expense.attachment_url
     if url.startswith("s3://"):
         # Generate presigned URL
-        if not s3_client:
+        if not storage.s3_client:
              raise HTTPException(status_code=500, detail="S3 configuration missing for this file")
-        bucket = url.split("/")[2]
-        key = "/".join(url.split("/")[3:])
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': bucket, 'Key': key},
-            ExpiresIn=3600
-        )
-        return {"url": presigned_url, "type": "s3_presigned"}
+        return {"url": storage.presigned_url(url), "type": "s3_presigned"}
     else:
         # Local file
         local_name = os.path.basename(url)
@@ -150,6 +371,44 @@ def get_expense_attachment(expense_id: int, db: Session = Depends(get_db), user
         else:
             raise HTTPException(status_code=404, detail=f"File not found on server: {local_path}")
 
+@router.get("/attachments/expenses/{expense_id}/thumbnail")
+def get_expense_thumbnail(expense_id: int, variant: str = "thumbnail", db: Session = Depends(get_db), user = Depends(verify_token)):
+    """Serve uma derivada do recibo (miniatura, preview ou JPEG normalizado), gerando sob demanda para anexos antigos."""
+    if variant not in PREVIEW_VARIANTS:
+        raise HTTPException(status_code=400, detail="variant deve ser 'thumbnail', 'preview' ou 'normalized'")
+
+    expense = db.query(Expense).filter(Expense.id == expense_id).first()
+    if not expense:
+        raise HTTPException(status_code=404, detail="Expense not found")
+
+    # Security Check
+    check_family_access(db, user.id, expense.family_unit_id)
+
+    url = getattr(expense, f"{variant}_url")
+    if not url:
+        original = storage.load_bytes(expense.attachment_url) if expense.attachment_url else None
+        processed = run_in_process_sync(process_receipt, original) if original else None
+        if not processed:
+            raise HTTPException(status_code=404, detail="Pré-visualização indisponível para este anexo")
+        previews = _save_previews(expense.attachment_hash_sha256 or sha256(original).hexdigest(), processed)
+        expense.thumbnail_url = previews["thumbnail"]
+        expense.preview_url = previews["preview"]
+        expense.normalized_url = previews["normalized"]
+        db.commit()
+        url = previews[variant]
+
+    if url.startswith("s3://"):
+        return {"url": storage.presigned_url(url), "type": "s3_presigned"}
+    path = storage.local_path(url)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Arquivo da pré-visualização não encontrado no servidor")
+    # Nome derivado do hash do conteúdo: pode ser cacheado pelo app sem revalidação
+    return FileResponse(
+        path,
+        media_type=PREVIEW_VARIANTS[variant],
+        headers={"Cache-Control": "private, max-age=31536000, immutable"}
+    )
+
 @router.delete("/expenses/{expense_id}")
 def delete_expense(expense_id: int, db: Session = Depends(get_db), user = Depends(verify_token)):
     expense = db.query(Expense).filter(Expense.id == expense_id, Expense.family_unit_id == user.family_unit_id).first()
@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from routers.auth import verify_token, check_family_access
@@ -38,16 +39,24 @@ def create_task(request: TaskRequest, db: Session = Depends(get_db), user = Depe
     db.refresh(task)
     return {"message": "Task created successfully", "task_id": task.id}
 
+def _family_child(db: Session, child_id: int, family_unit_id: int, detail: str):
+    from models import Child
+    child = db.query(Child).filter(Child.id == child_id, Child.family_id == family_unit_id).first()
+    if not child:
+        raise HTTPException(status_code=403, detail=detail)
+    return child
+
+# Os handlers com IA são async: consultas rodam no threadpool e o event loop só aguarda a IA
+
 @router.get("/tasks/suggest-ai")
-def suggest_tasks_ai(child_id: int, db: Session = Depends(get_db), user = Depends(verify_token)):
+async def suggest_tasks_ai(child_id: int, http_request: Request, db: Session = Depends(get_db), user = Depends(verify_token)):
     """Sugere tarefas lúdicas e educativas usando o Gemini."""
-    from ai_utils import gemini_client
-    from models import Child
-    import json
+    from ai_utils import gemini_client, cancel_on_disconnect, AI_CACHE_TTL
     
-    child = db.query(Child).filter(Child.id == child_id, Child.family_id == user.family_unit_id).first()
-    if not child:
-        raise HTTPException(status_code=403, detail="Acesso negado: Você não tem permissão para ver esta criança.")
+    child = await run_in_threadpool(
+        _family_child, db, child_id, user.family_unit_id,
+        "Acesso negado: Você não tem permissão para ver esta criança."
+    )
     
     # Calcula idade aproximada
     age = datetime.now().year - child.birth_date.year
@@ -64,7 +73,9 @@ def suggest_tasks_ai(child_id: int, db: Session = Depends(get_db), user = Depend
     ]
     """
     
-    suggestions = gemini_client.analyze_json(prompt)
+    suggestions = await cancel_on_disconnect(http_request, gemini_client.analyze_json_async(
+        prompt, family_id=user.family_unit_id, cache_ttl=AI_CACHE_TTL["suggest_tasks"]
+    ))
     
     if not suggestions:
         # Fallback se a IA falhar
@@ -92,7 +103,7 @@ def complete_task(task_id: int, db: Session = Depends(get_db), user = Depends(ve
         db, user.id, user.family_unit_id, 
         "Missão Cumprida!", 
         f"A tarefa '{task.name}' foi marcada como concluída.",
-        "success"
+        "success", group_key="task_completed", digest_title="{count} missões concluídas"
     )
 
     # Add points to ledger
@@ -156,22 +167,26 @@ def get_child_progress(child_id: int, db: Session = Depends(get_db), user = Depe
         "next_level_points": 100
     }
 
-@router.get("/child-progress/{child_id}/encouragement")
-def get_child_encouragement(child_id: int, db: Session = Depends(get_db), user = Depends(verify_token)):
-    """Gera uma mensagem de incentivo personalizada via IA baseada no progresso da criança."""
-    from ai_utils import gemini_client
-    from models import Child, ChildLevel, Task, FamilyUnit
-    
-    child = db.query(Child).filter(Child.id == child_id, Child.family_id == user.family_unit_id).first()
-    if not child:
-        raise HTTPException(status_code=403, detail="Acesso negado.")
+def _encouragement_context(db: Session, child_id: int, family_unit_id: int):
+    from models import FamilyUnit
+    child = _family_child(db, child_id, family_unit_id, "Acesso negado.")
         
     child_level = db.query(ChildLevel).filter(ChildLevel.child_id == child_id).first()
+    family = db.query(FamilyUnit).filter(FamilyUnit.id == family_unit_id).first()
         
     recent_tasks = db.query(Task).filter(Task.child_id == child_id, Task.status == 'completed').order_by(Task.created_at.desc()).limit(3).all()
     tasks_str = ", ".join([t.name for t in recent_tasks]) or "iniciando novas missões"
     
     values = family.values_profile if family else "educação e harmonia"
+    return child, child_level, tasks_str, values
+
+@router.get("/child-progress/{child_id}/encouragement")
+async def get_child_encouragement(child_id: int, http_request: Request, db: Session = Depends(get_db), user = Depends(verify_token)):
+    """Gera uma mensagem de incentivo personalizada via IA baseada no progresso da criança."""
+    from ai_utils import gemini_client, cancel_on_disconnect
+    child, child_level, tasks_str, values = await run_in_threadpool(
+        _encouragement_context, db, child_id, user.family_unit_id
+    )
     
     prompt = f"""
     Você é o 'Guardião da Harmonia', um mentor virtual super legal para crianças.
@@ -186,7 +201,7 @@ def get_child_encouragement(child_id: int, db: Session = Depends(get_db), user =
     Retorne APENAS o texto da mensagem.
     """
     
-    encouragement = gemini_client.generate_content(prompt)
+    encouragement = await cancel_on_disconnect(http_request, gemini_client.generate_content_async(prompt, family_id=user.family_unit_id))
     if not encouragement:
         encouragement = f"Continue assim, {child.name}! Você está se tornando um verdadeiro herói da colaboração! ✨🚀"
         
@@ -225,20 +240,20 @@ def delete_reward(reward_id: int, db: Session = Depends(get_db), user = Depends(
     db.commit()
     return {"message": "Recompensa removida"}
 
+def _discovery_context(db: Session, child_id: int, family_unit_id: int):
+    from models import FamilyUnit
+    child = _family_child(db, child_id, family_unit_id, "Acesso negado.")
+    family = db.query(FamilyUnit).filter(FamilyUnit.id == family_unit_id).first()
+    return child, family
+
 @router.get("/child-discovery")
-def get_child_discovery(child_id: int, city: str, db: Session = Depends(get_db), user = Depends(verify_token)):
+async def get_child_discovery(child_id: int, city: str, http_request: Request, db: Session = Depends(get_db), user = Depends(verify_token)):
     """
     Motor de Descobertas IA: Pesquisa eventos, filmes e notícias 
     baseados nos interesses da criança e nos valores da família.
     """
-    from ai_utils import gemini_client
-    from models import Child, FamilyUnit
-    
-    child = db.query(Child).filter(Child.id == child_id, Child.family_id == user.family_unit_id).first()
-    if not child:
-        raise HTTPException(status_code=403, detail="Acesso negado.")
-        
-    family = db.query(FamilyUnit).filter(FamilyUnit.id == user.family_unit_id).first()
+    from ai_utils import gemini_client, cancel_on_disconnect, AI_CACHE_TTL
+    child, family = await run_in_threadpool(_discovery_context, db, child_id, user.family_unit_id)
 
     interests = child.interests or "Atividades educativas e lazer"
     values = family.values_profile or "neutro/educativo"
@@ -269,7 +284,9 @@ def get_child_discovery(child_id: int, city: str, db: Session = Depends(get_db),
       ]
     """
     
-    discovery_data = gemini_client.analyze_json(prompt)
+    discovery_data = await cancel_on_disconnect(http_request, gemini_client.analyze_json_async(
+        prompt, family_id=user.family_unit_id, cache_ttl=AI_CACHE_TTL["child_discovery"]
+    ))
     
     if not discovery_data:
         return {"message": "A IA está processando as novidades, tente em instantes.", "status": "processing"}
@@ -309,22 +326,25 @@ def redeem_reward(reward_id: int, child_id: int, db: Session = Depends(get_db),
         db, user.id, user.family_unit_id,
         "Recompensa Resgatada! 🎁",
         f"A recompensa '{reward.name}' foi resgatada.",
-        "info"
+        "info", group_key="reward_redeemed", digest_title="{count} recompensas resgatadas 🎁"
     )
     
     db.commit()
     return {"message": "Reward redeemed successfully", "new_balance": child_level.points}
 
-@router.get("/gamification/harmony-insight")
-def get_family_harmony_insight(db: Session = Depends(get_db), user = Depends(verify_token)):
-    """Analisa o engajamento da família na gamificação e chat para dar um 'termômetro' de harmonia."""
-    from ai_utils import gemini_client
+def _harmony_context(db: Session, family_unit_id: int):
     from models import EventLog, FamilyUnit
-    
-    family = db.query(FamilyUnit).filter(FamilyUnit.id == user.family_unit_id).first()
-    recent_events = db.query(EventLog).filter(EventLog.family_unit_id == user.family_unit_id).order_by(EventLog.created_at.desc()).limit(10).all()
+    family = db.query(FamilyUnit).filter(FamilyUnit.id == family_unit_id).first()
+    recent_events = db.query(EventLog).filter(EventLog.family_unit_id == family_unit_id).order_by(EventLog.created_at.desc()).limit(10).all()
     
     events_summary = ", ".join([e.event_type for e in recent_events]) if recent_events else "início das atividades"
+    return family, events_summary
+
+@router.get("/gamification/harmony-insight")
+async def get_family_harmony_insight(http_request: Request, db: Session = Depends(get_db), user = Depends(verify_token)):
+    """Analisa o engajamento da família na gamificação e chat para dar um 'termômetro' de harmonia."""
+    from ai_utils import gemini_client, cancel_on_disconnect, AI_CACHE_TTL
+    family, events_summary = await run_in_threadpool(_harmony_context, db, user.family_unit_id)
     
     prompt = f"""
     Você é um consultor de harmonia familiar de alto nível.
@@ -337,7 +357,9 @@ def get_family_harmony_insight(db: Session = Depends(get_db), user = Depends(ver
     Retorne APENAS a frase curta.
     """
     
-    insight = gemini_client.generate_content(prompt)
+    insight = await cancel_on_disconnect(http_request, gemini_client.generate_content_async(
+        prompt, family_id=user.family_unit_id, cache_ttl=AI_CACHE_TTL["harmony_insight"]
+    ))
     if not insight:
         insight = "A colaboração é o alicerce para um futuro brilhante para seus filhos. Continuem firmes!"
         
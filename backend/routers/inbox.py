@@ -0,0 +1,41 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.orm import Session
+from .auth import verify_token
+from database import get_db
+from models import ConversationSummary
+import inbox_summary
+
+router = APIRouter(prefix="/inbox", tags=["Inbox"])
+
+@router.get("/badge")
+def get_badge(db: Session = Depends(get_db), user = Depends(verify_token)):
+    """Contadores do badge do app, lidos do resumo do usuário (uma linha)."""
+    summary = inbox_summary.get_summary(db, user.id)
+    return {
+        "unread_notifications": summary.unread_notifications,
+        "unread_messages": summary.unread_messages,
+        "total": summary.unread_notifications + summary.unread_messages,
+    }
+
+@router.get("")
+def get_inbox(db: Session = Depends(get_db), user = Depends(verify_token)):
+    """Caixa de entrada: não lidas e última mensagem de cada chat, mais recentes primeiro."""
+    summary = inbox_summary.get_summary(db, user.id)
+    conversations = db.query(ConversationSummary).filter(
+        ConversationSummary.user_id == user.id
+    ).order_by(ConversationSummary.last_message_at.desc()).all()
+    return {
+        "unread_notifications": summary.unread_notifications,
+        "unread_messages": summary.unread_messages,
+        "chats": [
+            {
+                "chat_id": row.chat_id,
+                "unread": row.unread_count,
+                "last_message_id": row.last_message_id,
+                "last_message_preview": row.last_message_preview,
+                "last_message_at": row.last_message_at,
+                "last_sender_id": row.last_sender_id,
+            }
+            for row in conversations
+        ],
+    }
@@ -1,14 +1,27 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, ConfigDict
 from .auth import verify_token
 from database import get_db
-from models import Notification
+from models import Notification, PushDevice
+import inbox_summary
+import notifier
+import pubsub
 from datetime import datetime, timezone
 from typing import List, Optional
+import os
+import json
+import asyncio
 
 router = APIRouter(prefix="/notifications", tags=["Notifications"])
 
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("SSE_HEARTBEAT_SECONDS", 15))
+SSE_RETRY_MS = int(os.environ.get("SSE_RETRY_MS", 3000))
+LONG_POLL_TIMEOUT_SECONDS = float(os.environ.get("LONG_POLL_TIMEOUT_SECONDS", 25))
+NOTIFICATION_BACKLOG_LIMIT = int(os.environ.get("NOTIFICATION_BACKLOG_LIMIT", 100))
+
 class NotificationResponse(BaseModel):
     id: int
     title: str
@@ -16,6 +29,8 @@ class NotificationResponse(BaseModel):
     type: str
     created_at: datetime
     read_at: Optional[datetime]
+    occurrences: int = 1
+    updated_at: Optional[datetime] = None
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -29,37 +44,145 @@ def list_notifications(db: Session = Depends(get_db), user = Depends(verify_toke
     notifications = db.query(Notification).filter(
         Notification.family_unit_id == user.family_unit_id,
         Notification.user_id == user.id
-    ).order_by(Notification.created_at.desc()).limit(20).all()
+    ).order_by(func.coalesce(Notification.updated_at, Notification.created_at).desc()).limit(20).all()
     return notifications
 
+def _backlog(db: Session, user_id: int, after_id: int) -> list:
+    """Notificações criadas depois de `after_id` (retomada do stream / long-poll)."""
+    # As guardadas para o resumo do resguardo só chegam pelo resumo, como no envio ao vivo
+    notifications = db.query(Notification).filter(
+        Notification.user_id == user_id, Notification.id > after_id, Notification.digest_pending.is_(False)
+    ).order_by(Notification.id.asc()).limit(NOTIFICATION_BACKLOG_LIMIT).all()
+    return [notifier.serialize(notification) for notification in notifications]
+
+def _sse(payload: dict) -> str:
+    if payload.get("updated"):
+        # Notificação agrupada que já foi entregue: sem id, para não mexer no Last-Event-ID
+        return f"event: notification.updated\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+    return f"id: {payload['id']}\nevent: notification\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+async def notification_stream(subscription, backlog: list, last_id: int, heartbeat: float = SSE_HEARTBEAT_SECONDS):
+    """Envia o backlog e depois as notificações ao vivo, sem repetir ids já entregues (exceto atualizações)."""
+    try:
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        for payload in backlog:
+            last_id = max(last_id, payload["id"])
+            yield _sse(payload)
+        while True:
+            try:
+                payload = await asyncio.wait_for(subscription.get(), heartbeat)
+            except asyncio.TimeoutError:
+                # Comentário SSE: mantém a conexão viva em proxies
+                yield ": keep-alive\n\n"
+                continue
+            if payload.get("updated"):
+                yield _sse(payload)
+                continue
+            if payload["id"] <= last_id:
+                continue
+            last_id = payload["id"]
+            yield _sse(payload)
+    finally:
+        subscription.close()
+
+@router.get("/stream")
+async def stream_notifications(last_event_id: Optional[int] = Header(None), after_id: Optional[int] = None,
+                               db: Session = Depends(get_db), user = Depends(verify_token)):
+    """
+    Server-Sent Events com as notificações novas do usuário. Reconexões enviam
+    Last-Event-ID (ou ?after_id=) e recebem o que foi criado no intervalo.
+    """
+    # Inscreve antes de ler o backlog para não perder nada entre os dois
+    subscription = await pubsub.broker.subscribe(pubsub.user_topic(user.id))
+    last_id = last_event_id if last_event_id is not None else after_id
+    try:
+        backlog = _backlog(db, user.id, last_id) if last_id is not None else []
+    except Exception:
+        subscription.close()
+        raise
+    # O stream pode durar horas: não segura a conexão do banco
+    db.close()
+    return StreamingResponse(
+        notification_stream(subscription, backlog, last_id or 0),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.get("/poll")
+async def poll_notifications(after_id: int = 0, timeout: float = LONG_POLL_TIMEOUT_SECONDS,
+                             db: Session = Depends(get_db), user = Depends(verify_token)):
+    """Long-poll (alternativa ao SSE): responde assim que houver notificação com id > after_id ou no timeout."""
+    subscription = await pubsub.broker.subscribe(pubsub.user_topic(user.id))
+    try:
+        notifications = _backlog(db, user.id, after_id)
+        db.close()
+        if not notifications:
+            deadline = asyncio.get_running_loop().time() + min(max(timeout, 0), LONG_POLL_TIMEOUT_SECONDS)
+            while not notifications:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                try:
+                    payload = await asyncio.wait_for(subscription.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if payload["id"] > after_id or payload.get("updated"):
+                    notifications.append(payload)
+        last_id = max([after_id] + [payload["id"] for payload in notifications])
+        return {"notifications": notifications, "last_id": last_id}
+    finally:
+        subscription.close()
+
+class DeviceRequest(BaseModel):
+    token: str
+    platform: Optional[str] = None
+
+@router.post("/devices")
+def register_device(request: DeviceRequest, db: Session = Depends(get_db), user = Depends(verify_token)):
+    """Registra (ou reativa) o token FCM do aparelho. Um token pertence a um único usuário."""
+    now = datetime.now(timezone.utc)
+    device = db.query(PushDevice).filter(PushDevice.token == request.token).first()
+    if device:
+        device.user_id = user.id
+        device.platform = request.platform or device.platform
+        device.last_seen_at = now
+        device.disabled_at = None
+    else:
+        device = PushDevice(user_id=user.id, token=request.token, platform=request.platform,
+                            created_at=now, last_seen_at=now)
+        db.add(device)
+    db.commit()
+    return {"message": "Device registered", "device_id": device.id}
+
+@router.delete("/devices/{token}")
+def unregister_device(token: str, db: Session = Depends(get_db), user = Depends(verify_token)):
+    device = db.query(PushDevice).filter(PushDevice.token == token, PushDevice.user_id == user.id).first()
+    if not device:
+        raise HTTPException(status_code=404, detail="Device not found")
+    device.disabled_at = datetime.now(timezone.utc)
+    db.commit()
+    return {"message": "Device unregistered"}
+
 @router.post("/{notification_id}/read")
 def mark_read(notification_id: int, db: Session = Depends(get_db), user = Depends(verify_token)):
     notification = db.query(Notification).filter(Notification.id == notification_id, Notification.user_id == user.id).first()
     if not notification:
         raise HTTPException(status_code=404, detail="Notification not found")
     
-    notification.read_at = datetime.now(timezone.utc)
+    if notification.read_at is None:
+        notification.read_at = datetime.now(timezone.utc)
+        inbox_summary.notification_read(db, user.id)
     db.commit()
     return {"message": "Notification marked as read"}
 
 from models import User
 
 # Internal utility to create notifications
-def create_internal_notification(db: Session, user_id: int, family_id: int, title: str, content: str, n_type: str = "info"):
-    # Filtro de Resguardo: Ignore if the user has Do Not Disturb active
-    user = db.query(User).filter(User.id == user_id).first()
-    if user and getattr(user, 'resguardo_active', False):
-        return
-
-    new_notif = Notification(
-        title=title,
-        content=content,
-        type=n_type,
-        user_id=user_id,
-        family_unit_id=family_id,
-        created_at=datetime.now(timezone.utc)
-    )
-    db.add(new_notif)
+def create_internal_notification(db: Session, user_id: int, family_id: int, title: str, content: str, n_type: str = "info",
+                                 group_key: str = None, digest_title: str = None):
+    # Filtro de Resguardo e agrupamento aplicados no próprio fan-out (ver notifier.notify_family)
+    notifier.notify_family(db, family_id, title, content, n_type, audience="users", user_ids=[user_id],
+                           group_key=group_key, digest_title=digest_title)
     db.commit()
 
 @router.post("/emergency")
@@ -68,29 +191,16 @@ def trigger_emergency(req: EmergencyRequest, db: Session = Depends(get_db), user
     Aciona o Botão de Pânico / Emergência Médica.
     Deve notificar os outros membros da família e possivelmente serviços cadastrados (futuro).
     """
-    from models import FamilyMember
     if not user.family_unit_id:
         raise HTTPException(status_code=400, detail="User not in a family unit")
         
-    other_members = db.query(FamilyMember).filter(
-        FamilyMember.family_id == user.family_unit_id,
-        FamilyMember.user_id != user.id
-    ).all()
-    
     base_msg = f"{req.message}. Coordenadas: {req.latitude}, {req.longitude}"
     
-    for member in other_members:
-        # Pula o filtro de resguardo para emergências reais se for mandatório, 
-        # mas aqui vamos manter a assinatura. Idealmente emergência ignora resguardo.
-        new_notif = Notification(
-            title=f"🚨 ALERTA GERAL: {user.full_name}",
-            content=base_msg,
-            type="error",
-            user_id=member.user_id,
-            family_unit_id=user.family_unit_id,
-            created_at=datetime.now(timezone.utc)
-        )
-        db.add(new_notif)
-        
+    # Emergência é urgente: ignora o resguardo dos demais membros
+    created = notifier.notify_family(
+        db, user.family_unit_id,
+        f"🚨 ALERTA GERAL: {user.full_name}", base_msg, "error",
+        audience="others", actor_id=user.id, priority="urgent"
+    )
     db.commit()
-    return {"message": "Emergency broadcasted successfully", "receivers": len(other_members)}
+    return {"message": "Emergency broadcasted successfully", "receivers": len(created)}
@@ -1,161 +1,213 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from starlette.background import BackgroundTask
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from .auth import verify_token, check_family_access
 from database import get_db
-from models import EventLog, Report
-from datetime import datetime, timezone
+from models import Report, ReportJob, FamilyMember
+from report_builder import canvas, build_report, report_fingerprint, find_cached_report, parse_date_range
+from report_jobs import enqueue_report, enqueue_batch, batch_manifest, serialize_job, serialize_cached_report
+from batch_reports import batch_filters, BATCH_MAX_FAMILIES
+from report_verification import verify_report_hash, verify_limiter, is_sha256, client_ip
 from hashlib import sha256
+from datetime import datetime
+from typing import List, Optional
+import storage
+import json
 import os
-try:
-    from reportlab.pdfgen import canvas
-except ImportError:
-    canvas = None
-    print("WARNING: reportlab not installed. PDF generation disabled.")
 
 router = APIRouter()
 
+# Relatórios até este tamanho podem ser devolvidos na própria requisição (?inline=true)
+REPORT_INLINE_MAX_BYTES = int(os.environ.get("REPORT_INLINE_MAX_BYTES", 2 * 1024 * 1024))
+# Limite do PDF enviado para verificação pública
+REPORT_VERIFY_MAX_BYTES = int(os.environ.get("REPORT_VERIFY_MAX_BYTES", 50 * 1024 * 1024))
+
 class ReportRequest(BaseModel):
     name: str
     filters: dict
 
-@router.post("/reports")
-def generate_report(request: ReportRequest, db: Session = Depends(get_db), user = Depends(verify_token)):
+@router.post("/reports", status_code=status.HTTP_202_ACCEPTED)
+def generate_report(request: ReportRequest, inline: bool = False, db: Session = Depends(get_db), user = Depends(verify_token)):
+    """
+    Enfileira a geração do relatório e retorna o job para acompanhamento via polling.
+    Filtros: include_events, include_expenses, include_checkins, include_appointments,
+    start_date e end_date (ISO 8601). Sem período, inclui todo o histórico.
+    Com ?inline=true o relatório é gerado nesta requisição e, se for pequeno, o PDF
+    é devolvido diretamente (headers X-Report-Id e X-Report-Hash).
+    """
     # Security Check
     if user.family_unit_id:
         check_family_access(db, user.id, user.family_unit_id)
     
-    # Ensure reports directory exists
     if not canvas:
         raise HTTPException(status_code=503, detail="PDF generation service unavailable (reportlab missing)")
-    os.makedirs("reports", exist_ok=True)
-    
-    # Fetch context
-    from models import Expense
-    
-    events = []
-    if request.filters.get("include_events"):
-        events = db.query(EventLog).filter(EventLog.family_unit_id == user.family_unit_id).order_by(EventLog.created_at.desc()).limit(100).all()
-    
-    expenses = []
-    if request.filters.get("include_expenses"):
-        expenses = db.query(Expense).filter(Expense.family_unit_id == user.family_unit_id).order_by(Expense.created_at.desc()).limit(50).all()
 
-    # IA Executive Summary
-    ai_summary = ""
     try:
-        from ai_utils import gemini_client
-        context_text = f"Análise de convivência para a família {user.full_name}.\n"
-        context_text += "Eventos recentes:\n" + "\n".join([f"- {e.event_type}: {e.event_data[:100]}" for e in events])
-        context_text += "\nDespesas recentes:\n" + "\n".join([f"- {ex.description}: R$ {ex.amount}" for ex in expenses])
-        
-        prompt = f"""
-        Você é um mediador de conflitos familiar de alto nível.
-        Analise os seguintes dados de convivência e finanças e escreva um "Sumário Executivo do Mediador" de no máximo 5 linhas.
-        O tom deve ser profissional, neutro e focado em destacar a colaboração ou pontos que precisam de atenção diplomática.
-        Este sumário será lido por um Juiz ou Mediador.
-        
-        DADOS:
-        {context_text}
-        """
-        ai_summary = gemini_client.generate_content(prompt)
-    except Exception as e:
-        ai_summary = "Sumário IA indisponível no momento."
-
-    # Generate PDF
-    file_name = f"relatorio_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-    pdf_path = f"reports/{file_name}"
-    
-    c = canvas.Canvas(pdf_path)
-    c.setFont("Helvetica-Bold", 16)
-    c.drawString(40, 800, "MEDIARE - Relatório Auditado de Compliance Familiar")
-    c.setFont("Helvetica", 10)
-    c.drawString(40, 780, f"Nome do Documento: {request.name}")
-    c.drawString(40, 765, f"Data de Geração: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
-    c.drawString(40, 750, f"Gerado por: {user.full_name}")
-    c.line(40, 745, 550, 745)
-
-    y = 730
-    if ai_summary:
-        c.setFont("Helvetica-BoldOblique", 11)
-        c.setFillColorRGB(0.1, 0.4, 0.8) # Blueish for AI section
-        c.drawString(40, y, "PARECER AUTOMÁTICO DO MEDIADOR (IA):")
-        y -= 15
-        c.setFont("Helvetica-Oblique", 10)
-        c.setFillColorRGB(0, 0, 0)
-        
-        # Simple text wrap for summary
-        summary_lines = [ai_summary[i:i+95] for i in range(0, len(ai_summary), 95)]
-        for line in summary_lines:
-             c.drawString(45, y, line)
-             y -= 12
-        y -= 10
-
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(40, y, "Atividades e Registros:")
-    y -= 25
-    
-    c.setFont("Helvetica", 9)
-    if not events and not expenses:
-        c.drawString(40, y, "Nenhum dado selecionado ou encontrado no período.")
-    
-    # Render Events
-    if events:
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(40, y, "EVENTOS DE CONVIVÊNCIA E TROCAS")
-        y -= 15
-        c.setFont("Helvetica", 8)
-        for event in events:
-            c.drawString(40, y, f"[{event.created_at.strftime('%d/%m/%Y %H:%M')}] {event.event_type.upper()}: {event.event_data[:120]}")
-            y -= 12
-            if y < 80:
-                c.showPage()
-                y = 800
-                c.setFont("Helvetica", 8)
-
-    # Render Expenses
-    if expenses:
-        if y < 150:
-            c.showPage()
-            y = 800
-        y -= 20
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(40, y, "DESPESAS E MOVIMENTAÇÕES FINANCEIRAS")
-        y -= 15
-        c.setFont("Helvetica", 8)
-        for exp in expenses:
-            status = exp.status
-            c.drawString(40, y, f"[{exp.created_at.strftime('%d/%m/%Y')}] {exp.description}: R$ {exp.amount:.2f} ({status})")
-            y -= 12
-            if y < 80:
-                c.showPage()
-                y = 800
-                c.setFont("Helvetica", 8)
-
-    # Temporary save to calculate hash
-    c.save()
-
-    with open(pdf_path, "rb") as pdf_file:
-        pdf_content = pdf_file.read()
-        pdf_hash = sha256(pdf_content).hexdigest()
-
-    # Re-save with hash footer (simplified for MVP: we just record it in DB)
-    # The real approach would be signing the PDF bytes after generation
-    
-    # Save report to database
-    report = Report(
-        name=request.name,
-        filters=str(request.filters),
-        pdf_url=f"/reports/{file_name}", # Local relative path for front serving
-        hash_sha256=pdf_hash,
-        created_at=datetime.now(timezone.utc),
-        family_unit_id=user.family_unit_id
-    )
-    db.add(report)
-    db.commit()
-    db.refresh(report)
-
-    return {"message": "Report generated successfully", "report_id": report.id, "hash": pdf_hash, "url": report.pdf_url}
+        parse_date_range(request.filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Filtro de período inválido: {e}")
+
+    # Mesma família, mesmos filtros e nenhum dado novo: devolve o relatório já gerado
+    fingerprint = report_fingerprint(db, user.family_unit_id, request.filters, request.name, user.id, user.full_name)
+    cached = find_cached_report(db, user.family_unit_id, fingerprint)
+    if cached:
+        content = storage.load_bytes(cached.pdf_url) if inline else None
+        if content is not None and len(content) <= REPORT_INLINE_MAX_BYTES:
+            return Response(content=content, media_type="application/pdf", headers={
+                "Content-Disposition": f'inline; filename="{os.path.basename(cached.pdf_url)}"',
+                "X-Report-Id": str(cached.id),
+                "X-Report-Hash": cached.hash_sha256,
+                "X-Report-Cache": "hit"
+            })
+        return JSONResponse(status_code=status.HTTP_200_OK, content=serialize_cached_report(cached))
+
+    if inline:
+        report, pdf = build_report(db, user.family_unit_id, user.full_name, request.name, request.filters, author_id=user.id)
+        if pdf.size > REPORT_INLINE_MAX_BYTES:
+            pdf.close()
+            return JSONResponse(status_code=status.HTTP_201_CREATED, content={
+                "message": "Report generated successfully",
+                "report_id": report.id,
+                "hash": report.hash_sha256,
+                "url": report.pdf_url
+            })
+        return StreamingResponse(
+            pdf.iter_chunks(),
+            media_type="application/pdf",
+            headers={
+                "Content-Length": str(pdf.size),
+                "Content-Disposition": f'inline; filename="{os.path.basename(report.pdf_url)}"',
+                "X-Report-Id": str(report.id),
+                "X-Report-Hash": report.hash_sha256
+            },
+            background=BackgroundTask(pdf.close)
+        )
+
+    job = enqueue_report(db, user, request.name, request.filters, fingerprint)
+    return {
+        "message": "Report generation queued",
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/reports/jobs/{job.id}"
+    }
+
+class BatchReportRequest(BaseModel):
+    family_ids: List[int]
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    filters: Optional[dict] = None
+
+def _denied_families(db: Session, user_id: int, family_ids: list) -> list:
+    # Security Check: uma única consulta para todas as famílias do lote
+    allowed = {
+        family_id for (family_id,) in db.query(FamilyMember.family_id).filter(
+            FamilyMember.user_id == user_id,
+            FamilyMember.family_id.in_(family_ids)
+        )
+    }
+    return [family_id for family_id in family_ids if family_id not in allowed]
+
+@router.post("/reports/batch", status_code=status.HTTP_202_ACCEPTED)
+def generate_batch_reports(request: BatchReportRequest, db: Session = Depends(get_db), user = Depends(verify_token)):
+    """
+    Gera os dossiês de várias famílias de uma vez (mediadores/escritórios).
+    Enfileira o lote e retorna na hora; as famílias são renderizadas em paralelo no pool de
+    processos e o manifesto sai em /reports/batch/{batch_id}.
+    """
+    if not canvas:
+        raise HTTPException(status_code=503, detail="PDF generation service unavailable (reportlab missing)")
+
+    family_ids = list(dict.fromkeys(request.family_ids))
+    if not family_ids:
+        raise HTTPException(status_code=400, detail="Informe ao menos uma família")
+    if len(family_ids) > BATCH_MAX_FAMILIES:
+        raise HTTPException(status_code=400, detail=f"Máximo de {BATCH_MAX_FAMILIES} famílias por lote")
+
+    filters = batch_filters(request.start_date, request.end_date, request.filters)
+    try:
+        parse_date_range(filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Filtro de período inválido: {e}")
+
+    denied = _denied_families(db, user.id, family_ids)
+    if denied:
+        raise HTTPException(status_code=403, detail=f"Acesso negado às famílias: {denied}")
+
+    name = f"Dossiê em lote {datetime.now().strftime('%d/%m/%Y')}"
+    batch_id = enqueue_batch(db, user, name, filters, family_ids)
+    return {
+        "message": "Batch report generation queued",
+        "batch_id": batch_id,
+        "status_url": f"/reports/batch/{batch_id}"
+    }
+
+@router.get("/reports/batch/{batch_id}")
+def get_batch_manifest(batch_id: str, db: Session = Depends(get_db), user = Depends(verify_token)):
+    """Manifesto do lote: report_id e hash de cada família concluída; `pending` chega a 0 no fim."""
+    jobs = db.query(ReportJob).filter(ReportJob.batch_id == batch_id, ReportJob.user_id == user.id).all()
+    if not jobs:
+        raise HTTPException(status_code=404, detail="Report batch not found")
+    manifest = batch_manifest(jobs, json.loads(jobs[0].filters))
+    manifest["batch_id"] = batch_id
+    return manifest
+
+def _verify_rate_limit(request: Request):
+    """Endpoints de verificação são públicos: limita por IP (atrás de proxy confiável, o do X-Forwarded-For)."""
+    peer = request.client.host if request.client else "unknown"
+    retry_after = verify_limiter.hit(client_ip(peer, request.headers.get("x-forwarded-for")))
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Muitas verificações, tente novamente em instantes",
+            headers={"Retry-After": str(int(retry_after) + 1)}
+        )
+
+@router.get("/reports/verify/{report_hash}", dependencies=[Depends(_verify_rate_limit)])
+def verify_report_by_hash(report_hash: str, db: Session = Depends(get_db)):
+    """Confirma se um SHA-256 corresponde a um relatório emitido pelo MEDIARE (sem autenticação)."""
+    report_hash = report_hash.strip().lower()
+    if not is_sha256(report_hash):
+        raise HTTPException(status_code=400, detail="Hash SHA-256 inválido")
+    return verify_report_hash(db, report_hash)
+
+@router.post("/reports/verify", dependencies=[Depends(_verify_rate_limit)])
+async def verify_report_upload(request: Request, db: Session = Depends(get_db)):
+    """
+    Recebe o PDF no corpo da requisição (application/pdf) e o hasheia enquanto chega,
+    sem gravar nem manter o arquivo em memória.
+    """
+    digest = sha256()
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > REPORT_VERIFY_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="Arquivo muito grande para verificação")
+        digest.update(chunk)
+    if not size:
+        raise HTTPException(status_code=400, detail="Envie o PDF no corpo da requisição")
+    # Consulta (e eventual recarga do filtro de Bloom) fora do event loop
+    return await run_in_threadpool(verify_report_hash, db, digest.hexdigest())
+
+@router.get("/reports/jobs")
+def list_report_jobs(db: Session = Depends(get_db), user = Depends(verify_token)):
+    jobs = db.query(ReportJob).filter(ReportJob.family_unit_id == user.family_unit_id).order_by(ReportJob.created_at.desc()).limit(20).all()
+    return {"jobs": [serialize_job(job) for job in jobs]}
+
+@router.get("/reports/jobs/{job_id}")
+def get_report_job(job_id: str, db: Session = Depends(get_db), user = Depends(verify_token)):
+    """Status e progresso (0-100) de um job. Quando concluído inclui report_id, hash e url."""
+    # Jobs de lote são de outras famílias: quem os pediu também acompanha
+    job = db.query(ReportJob).filter(
+        ReportJob.id == job_id,
+        or_(ReportJob.family_unit_id == user.family_unit_id, ReportJob.user_id == user.id)
+    ).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    return serialize_job(job)
 
 @router.get("/reports")
 def list_reports(db: Session = Depends(get_db), user = Depends(verify_token)):
@@ -170,21 +222,20 @@ def list_reports(db: Session = Depends(get_db), user = Depends(verify_token)):
 def download_report(report_id: int, db: Session = Depends(get_db), user = Depends(verify_token)):
     from fastapi.responses import FileResponse
     
-    report = db.query(Report).filter(
-        Report.id == report_id,
-        Report.family_unit_id == user.family_unit_id
-    ).first()
-    if not report:
+    report = db.query(Report).filter(Report.id == report_id).first()
+    # Relatórios de lote são de outras famílias: vale ser membro da família do relatório
+    if not report or (report.family_unit_id != user.family_unit_id and _denied_families(db, user.id, [report.family_unit_id])):
         raise HTTPException(status_code=404, detail="Report not found")
     
-    # Resolve local file path
     url = report.pdf_url
-    if url.startswith("/"):
-        url = url.lstrip("/")
-    
-    local_path = os.path.join(os.getcwd(), url)
+    if url.startswith("s3://"):
+        if not storage.s3_client:
+            raise HTTPException(status_code=500, detail="S3 configuration missing for this file")
+        return {"url": storage.presigned_url(url), "type": "s3_presigned"}
+
+    local_path = storage.local_path(url)
     
     if os.path.exists(local_path):
         return FileResponse(local_path, media_type="application/pdf", filename=os.path.basename(local_path))
     
-    raise HTTPException(status_code=404, detail="Report file not found on disk")
\ No newline at end of file
+    raise HTTPException(status_code=404, detail="Report file not found on disk")
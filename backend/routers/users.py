@@ -6,6 +6,7 @@ from routers.auth import get_current_user, verify_firebase_token
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 import datetime
+import push
 
 router = APIRouter(prefix="/users", tags=["Users"])
 security = HTTPBearer()
@@ -18,10 +19,12 @@ class UserResponse(BaseModel):
     profile_picture: str | None = None
     onboarding_completed: bool
     resguardo_active: bool
+    resguardo_digest: bool = False
 
 class UserProfileUpdate(BaseModel):
     full_name: str | None = None
     resguardo_active: bool | None = None
+    resguardo_digest: bool | None = None  # Em resguardo, receber um resumo agendado das notificações
 
 @router.post("/sync")
 def sync_user(
@@ -81,7 +84,8 @@ def get_me(current_user: User = Depends(get_current_user)):
         "cpf": current_user.cpf,
         "profile_picture": current_user.profile_picture,
         "onboarding_completed": current_user.onboarding_completed,
-        "resguardo_active": current_user.resguardo_active
+        "resguardo_active": current_user.resguardo_active,
+        "resguardo_digest": bool(current_user.resguardo_digest)
     }
 
 @router.put("/profile")
@@ -94,8 +98,14 @@ def update_profile(
         current_user.full_name = data.full_name
     if data.resguardo_active is not None:
         current_user.resguardo_active = data.resguardo_active
+        if not data.resguardo_active:
+            # Fim do resguardo: entrega já o resumo do que ficou guardado
+            push.enqueue_digests(db, [current_user.id])
+    if data.resguardo_digest is not None:
+        current_user.resguardo_digest = data.resguardo_digest
         
     db.commit()
+    push.push_worker.wake()
     return {"message": "Profile updated successfully"}
 
 @router.get("/me/families")
@@ -0,0 +1,72 @@
+import os
+import shutil
+import boto3
+
+# Camada de armazenamento de arquivos: S3 quando configurado, disco local como fallback.
+# As URLs persistidas no banco seguem o formato "s3://bucket/pasta/arquivo" ou "/pasta/arquivo".
+S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME", "mediare-documents")
+s3_client = boto3.client('s3') if 'AWS_ACCESS_KEY_ID' in os.environ else None
+
+
+def local_path(url: str) -> str:
+    """Resolve uma URL local ("/expenses/x.jpg") para o caminho em disco."""
+    return os.path.join(os.getcwd(), url.lstrip("/"))
+
+
+def save_bytes(folder: str, filename: str, content: bytes, content_type: str = None) -> str:
+    """Persiste o conteúdo e retorna a URL que deve ser gravada no banco."""
+    key = f"{folder}/{filename}"
+    if s3_client:
+        extra = {"ContentType": content_type} if content_type else {}
+        s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=key, Body=content, **extra)
+        return f"s3://{S3_BUCKET_NAME}/{key}"
+
+    os.makedirs(os.path.join(os.getcwd(), folder), exist_ok=True)
+    with open(local_path(key), "wb") as buffer:
+        buffer.write(content)
+    return f"/{key}"
+
+
+def save_stream(folder: str, filename: str, fileobj, content_type: str = None) -> str:
+    """Como save_bytes, mas copia de um arquivo/buffer em blocos sem carregá-lo inteiro."""
+    key = f"{folder}/{filename}"
+    fileobj.seek(0)
+    if s3_client:
+        extra = {"ContentType": content_type} if content_type else {}
+        s3_client.upload_fileobj(fileobj, S3_BUCKET_NAME, key, ExtraArgs=extra)
+        return f"s3://{S3_BUCKET_NAME}/{key}"
+
+    os.makedirs(os.path.join(os.getcwd(), folder), exist_ok=True)
+    with open(local_path(key), "wb") as buffer:
+        shutil.copyfileobj(fileobj, buffer)
+    return f"/{key}"
+
+
+def load_bytes(url: str):
+    """Lê o conteúdo de uma URL de armazenamento. Retorna None se não existir."""
+    if url.startswith("s3://"):
+        if not s3_client:
+            return None
+        bucket = url.split("/")[2]
+        key = "/".join(url.split("/")[3:])
+        try:
+            return s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        except Exception as e:
+            print(f"Storage Erro (load_bytes): {e}")
+            return None
+
+    path = local_path(url)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def presigned_url(url: str, expires_in: int = 3600) -> str:
+    bucket = url.split("/")[2]
+    key = "/".join(url.split("/")[3:])
+    return s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket, 'Key': key},
+        ExpiresIn=expires_in
+    )
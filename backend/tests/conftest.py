@@ -2,6 +2,7 @@ import sys
 import os
 import pytest
 import tempfile
+import uuid
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
@@ -14,7 +15,7 @@ if backend_path not in sys.path:
 
 from main import app
 from database import Base, get_db
-from routers.auth import verify_token
+from routers.auth import verify_token, get_websocket_user
 from models import User, FamilyUnit, FamilyMember, FamilyChat, Child
 
 # Global variable to store temp DB path
@@ -103,7 +104,49 @@ def client(db_session):
 
     app.dependency_overrides[get_db] = override_get_db
     app.dependency_overrides[verify_token] = override_verify_token
+    app.dependency_overrides[get_websocket_user] = override_verify_token
     
     c = TestClient(app)
     c.headers.update({"Authorization": "Bearer mock_token"})
     yield c
+
+@pytest.fixture
+def make_family(db_session):
+    """
+    Fábrica de famílias para os testes: make_family(members, name=..., family_id=..., include_default_user=...).
+    `members` mapeia apelido -> papel ("parent", "child") ou (papel, campos extras do User).
+    Sem family_id cria uma família nova. Retorna (family_id, {apelido: user_id}).
+    """
+    # Vínculos do usuário 1 e em famílias já existentes mudariam contagens de outros testes: desfeitos no fim
+    links = []
+
+    def make(members: dict, name: str = "Test Household", family_id: int = None, include_default_user: bool = False):
+        shared = family_id is not None
+        if not shared:
+            family = FamilyUnit(name=name, mode="collaborative")
+            db_session.add(family)
+            db_session.commit()
+            family_id = family.id
+            if include_default_user:
+                db_session.add(FamilyMember(user_id=1, family_id=family_id, role="parent"))
+                links.append((family_id, 1))
+        ids = {}
+        for alias, spec in members.items():
+            role, fields = (spec, {}) if isinstance(spec, str) else spec
+            tag = uuid.uuid4()
+            user = User(email=f"{alias}-{tag.hex[:12]}@example.com", full_name=alias, cpf=str(tag.int)[:11],
+                        hashed_password="hash", family_unit_id=family_id, **fields)
+            db_session.add(user)
+            db_session.flush()
+            db_session.add(FamilyMember(user_id=user.id, family_id=family_id, role=role))
+            ids[alias] = user.id
+            if shared:
+                links.append((family_id, user.id))
+        db_session.commit()
+        return family_id, ids
+
+    yield make
+    db_session.rollback()
+    for family_id, user_id in links:
+        db_session.query(FamilyMember).filter(FamilyMember.family_id == family_id, FamilyMember.user_id == user_id).delete()
+    db_session.commit()
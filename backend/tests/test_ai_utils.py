@@ -0,0 +1,149 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import ai_utils
+from ai_utils import gemini_client, cancel_on_disconnect, ClientDisconnected
+
+
+class FakeModels:
+    def __init__(self, responses=(), delay=0.0):
+        self.responses = list(responses)
+        self.delay = delay
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+
+    async def generate_content(self, model, contents):
+        self.calls += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            result = self.responses.pop(0) if self.responses else "ok"
+            if isinstance(result, Exception):
+                raise result
+            return SimpleNamespace(text=result)
+        finally:
+            self.active -= 1
+
+
+@pytest.fixture
+def fake_models(monkeypatch):
+    def install(*args, **kwargs):
+        models = FakeModels(*args, **kwargs)
+        monkeypatch.setattr(gemini_client, "client", SimpleNamespace(aio=SimpleNamespace(models=models)))
+        return models
+    monkeypatch.setattr(ai_utils, "AI_RETRY_BASE_SECONDS", 0.01)
+    return install
+
+
+def test_retries_transient_errors(fake_models):
+    models = fake_models([httpx.ConnectError("falhou"), '```json\n{"status": "allowed"}\n```'])
+    assert asyncio.run(gemini_client.analyze_json_async("prompt")) == {"status": "allowed"}
+    assert models.calls == 2
+
+
+def test_gives_up_after_max_retries(fake_models):
+    models = fake_models([httpx.ConnectError("falhou")] * 10)
+    assert asyncio.run(gemini_client.generate_content_async("prompt")) is None
+    assert models.calls == ai_utils.AI_MAX_RETRIES + 1
+
+
+def test_deadline_returns_none(fake_models):
+    fake_models(delay=1.0)
+    assert asyncio.run(gemini_client.generate_content_async("prompt", timeout=0.05)) is None
+
+
+def test_per_family_concurrency_limit(fake_models, monkeypatch):
+    monkeypatch.setattr(ai_utils, "AI_MAX_CONCURRENCY_PER_FAMILY", 2)
+    models = fake_models(delay=0.02)
+
+    async def burst():
+        return await asyncio.gather(*[gemini_client.generate_content_async("p", family_id=7) for _ in range(6)])
+
+    assert asyncio.run(burst()) == ["ok"] * 6
+    assert models.max_active == 2
+
+
+def test_cancel_on_disconnect():
+    cancelled = asyncio.Event()
+
+    async def slow_call():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    class DisconnectedRequest:
+        async def is_disconnected(self):
+            return True
+
+    async def scenario():
+        with pytest.raises(ClientDisconnected):
+            await cancel_on_disconnect(DisconnectedRequest(), slow_call(), poll_interval=0.01)
+        await asyncio.sleep(0)
+        return cancelled.is_set()
+
+    assert asyncio.run(scenario())
+
+
+@pytest.fixture
+def fresh_cache(monkeypatch):
+    cache = ai_utils.AIResponseCache(max_entries=2)
+    monkeypatch.setattr(ai_utils, "ai_cache", cache)
+    return cache
+
+
+def test_cache_single_flight_and_normalized_prompt(fake_models, fresh_cache):
+    models = fake_models(['{"insight": "a"}'], delay=0.05)
+
+    async def burst():
+        return await asyncio.gather(*[
+            gemini_client.analyze_json_async("Analise   a família\n 1" if i % 2 else "Analise a família 1", cache_ttl=60)
+            for i in range(5)
+        ])
+
+    assert asyncio.run(burst()) == [{"insight": "a"}] * 5
+    assert models.calls == 1
+    assert asyncio.run(gemini_client.analyze_json_async("Analise a família 1", cache_ttl=60)) == {"insight": "a"}
+    assert models.calls == 1
+    # Sem cache_ttl a chamada vai sempre ao modelo
+    asyncio.run(gemini_client.analyze_json_async("Analise a família 1"))
+    assert models.calls == 2
+
+
+def test_cache_ttl_lru_and_failures(fake_models, fresh_cache, monkeypatch):
+    models = fake_models([None, "r1", "r2", "r3", "r4"])
+    call = lambda prompt, ttl=60: asyncio.run(gemini_client.generate_content_async(prompt, cache_ttl=ttl))
+
+    assert call("p1") is None          # falha não é cacheada
+    assert call("p1") == "r1"
+    assert call("p2") == "r2"
+    assert call("p1") == "r1"          # p1 vira o mais recente
+    assert call("p3") == "r3"          # LRU com 2 entradas: p2 sai
+    assert call("p2") == "r4"
+    assert models.calls == 5
+
+    now = time.monotonic()
+    monkeypatch.setattr(ai_utils.time, "monotonic", lambda: now + 120)
+    models.responses = ["r5"]
+    assert call("p1") == "r5"
+
+
+def test_single_flight_cancelled_when_all_waiters_leave(fake_models, fresh_cache):
+    models = fake_models(delay=5)
+
+    async def scenario():
+        waiter = asyncio.ensure_future(gemini_client.generate_content_async("lento", cache_ttl=60))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        return fresh_cache._inflight
+
+    assert asyncio.run(scenario()) == {}
+    assert models.active == 0
@@ -0,0 +1,170 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+import audit_chain
+from models import EventLog, EventLogCheckpoint, FamilyUnit
+
+
+def _new_family(db_session):
+    family = FamilyUnit(name="Audit Family", mode="collaborative")
+    db_session.add(family)
+    db_session.commit()
+    return family.id
+
+
+def _add_events(db_session, family_id, count, base=datetime(2022, 5, 1, 8, 0)):
+    db_session.add_all([
+        EventLog(event_type="check-in", event_data={"status": f"Evento {i}"}, family_unit_id=family_id,
+                 created_at=base + timedelta(hours=i))
+        for i in range(count)
+    ])
+    db_session.commit()
+
+
+def test_events_are_chained_and_checkpointed(db_session, monkeypatch):
+    monkeypatch.setattr(audit_chain, "CHECKPOINT_SIZE", 4)
+    family_id = _new_family(db_session)
+    _add_events(db_session, family_id, 3)
+    _add_events(db_session, family_id, 6, base=datetime(2022, 5, 2, 8, 0))
+
+    entries = db_session.query(EventLog).filter(EventLog.family_unit_id == family_id).order_by(EventLog.seq).all()
+    assert [e.seq for e in entries] == list(range(1, 10))
+    assert entries[0].prev_hash == audit_chain.GENESIS_HASH
+    assert all(b.prev_hash == a.entry_hash for a, b in zip(entries, entries[1:]))
+
+    checkpoints = db_session.query(EventLogCheckpoint).filter(
+        EventLogCheckpoint.family_unit_id == family_id
+    ).order_by(EventLogCheckpoint.start_seq).all()
+    assert [(c.start_seq, c.end_seq) for c in checkpoints] == [(1, 4), (5, 8)]
+    assert checkpoints[1].merkle_root == audit_chain.merkle_root([e.entry_hash for e in entries[4:8]])
+
+    proof = audit_chain.proof_for_entry(db_session, entries[5])
+    assert proof["content_valid"] and proof["proof_valid"]
+    assert len(proof["proof"]) == 2
+
+    sealed = audit_chain.seal_checkpoint(db_session, family_id)
+    assert (sealed.start_seq, sealed.end_seq) == (9, 9)
+    assert audit_chain.seal_checkpoint(db_session, family_id) is None
+
+
+def test_merkle_proof_odd_leaf_count():
+    leaves = [audit_chain.compute_entry_hash(audit_chain.GENESIS_HASH, 1, i, "t", str(i), datetime(2022, 1, 1)) for i in range(7)]
+    root = audit_chain.merkle_root(leaves)
+    for index, leaf in enumerate(leaves):
+        assert audit_chain.verify_proof(leaf, audit_chain.merkle_proof(leaves, index), root)
+    assert not audit_chain.verify_proof(leaves[0], audit_chain.merkle_proof(leaves, 1), root)
+
+
+def test_verify_range_detects_tampering(db_session, monkeypatch):
+    monkeypatch.setattr(audit_chain, "CHECKPOINT_SIZE", 4)
+    family_id = _new_family(db_session)
+    _add_events(db_session, family_id, 10)
+
+    result = audit_chain.verify_range(db_session, family_id)
+    assert result["intact"] and result["checked_entries"] == 10
+
+    # Período dentro do primeiro bloco: o segundo bloco nem é lido
+    ranged = audit_chain.verify_range(db_session, family_id, datetime(2022, 5, 1, 8, 0), datetime(2022, 5, 1, 10, 0))
+    assert ranged["intact"] and ranged["checked_entries"] == 4
+
+    target = db_session.query(EventLog).filter(EventLog.family_unit_id == family_id, EventLog.seq == 6).one()
+    db_session.execute(text("UPDATE event_log SET event_data = :data WHERE id = :id"),
+                       {"data": '{"status": "alterado"}', "id": target.id})
+    db_session.commit()
+    db_session.expire_all()
+
+    result = audit_chain.verify_range(db_session, family_id)
+    assert not result["intact"]
+    assert {"seq": 6, "event_id": target.id, "error": "conteúdo alterado"} in result["errors"]
+    assert audit_chain.verify_range(db_session, family_id, datetime(2022, 5, 1, 8, 0), datetime(2022, 5, 1, 10, 0))["intact"]
+
+
+def test_verify_range_detects_tail_truncation(db_session, monkeypatch):
+    monkeypatch.setattr(audit_chain, "CHECKPOINT_SIZE", 4)
+    family_id = _new_family(db_session)
+    _add_events(db_session, family_id, 6)
+    assert audit_chain.verify_range(db_session, family_id)["intact"]
+
+    # Apagar a última entrada deixa o resto bem encadeado: só a cabeça denuncia
+    db_session.execute(text("DELETE FROM event_log WHERE family_unit_id = :family AND seq = 6"), {"family": family_id})
+    db_session.commit()
+    result = audit_chain.verify_range(db_session, family_id)
+    assert not result["intact"]
+    assert {"seq": 6, "error": "entradas ausentes no fim da cadeia", "missing_seqs": [6]} in result["errors"]
+
+    # Bloco selado inteiro apagado: o checkpoint também acusa
+    db_session.execute(text("DELETE FROM event_log WHERE family_unit_id = :family AND seq >= 3"), {"family": family_id})
+    db_session.commit()
+    result = audit_chain.verify_range(db_session, family_id, datetime(2022, 5, 1, 0, 0))
+    assert {"seq": 3, "error": "entradas ausentes no fim da cadeia", "missing_seqs": [3, 4, 5, 6]} in result["errors"]
+    # A selagem periódica não fecha um bloco sobre a cadeia truncada
+    assert audit_chain.seal_checkpoint(db_session, family_id) is None
+
+
+def test_audit_endpoints(client, db_session):
+    db_session.add(EventLog(event_type="delay", event_data="Atraso de 10 minutos", family_unit_id=1,
+                            created_at=datetime(2023, 2, 1, 18, 0)))
+    db_session.commit()
+    event = db_session.query(EventLog).filter(EventLog.family_unit_id == 1).order_by(EventLog.seq.desc()).first()
+
+    response = client.get("/audit/verify")
+    assert response.status_code == 200
+    assert response.json()["intact"] is True
+
+    assert client.post("/audit/checkpoints").status_code in (201, 409)
+    response = client.get(f"/audit/events/{event.id}/proof")
+    assert response.status_code == 200
+    assert response.json()["proof_valid"] is True
+
+    assert client.get("/audit/verify?start_date=2023-03-01&end_date=2023-01-01").status_code == 400
+    assert client.get("/audit/events/999999/proof").status_code == 404
+
+
+def test_head_row_serializes_chain(db_session):
+    from models import EventChainHead
+    family_id = _new_family(db_session)
+    _add_events(db_session, family_id, 3)
+
+    head = db_session.query(EventChainHead).filter(EventChainHead.family_unit_id == family_id).one()
+    last = db_session.query(EventLog).filter(EventLog.family_unit_id == family_id).order_by(EventLog.seq.desc()).first()
+    assert (head.seq, head.entry_hash) == (3, last.entry_hash)
+
+    # Uma transação que não chega ao commit não avança a cabeça
+    db_session.add(EventLog(event_type="check-in", event_data={"status": "descartado"}, family_unit_id=family_id,
+                            created_at=datetime(2022, 6, 1)))
+    db_session.flush()
+    db_session.rollback()
+    _add_events(db_session, family_id, 1, base=datetime(2022, 6, 2))
+    assert [e.seq for e in db_session.query(EventLog).filter(EventLog.family_unit_id == family_id)] == [1, 2, 3, 4]
+
+
+def test_backfill_appends_legacy_rows_to_existing_chain(db_session):
+    family_id = _new_family(db_session)
+    _add_events(db_session, family_id, 2)
+    # Linha antiga gravada antes da cadeia existir (sem passar pelo before_flush)
+    db_session.execute(text(
+        "INSERT INTO event_log (event_type, event_data, family_unit_id, created_at) VALUES ('delay', '\"legado\"', :family, :created)"
+    ), {"family": family_id, "created": datetime(2020, 1, 1)})
+    db_session.commit()
+
+    assert audit_chain.backfill_legacy_events(db_session) >= 1
+    legacy = db_session.query(EventLog).filter(EventLog.family_unit_id == family_id, EventLog.event_type == "delay").one()
+    assert legacy.seq == 3
+    assert audit_chain.verify_range(db_session, family_id)["intact"]
+
+
+def test_seal_due_checkpoints(db_session):
+    family_id = _new_family(db_session)
+    _add_events(db_session, family_id, 3)
+
+    assert audit_chain.seal_due_checkpoints(db_session) >= 1
+    checkpoint = db_session.query(EventLogCheckpoint).filter(EventLogCheckpoint.family_unit_id == family_id).one()
+    assert (checkpoint.start_seq, checkpoint.end_seq) == (1, 3)
+
+    # Checkpoint recente: a cauda nova espera o próximo intervalo
+    _add_events(db_session, family_id, 2, base=datetime(2022, 6, 1))
+    audit_chain.seal_due_checkpoints(db_session)
+    assert db_session.query(EventLogCheckpoint).filter(EventLogCheckpoint.family_unit_id == family_id).count() == 1
+    audit_chain.seal_due_checkpoints(db_session, max_age_seconds=0)
+    assert db_session.query(EventLogCheckpoint).filter(EventLogCheckpoint.family_unit_id == family_id).count() == 2
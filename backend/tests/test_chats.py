@@ -1,14 +1,21 @@
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 import os
 import json
+import asyncio
+from datetime import datetime, timezone
+
+import audio_utils
+import pubsub
+from models import ChatMessage, ChatReadWatermark, EventLog, FamilyChat
+from routers.chats import moderate_pending_message, _visible_event
 
 # We rely on conftest.py for client and dependency overrides
 
 def test_send_message_allowed(client, setup_database):
     # Mock Google Generative AI response (if genai_client is used)
     # The routers/chats.py uses ai_utils.gemini_client
-    with patch("ai_utils.gemini_client.analyze_json") as mock_analyze:
+    with patch("ai_utils.gemini_client.analyze_json_async", new_callable=AsyncMock) as mock_analyze:
         mock_analyze.return_value = {"toxicity_score": 0.1, "status": "allowed", "reason": "OK"}
         
         response = client.post(
@@ -18,25 +25,347 @@ def test_send_message_allowed(client, setup_database):
         assert response.status_code == 200
         assert response.json()["moderation_status"] == "allowed"
 
-def test_send_message_blocked_ai(client, setup_database):
-    with patch("ai_utils.gemini_client.analyze_json") as mock_analyze:
+def test_send_message_blocked_ai(client, db_session, setup_database):
+    with patch("ai_utils.gemini_client.analyze_json_async", new_callable=AsyncMock) as mock_analyze:
         mock_analyze.return_value = {"toxicity_score": 0.9, "status": "blocked", "reason": "Ofensivo"}
         
         response = client.post(
             "/chats/messages",
             json={"chat_id": 1, "content": "Você é horrível"}
         )
-        assert response.status_code == 400
-        assert "Mensagem bloqueada" in response.json()["detail"]
+        # Aceita na hora; a moderação roda depois da resposta
+        assert response.status_code == 202
+        assert response.json()["moderation_status"] == "pending"
 
-def test_send_message_fallback(client, setup_database):
+    message = db_session.get(ChatMessage, response.json()["message_id"])
+    db_session.refresh(message)
+    assert message.moderation_status == "blocked"
+    listed = client.get("/chats/messages?chat_id=1&page_size=1000").json()["messages"]
+    assert message.id not in [m["id"] for m in listed]
+
+def test_send_message_fallback(client, db_session, setup_database):
     # Mock analyze_json returning None to trigger fallback
-    with patch("ai_utils.gemini_client.analyze_json") as mock_analyze:
+    with patch("ai_utils.gemini_client.analyze_json_async", new_callable=AsyncMock) as mock_analyze:
         mock_analyze.return_value = None
         
         response = client.post(
             "/chats/messages",
             json={"chat_id": 1, "content": "Seu idiota"}
         )
+        # Ofensa dirigida ao outro vai para a IA; sem resposta, o fallback bloqueia pelo termo forte
+        assert response.status_code == 202
+
+    message = db_session.get(ChatMessage, response.json()["message_id"])
+    db_session.refresh(message)
+    assert message.moderation_status == "blocked"
+
+def test_pending_message_visible_only_to_sender(client, db_session):
+    now = datetime.now(timezone.utc)
+    own = ChatMessage(chat_id=1, sender_id=1, content="Minha pendente", toxicity_score=0.4,
+                      sentiment_score=0.0, moderation_status="pending", created_at=now)
+    other = ChatMessage(chat_id=1, sender_id=999, content="Pendente do outro", toxicity_score=0.4,
+                        sentiment_score=0.0, moderation_status="pending", created_at=now)
+    db_session.add_all([own, other])
+    db_session.commit()
+
+    ids = [m["id"] for m in client.get("/chats/messages?chat_id=1&page_size=1000").json()["messages"]]
+    assert own.id in ids
+    assert other.id not in ids
+
+
+def test_moderation_status_published_to_chat(db_session):
+    message = ChatMessage(chat_id=1, sender_id=1, content="Você é irresponsável", toxicity_score=0.4,
+                          sentiment_score=0.0, moderation_status="pending", created_at=datetime.now(timezone.utc))
+    db_session.add(message)
+    db_session.commit()
+
+    async def scenario():
+        events = await pubsub.broker.subscribe(pubsub.chat_topic(1))
+        try:
+            await moderate_pending_message(db_session.get_bind(), message.id, 1)
+            return await asyncio.wait_for(events.get(), 1)
+        finally:
+            events.close()
+
+    with patch("ai_utils.gemini_client.analyze_json_async", new_callable=AsyncMock) as mock_analyze:
+        mock_analyze.return_value = {"toxicity_score": 0.5, "status": "needs_rewrite", "reason": "Tom acusatório"}
+        event = asyncio.run(scenario())
+
+    assert event["type"] == "message.moderated"
+    assert event["message_id"] == message.id
+    assert event["moderation_status"] == "needs_rewrite"
+    # O outro responsável recebe a mensagem liberada, sem o motivo da moderação
+    visible = _visible_event(event, user_id=2)
+    assert visible["content"] == "Você é irresponsável" and "reason" not in visible
+    db_session.refresh(message)
+    assert message.moderation_status == "needs_rewrite"
+
+
+def test_visible_event_hides_pending_from_other_parent():
+    created = {"type": "message.created", "chat_id": 1, "message_id": 7, "sender_id": 1,
+               "content": "Você é horrível", "moderation_status": "pending", "reason": "Ambígua"}
+    assert _visible_event(created, user_id=1) == created
+    assert _visible_event(created, user_id=2) is None
+    edited = {**created, "type": "message.edited"}
+    assert _visible_event(edited, user_id=2) == {"type": "message.edited", "chat_id": 1, "message_id": 7,
+                                                 "sender_id": 1, "moderation_status": "pending"}
+    assert _visible_event({"type": "typing", "chat_id": 1, "user_id": 1}, user_id=1) is None
+
+
+def test_websocket_pushes_new_and_edited_messages(client):
+    with client.websocket_connect("/chats/1/ws") as ws:
+        snapshot = ws.receive_json()
+        assert snapshot == {"type": "presence.snapshot", "chat_id": 1, "online": [1]}
+
+        ws.send_json({"type": "ping"})
+        assert ws.receive_json() == {"type": "pong"}
+
+        response = client.post("/chats/messages", json={"chat_id": 1, "content": "Chego às 18h com a mochila"})
+        message_id = response.json()["message_id"]
+        event = ws.receive_json()
+        assert event["type"] == "message.created"
+        assert event["message_id"] == message_id
+        assert event["content"] == "Chego às 18h com a mochila"
+
+        response = client.patch(f"/chats/messages/{message_id}", json={"content": "Chego às 19h com a mochila"})
+        assert response.status_code == 200
+        event = ws.receive_json()
+        assert event["type"] == "message.edited"
+        assert event["content"] == "Chego às 19h com a mochila"
+        assert event["edited_at"] is not None
+
+    assert pubsub.broker.online(pubsub.chat_topic(1)) == []
+
+
+def test_redis_publish_does_not_block_the_caller():
+    import threading
+    import time
+    sent = threading.Event()
+
+    class SlowRedis:
+        def publish(self, channel, data):
+            time.sleep(0.2)
+            sent.set()
+
+    broker = pubsub.RedisBroker("redis://localhost:6379/0")
+    broker._redis = SlowRedis()
+    started = time.monotonic()
+    broker.publish(pubsub.chat_topic(1), {"type": "typing", "chat_id": 1, "user_id": 1})
+    # A ida ao Redis fica na thread de envio: o event loop não espera
+    assert time.monotonic() - started < 0.1
+    assert sent.wait(2)
+
+
+def test_edit_message_rules(client, db_session):
+    other = ChatMessage(chat_id=1, sender_id=999, content="Mensagem do outro", toxicity_score=0.0,
+                        sentiment_score=0.0, moderation_status="allowed", created_at=datetime.now(timezone.utc))
+    db_session.add(other)
+    db_session.commit()
+    assert client.patch(f"/chats/messages/{other.id}", json={"content": "x"}).status_code == 403
+
+    message_id = client.post("/chats/messages", json={"chat_id": 1, "content": "Combinado para sábado"}).json()["message_id"]
+    response = client.patch(f"/chats/messages/{message_id}", json={"content": "Seu idiota imbecil"})
+    assert response.status_code == 400
+    # A versão anterior continua valendo
+    assert db_session.get(ChatMessage, message_id).content == "Combinado para sábado"
+
+
+def test_edit_rejected_while_pending_and_history_kept(client, db_session):
+    with patch("ai_utils.gemini_client.analyze_json_async", new_callable=AsyncMock) as mock_analyze:
+        mock_analyze.return_value = {"toxicity_score": 0.1, "status": "allowed", "reason": "OK"}
+        message_id = client.post("/chats/messages", json={"chat_id": 1, "content": "Combinado, até sábado"}).json()["message_id"]
+        response = client.patch(f"/chats/messages/{message_id}", json={"content": "Você esqueceu de novo"})
+        assert response.status_code == 202  # nova versão em moderação
+        pending = ChatMessage(chat_id=1, sender_id=1, content="Você sempre atrasa", toxicity_score=0.2,
+                              sentiment_score=0.0, moderation_status="pending", created_at=datetime.now(timezone.utc))
+        db_session.add(pending)
+        db_session.commit()
+        assert client.patch(f"/chats/messages/{pending.id}", json={"content": "ok"}).status_code == 409
+
+    history = db_session.query(EventLog).filter(
+        EventLog.event_type == "chat_edit", EventLog.reference_id == message_id
+    ).one()
+    assert history.event_data["previous_content"] == "Combinado, até sábado"
+    assert history.actor_user_id == 1
+
+
+def test_moderation_verdict_discarded_if_message_changed(db_session):
+    message = ChatMessage(chat_id=1, sender_id=1, content="Você é irresponsável", toxicity_score=0.4,
+                          sentiment_score=0.0, moderation_status="pending", created_at=datetime.now(timezone.utc))
+    db_session.add(message)
+    db_session.commit()
+
+    async def edited_meanwhile(content, family_id=None):
+        db_session.query(ChatMessage).filter(ChatMessage.id == message.id).update(
+            {"content": "Outro texto", "edited_at": datetime.now(timezone.utc)})
+        db_session.commit()
+        return {"toxicity_score": 0.1, "status": "allowed", "reason": "OK"}
+
+    with patch("moderation.moderation_batcher.analyze", edited_meanwhile):
+        asyncio.run(moderate_pending_message(db_session.get_bind(), message.id, 1))
+    db_session.refresh(message)
+    assert message.moderation_status == "pending"
+
+
+def test_read_watermark_and_unread_count(client, db_session):
+    chat = FamilyChat(family_unit_id=1, created_at=datetime.now(timezone.utc))
+    db_session.add(chat)
+    db_session.commit()
+    now = datetime.now(timezone.utc)
+    incoming = [ChatMessage(chat_id=chat.id, sender_id=999, content=f"Mensagem {i}", toxicity_score=0.0,
+                            sentiment_score=0.0, moderation_status="allowed", created_at=now) for i in range(5)]
+    pending = ChatMessage(chat_id=chat.id, sender_id=999, content="Em moderação", toxicity_score=0.4,
+                          sentiment_score=0.0, moderation_status="pending", created_at=now)
+    own = ChatMessage(chat_id=chat.id, sender_id=1, content="Minha", toxicity_score=0.0,
+                      sentiment_score=0.0, moderation_status="allowed", created_at=now)
+    db_session.add_all(incoming + [pending, own])
+    db_session.commit()
+
+    assert client.get(f"/chats/{chat.id}/unread").json()["unread"] == 5
+
+    assert client.post(f"/chats/messages/{incoming[2].id}/read").status_code == 200
+    assert client.get(f"/chats/{chat.id}/unread").json()["unread"] == 2
+    # Leitura atrasada de uma mensagem anterior não faz a marca voltar
+    client.post(f"/chats/messages/{incoming[0].id}/read")
+    watermark = db_session.query(ChatReadWatermark).filter(
+        ChatReadWatermark.chat_id == chat.id, ChatReadWatermark.user_id == 1
+    ).one()
+    db_session.refresh(watermark)
+    assert watermark.last_read_message_id == incoming[2].id
+
+    client.post(f"/chats/messages/{incoming[4].id}/read")
+    assert client.get(f"/chats/{chat.id}/unread").json()["unread"] == 0
+    assert db_session.query(ChatReadWatermark).filter(ChatReadWatermark.chat_id == chat.id).count() == 1
+    assert client.post("/chats/messages/999999/read").status_code == 404
+
+def test_pending_message_released_after_later_read_stays_unread(client, db_session):
+    chat = FamilyChat(family_unit_id=1, created_at=datetime.now(timezone.utc))
+    db_session.add(chat)
+    db_session.commit()
+    now = datetime.now(timezone.utc)
+    first, pending, later = [ChatMessage(chat_id=chat.id, sender_id=999, content=content, toxicity_score=0.0,
+                                         sentiment_score=0.0, moderation_status=status, created_at=now)
+                             for content, status in (("Oi", "allowed"), ("Em moderação", "pending"), ("Depois", "allowed"))]
+    db_session.add_all([first, pending, later])
+    db_session.commit()
+
+    with patch("pubsub.broker.publish") as publish:
+        assert client.post(f"/chats/messages/{later.id}/read").status_code == 200
+    watermark = db_session.query(ChatReadWatermark).filter(
+        ChatReadWatermark.chat_id == chat.id, ChatReadWatermark.user_id == 1
+    ).one()
+    assert watermark.last_read_message_id == first.id
+    # Os outros participantes recebem a mesma marca, não a mensagem pedida
+    assert publish.call_args.args[1]["last_read_message_id"] == first.id
+
+    async def allowed(content, family_id=None):
+        return {"toxicity_score": 0.1, "status": "allowed", "reason": "OK"}
+
+    with patch("moderation.moderation_batcher.analyze", allowed):
+        asyncio.run(moderate_pending_message(db_session.get_bind(), pending.id, 1))
+    db_session.expire_all()
+    # A liberada aparece como não lida (a posterior também, até a próxima leitura)
+    assert client.get(f"/chats/{chat.id}/unread").json()["unread"] == 2
+    client.post(f"/chats/messages/{later.id}/read")
+    assert client.get(f"/chats/{chat.id}/unread").json()["unread"] == 0
+
+def test_audio_without_ffmpeg_sends_original(client, db_session):
+    with patch("audio_utils.FFMPEG", None), \
+         patch("ai_utils.gemini_client.analyze_audio_async", new_callable=AsyncMock) as mock_audio:
+        mock_audio.return_value = {"transcription": "Busco as crianças às 18h", "toxicity_score": 0.0, "status": "allowed"}
+        response = client.post("/chats/messages/audio", data={"chat_id": 1},
+                               files={"file": ("nota.m4a", b"voz-original", "audio/mp4")})
+    assert response.status_code == 200
+    assert response.json()["transcription"] == "Busco as crianças às 18h"
+    assert mock_audio.await_count == 1
+    assert mock_audio.await_args.args[1] == b"voz-original"
+    assert mock_audio.await_args.kwargs["mime_type"] == "audio/mp4"
+
+def test_audio_segments_transcribed_in_parallel(client, db_session):
+    async def fake_process(fn, path):
+        return [b"seg-1", b"seg-2", b"seg-3"]
+
+    async def fake_analyze(prompt, segment, mime_type, family_id):
+        await asyncio.sleep(0.01)
+        assert mime_type == "audio/ogg" and "trecho" in prompt
+        if segment == b"seg-3" and blocked:
+            return {"transcription": "...", "toxicity_score": 0.9, "status": "blocked", "reason": "Ofensa"}
+        return {"transcription": segment.decode(), "toxicity_score": 0.2, "status": "allowed"}
+
+    with patch("audio_utils.FFMPEG", "ffmpeg"), patch("routers.chats.run_in_process", fake_process), \
+         patch("ai_utils.gemini_client.analyze_audio_async", fake_analyze):
+        blocked = False
+        response = client.post("/chats/messages/audio", data={"chat_id": 1},
+                               files={"file": ("nota.m4a", b"voz", "audio/mp4")})
+        assert response.status_code == 200
+        assert response.json()["transcription"] == "seg-1 seg-2 seg-3"
+
+        blocked = True
+        response = client.post("/chats/messages/audio", data={"chat_id": 1},
+                               files={"file": ("nota.m4a", b"voz", "audio/mp4")})
         assert response.status_code == 400
-        assert "Mensagem bloqueada" in response.json()["detail"]
+        assert "Ofensa" in response.json()["detail"]
+
+def test_audio_segments_moderated_together(client, db_session):
+    # Cada trecho sozinho é inofensivo; a frase inteira é uma ameaça
+    parts = [b"Se voce aparecer", b"aqui de novo", b"voce vai ver so"]
+    analyzed = []
+
+    async def fake_process(fn, path):
+        return parts
+
+    async def fake_analyze(prompt, segment, mime_type, family_id):
+        return {"transcription": segment.decode(), "toxicity_score": 0.1, "status": "allowed"}
+
+    async def fake_moderation(content, family_id=None):
+        analyzed.append(content)
+        return {"toxicity_score": 0.95, "sentiment_score": -0.9, "status": "blocked", "reason": "Ameaça velada"}
+
+    with patch("audio_utils.FFMPEG", "ffmpeg"), patch("routers.chats.run_in_process", fake_process), \
+         patch("ai_utils.gemini_client.analyze_audio_async", fake_analyze), \
+         patch("moderation.moderation_batcher.analyze", fake_moderation):
+        response = client.post("/chats/messages/audio", data={"chat_id": 1},
+                               files={"file": ("nota.m4a", b"voz", "audio/mp4")})
+    assert response.status_code == 400
+    assert "Ameaça velada" in response.json()["detail"]
+    assert analyzed == ["Se voce aparecer aqui de novo voce vai ver so"]
+
+def test_audio_unreadable_moderation_reply_is_not_allowed(client, db_session):
+    analyzed = []
+
+    async def fake_moderation(content, family_id=None):
+        analyzed.append(content)
+        return {"toxicity_score": 0.8, "status": "blocked", "reason": "Tom hostil"}
+
+    with patch("audio_utils.FFMPEG", None), \
+         patch("ai_utils.gemini_client.analyze_audio_async", new_callable=AsyncMock) as mock_audio, \
+         patch("moderation.moderation_batcher.analyze", fake_moderation):
+        # Transcrição sem veredito válido: o texto vai para a moderação em vez de passar direto
+        mock_audio.return_value = {"transcription": "Busco as crianças às 18h", "status": "talvez"}
+        response = client.post("/chats/messages/audio", data={"chat_id": 1},
+                               files={"file": ("nota.m4a", b"voz", "audio/mp4")})
+        assert response.status_code == 400 and "Tom hostil" in response.json()["detail"]
+        assert analyzed == ["Busco as crianças às 18h"]
+
+        # JSON ilegível, lista ou escalar: sem transcrição não há o que moderar
+        for reply in ({"text": "resposta quebrada"}, [{"status": "allowed"}], "allowed"):
+            mock_audio.return_value = reply
+            response = client.post("/chats/messages/audio", data={"chat_id": 1},
+                                   files={"file": ("nota.m4a", b"voz", "audio/mp4")})
+            assert response.status_code == 400
+
+def test_audio_upload_size_limit(client):
+    with patch("routers.chats.AUDIO_MAX_BYTES", 10):
+        response = client.post("/chats/messages/audio", data={"chat_id": 1},
+                               files={"file": ("nota.m4a", b"x" * 100, "audio/mp4")})
+    assert response.status_code == 413
+
+@pytest.mark.skipif(audio_utils.FFMPEG is None, reason="ffmpeg not installed")
+def test_transcode_segments(tmp_path):
+    import subprocess
+    source = tmp_path / "tone.wav"
+    subprocess.run([audio_utils.FFMPEG, "-loglevel", "error", "-f", "lavfi", "-i", "sine=frequency=440:duration=5",
+                    str(source)], check=True)
+    segments = audio_utils.transcode_segments(str(source), segment_seconds=2)
+    assert len(segments) == 3
+    assert sum(map(len, segments)) < source.stat().st_size
@@ -1,4 +1,6 @@
 import pytest
+import time
+import hashlib
 
 def test_health_check(client):
     response = client.get("/health")
@@ -30,11 +32,23 @@ def test_generate_report(client):
             "filters": {"date": "today"}
         }
     )
-    # 200 if reportlab installed, 503 if missing (which is valid for this env)
-    assert response.status_code in [200, 503]
-    if response.status_code == 200:
-        assert "url" in response.json()
-        assert "hash" in response.json()
+    # 202 if reportlab installed, 503 if missing (which is valid for this env), 200 on cache hit
+    assert response.status_code in [200, 202, 503]
+    if response.status_code == 202:
+        job_id = response.json()["job_id"]
+        for _ in range(100):
+            job = client.get(f"/reports/jobs/{job_id}").json()
+            if job["status"] in ("completed", "failed"):
+                break
+            time.sleep(0.05)
+        assert job["status"] == "completed"
+        assert job["progress"] == 100
+        assert "url" in job
+        assert "hash" in job
+
+def test_report_job_not_found(client):
+    response = client.get("/reports/jobs/does-not-exist")
+    assert response.status_code == 404
 
 def test_list_reports(client):
     response = client.get("/reports")
@@ -105,3 +119,49 @@ def test_create_expense(client):
         res = client.get(f"/attachments/expenses/{expense_id}")
         assert res.status_code == 200, f"Status: {res.status_code}, Body: {res.text}"
         assert res.content == b"fake file content"
+
+def test_generate_report_inline(client):
+    response = client.post(
+        "/reports?inline=true",
+        json={"name": "Relatório Inline", "filters": {"include_events": True}}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/pdf"
+    assert response.content.startswith(b"%PDF")
+    assert hashlib.sha256(response.content).hexdigest() == response.headers["x-report-hash"]
+
+    report_id = response.headers["x-report-id"]
+    download = client.get(f"/attachments/reports/{report_id}")
+    assert download.status_code == 200
+    assert download.content == response.content
+
+def test_generate_report_cache_hit_and_invalidation(client, db_session):
+    from models import EventLog
+    from datetime import datetime, timezone
+
+    body = {"name": "Relatório Cache", "filters": {"include_expenses": True, "include_chat": False}}
+    first = client.post("/reports?inline=true", json=body)
+    assert first.status_code == 200
+
+    # Filtros equivalentes (ordem diferente, flag falsa omitida) reaproveitam o mesmo relatório
+    second = client.post("/reports?inline=true", json={"name": "Relatório Cache", "filters": {"include_expenses": True}})
+    assert second.headers["x-report-cache"] == "hit"
+    assert second.headers["x-report-id"] == first.headers["x-report-id"]
+
+    # O nome do documento é impresso no PDF: outro nome gera outro relatório
+    renamed = client.post("/reports?inline=true", json={"name": "Outro nome", "filters": {"include_expenses": True}})
+    assert "x-report-cache" not in renamed.headers
+    assert renamed.headers["x-report-id"] != first.headers["x-report-id"]
+
+    queued = client.post("/reports", json=body)
+    assert queued.status_code == 200
+    assert queued.json()["cached"] is True
+
+    # Um evento novo muda o watermark quando eventos estão incluídos
+    body = {"name": "Relatório Cache", "filters": {"include_events": True, "include_expenses": True}}
+    before = client.post("/reports?inline=true", json=body)
+    db_session.add(EventLog(event_type="check-in", event_data="{}", family_unit_id=1, created_at=datetime.now(timezone.utc)))
+    db_session.commit()
+    after = client.post("/reports?inline=true", json=body)
+    assert "x-report-cache" not in after.headers
+    assert after.headers["x-report-id"] != before.headers["x-report-id"]
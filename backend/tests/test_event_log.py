@@ -0,0 +1,48 @@
+import pytest
+from datetime import datetime
+from pydantic import ValidationError
+
+from event_log import build_event, log_event, describe_event
+from models import EventLog
+
+
+def test_agreement_suggestion_is_logged_as_json(client, db_session):
+    response = client.post("/agreements/suggest", json={
+        "conflict_context": "Troca de fim de semana",
+        "child_name": "Test Child",
+        "family_unit_id": 1
+    })
+    assert response.status_code == 200
+
+    event = db_session.query(EventLog).filter(
+        EventLog.event_type == "ai_agreement_suggested",
+        EventLog.event_data["conflict"].as_string() == "Troca de fim de semana"
+    ).one()
+    assert event.event_data["suggestion"] == response.json()["suggestion"]
+    assert event.child_id == 1
+    assert event.actor_user_id == 1
+
+
+def test_typed_schemas_validate_and_fill_indexed_columns():
+    event = build_event("expense", 1, {"description": "Material escolar", "amount": "120.5", "child_id": 1, "reference_id": 42})
+    assert event.event_data == {"description": "Material escolar", "amount": 120.5, "child_id": 1, "reference_id": 42}
+    assert (event.child_id, event.reference_id, event.actor_user_id) == (1, 42, None)
+    assert describe_event("expense", event.event_data) == "Material escolar (R$ 120.50)"
+
+    with pytest.raises(ValidationError):
+        build_event("expense", 1, {"description": "Sem valor"})
+
+    # Tipos sem esquema específico aceitam qualquer chave; texto legado é exibido como está
+    assert describe_event("custom", {"nota": "x"}) == "nota: x"
+    assert describe_event("check-in", "texto antigo") == "texto antigo"
+
+
+def test_report_filters_events_by_child_in_sql(client, db_session):
+    day = datetime(2018, 6, 1, 10, 0)
+    log_event(db_session, "delay", 1, {"minutes": 15, "reason": "Trânsito da criança", "child_id": 1}, created_at=day)
+    log_event(db_session, "delay", 1, {"minutes": 30, "reason": "Outro assunto"}, created_at=day)
+    db_session.commit()
+
+    from report_builder import _events_query
+    rows = _events_query(db_session, 1, day, datetime(2018, 6, 2), {"child_id": 1}).all()
+    assert [describe_event(r.event_type, r.event_data) for r in rows] == ["Atraso de 15 min: Trânsito da criança"]
@@ -0,0 +1,180 @@
+import io
+import pytest
+from unittest.mock import patch, AsyncMock
+from PIL import Image
+
+from image_utils import process_receipt, prepare_for_ai
+from models import Expense, ReceiptAnalysis
+
+
+def _photo_with_exif(size=(2400, 1200)):
+    """Foto 'deitada' com EXIF de orientação 6 (girar 90°) e tag de GPS."""
+    img = Image.new("RGB", size, (200, 30, 30))
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    exif[0x8825] = {1: "S"}
+    out = io.BytesIO()
+    img.save(out, format="JPEG", exif=exif)
+    return out.getvalue()
+
+
+def test_process_receipt_orients_strips_and_downscales():
+    processed = process_receipt(_photo_with_exif())
+
+    normalized = Image.open(io.BytesIO(processed["normalized"]))
+    assert normalized.size == (1200, 2400)
+    assert not normalized.getexif()
+
+    ai = Image.open(io.BytesIO(processed["ai"]))
+    assert max(ai.size) == 1600
+    assert ai.mode == "L"
+
+    thumb = Image.open(io.BytesIO(processed["thumbnail"]))
+    assert thumb.format == "WEBP"
+    assert thumb.size == (256, 256)
+
+
+def test_process_receipt_ignores_non_images():
+    assert process_receipt(b"%PDF-1.4 not an image") is None
+
+
+def test_create_expense_stores_thumbnail(client, db_session):
+    import storage
+    from hashlib import sha256
+    photo = _photo_with_exif((800, 400))
+    response = client.post(
+        "/expenses",
+        data={"description": "Farmácia", "amount": "42.0", "child_id": "1", "family_unit_id": "1"},
+        files={"file": ("recibo.jpg", photo, "image/jpeg")},
+    )
+    assert response.status_code == 200
+    expense = db_session.query(Expense).filter(Expense.id == response.json()["expense_id"]).first()
+    assert expense.thumbnail_url.endswith(".webp")
+    # O anexo é o arquivo enviado, byte a byte; a versão normalizada é uma derivada à parte
+    assert expense.attachment_hash_sha256 == sha256(photo).hexdigest()
+    assert storage.load_bytes(expense.attachment_url) == photo
+    response = client.get(f"/attachments/expenses/{expense.id}/thumbnail?variant=normalized")
+    assert response.status_code == 200 and response.headers["content-type"] == "image/jpeg"
+    normalized = Image.open(io.BytesIO(response.content))
+    assert normalized.size == (400, 800) and not normalized.getexif()
+
+    response = client.get(f"/attachments/expenses/{expense.id}/thumbnail")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+
+    response = client.get(f"/attachments/expenses/{expense.id}/thumbnail?variant=huge")
+    assert response.status_code == 400
+
+    # Linha aponta para um arquivo que sumiu do disco: 404, não 500
+    expense.preview_url = "/uploads/thumbnails/missing_preview.webp"
+    db_session.commit()
+    response = client.get(f"/attachments/expenses/{expense.id}/thumbnail?variant=preview")
+    assert response.status_code == 404
+
+
+def test_prepare_for_ai_is_grayscale_and_smaller():
+    photo = _photo_with_exif()
+    ai = prepare_for_ai(photo)
+    img = Image.open(io.BytesIO(ai))
+    assert img.mode == "L" and max(img.size) == 1600
+    assert len(ai) < len(photo)
+
+
+def test_receipt_analysis_is_cached_by_content_hash(client, db_session):
+    photo = _photo_with_exif((640, 320))
+    result = {"description": "Farmácia", "amount": 42.0, "date": "2026-10-01", "category": "Saúde"}
+    with patch("ai_utils.gemini_client.analyze_image_async", new_callable=AsyncMock) as mock_image:
+        mock_image.return_value = result
+        for _ in range(2):
+            response = client.post("/expenses/analyze-receipt", files={"file": ("recibo.jpg", photo, "image/jpeg")})
+            assert response.status_code == 200
+            assert response.json() == result
+    assert mock_image.await_count == 1
+    sent = Image.open(io.BytesIO(mock_image.await_args.args[1]))
+    assert sent.mode == "L"
+
+    try:
+        # Cadastro com a mesma foto reaproveita a leitura
+        response = client.post(
+            "/expenses",
+            data={"description": "Farmácia", "amount": "42.0", "child_id": "1", "family_unit_id": "1"},
+            files={"file": ("recibo.jpg", photo, "image/jpeg")},
+        )
+        assert response.json()["receipt_analysis"] == result
+    finally:
+        db_session.query(ReceiptAnalysis).delete()
+        db_session.commit()
+
+
+def test_pack_receipts_fills_calls_within_limits():
+    from routers.expenses import pack_receipts
+    assert pack_receipts([]) == []
+    packs = pack_receipts([5, 1, 4, 2, 3, 6], max_items=3, max_bytes=10)
+    assert sorted(index for pack in packs for index in pack) == list(range(6))
+    assert all(len(pack) <= 3 for pack in packs)
+    assert len(packs) == 3  # 21 bytes não cabem em duas chamadas de 10
+
+
+def test_batch_receipt_analysis(client, db_session):
+    photos = [_photo_with_exif((300 + 10 * i, 200)) for i in range(4)]
+    cached = {"description": "Escola", "amount": 500.0, "date": "2026-09-30", "category": "Educação"}
+
+    async def fake_batch(prompt, images, family_id=None, timeout=None):
+        # Devolve fora de ordem e sem a última imagem, que é lida individualmente
+        return [{"index": n, "description": f"Farmácia {n}", "amount": "10,50", "category": "Saúde"}
+                for n in range(len(images) - 1, 0, -1)]
+
+    try:
+        with patch("ai_utils.gemini_client.analyze_image_async", new_callable=AsyncMock) as mock_image, \
+             patch("ai_utils.gemini_client.analyze_images_async", side_effect=fake_batch) as mock_batch:
+            mock_image.return_value = cached
+            client.post("/expenses/analyze-receipt", files={"file": ("0.jpg", photos[0], "image/jpeg")})
+            mock_image.return_value = {"description": "Uniforme", "amount": 80, "category": "Vestuário"}
+            mock_image.reset_mock()
+            response = client.post(
+                "/expenses/analyze-receipts",
+                data={"child_id": "1"},
+                files=[("files", (f"{i}.jpg", photo, "image/jpeg")) for i, photo in enumerate(photos + [photos[1]])],
+            )
+        assert response.status_code == 200
+        body = response.json()
+        assert body["packs"] == 1 and mock_batch.call_count == 1
+        assert len(mock_batch.call_args.args[1]) == 3  # cacheada e repetida não vão de novo
+        assert mock_image.await_count == 1
+        results = body["results"]
+        assert results[0]["cached"] and results[0]["analysis"] == cached
+        assert [r["analysis"]["description"] for r in results[1:]] == ["Farmácia 1", "Farmácia 2", "Uniforme", "Farmácia 1"]
+        assert len(body["draft"]["expenses"]) == 5
+        assert body["draft"]["expenses"][1] == {"index": 1, "description": "Farmácia 1", "amount": 10.5, "date": None,
+                                                "category": "Saúde", "child_id": 1, "family_unit_id": 1}
+        assert body["draft"]["total_amount"] == 500 + 10.5 * 3 + 80
+        # Leituras do prompt em grupo não entram no cache: só a inicial e a refeita individualmente
+        assert {row.result["description"] for row in db_session.query(ReceiptAnalysis)} == {"Escola", "Uniforme"}
+    finally:
+        db_session.query(ReceiptAnalysis).delete()
+        db_session.commit()
+
+
+def test_pack_results_requires_valid_unique_index():
+    from routers.expenses import _pack_results
+    response = [
+        {"description": "sem índice"},
+        {"index": 2, "description": "dois"},
+        {"index": 3, "description": "três a"},
+        {"index": 3, "description": "três b"},
+        {"index": 9, "description": "fora"},
+        {"index": True, "description": "booleano"},
+    ]
+    assert _pack_results(response, 3) == [None, {"description": "dois"}, None]
+    assert _pack_results({"receipts": [{"index": 1, "amount": 5}]}, 2) == [{"amount": 5}, None]
+    assert _pack_results("texto", 2) == [None, None]
+
+
+def test_batch_receipt_upload_size_cap(client, monkeypatch):
+    import routers.expenses as expenses
+    monkeypatch.setattr(expenses, "RECEIPT_BATCH_MAX_BYTES", 1000)
+    with patch("ai_utils.gemini_client.analyze_images_async", new_callable=AsyncMock) as mock_batch:
+        response = client.post("/expenses/analyze-receipts",
+                               files=[("files", (f"{i}.jpg", b"x" * 600, "image/jpeg")) for i in range(2)])
+    assert response.status_code == 413
+    mock_batch.assert_not_called()
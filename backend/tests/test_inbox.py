@@ -0,0 +1,74 @@
+import pytest
+from datetime import datetime, timezone
+
+import inbox_summary
+from models import ChatMessage, ConversationSummary, FamilyChat, Notification, UserInboxSummary
+from routers.notifications import create_internal_notification
+
+
+@pytest.fixture
+def partner_family(db_session, make_family):
+    family_id, ids = make_family({"partner": "parent"}, name="Inbox Family", include_default_user=True)
+    chat = FamilyChat(family_unit_id=family_id, created_at=datetime.now(timezone.utc))
+    db_session.add(chat)
+    db_session.commit()
+    return family_id, ids["partner"], chat.id
+
+
+def _summary(db_session, user_id):
+    db_session.expire_all()
+    return db_session.query(UserInboxSummary).filter(UserInboxSummary.user_id == user_id).one()
+
+
+def _conversation(db_session, user_id, chat_id):
+    return db_session.query(ConversationSummary).filter(
+        ConversationSummary.user_id == user_id, ConversationSummary.chat_id == chat_id
+    ).one()
+
+
+def test_unread_counters_follow_messages_and_reads(client, db_session, partner_family):
+    family_id, partner_id, chat_id = partner_family
+    baseline = client.get("/inbox/badge").json()["unread_messages"]
+
+    for text in ("Chego às 18h", "Levo a mochila"):
+        assert client.post("/chats/messages", json={"chat_id": chat_id, "content": text}).status_code == 200
+    partner = _summary(db_session, partner_id)
+    assert partner.unread_messages == 2
+    conversation = _conversation(db_session, partner_id, chat_id)
+    assert conversation.unread_count == 2
+    assert conversation.last_message_preview == "Levo a mochila"
+    assert _conversation(db_session, 1, chat_id).unread_count == 0
+
+    reply = ChatMessage(chat_id=chat_id, sender_id=partner_id, content="Combinado! " + "x" * 200, toxicity_score=0.0,
+                        sentiment_score=0.0, moderation_status="allowed", created_at=datetime.now(timezone.utc))
+    db_session.add(reply)
+    db_session.flush()
+    inbox_summary.message_created(db_session, reply)
+    db_session.commit()
+
+    assert client.get("/inbox/badge").json()["unread_messages"] == baseline + 1
+    inbox = client.get("/inbox").json()
+    chat = next(row for row in inbox["chats"] if row["chat_id"] == chat_id)
+    assert chat["unread"] == 1 and chat["last_sender_id"] == partner_id
+    assert len(chat["last_message_preview"]) == inbox_summary.INBOX_PREVIEW_CHARS
+
+    client.post(f"/chats/messages/{reply.id}/read")
+    assert client.get("/inbox/badge").json()["unread_messages"] == baseline
+
+    # Os contadores mantidos batem com o recálculo do zero
+    maintained = _summary(db_session, partner_id).unread_messages
+    assert inbox_summary.rebuild_user(db_session, partner_id).unread_messages == maintained
+    db_session.rollback()
+
+
+def test_notification_counter(client, db_session):
+    before = client.get("/inbox/badge").json()["unread_notifications"]
+    create_internal_notification(db_session, 1, 1, "Lembrete", "Consulta amanhã")
+    badge = client.get("/inbox/badge").json()
+    assert badge["unread_notifications"] == before + 1
+    assert badge["total"] == badge["unread_notifications"] + badge["unread_messages"]
+
+    notification = db_session.query(Notification).filter(Notification.user_id == 1).order_by(Notification.id.desc()).first()
+    client.post(f"/notifications/{notification.id}/read")
+    client.post(f"/notifications/{notification.id}/read")
+    assert client.get("/inbox/badge").json()["unread_notifications"] == before
@@ -0,0 +1,205 @@
+import asyncio
+import pytest
+from datetime import datetime, timedelta, timezone
+
+import inbox_summary
+import notifier
+import pubsub
+from models import Notification
+from routers.notifications import create_internal_notification, notification_stream
+
+
+@pytest.fixture
+def household(make_family):
+    return make_family({
+        "actor": "parent",
+        "partner": "parent",
+        "resting": ("parent", {"resguardo_active": True}),
+        "teen": "child",
+        "gone": ("parent", {"deleted_at": datetime.now(timezone.utc)}),
+    }, name="Fan-out Family")
+
+
+def _recipients(db_session, family_id, **kwargs):
+    return {user_id for user_id, _ in notifier.recipients_query(db_session, family_id, **kwargs)}
+
+
+def test_audience_and_resguardo_rules(db_session, household):
+    family_id, ids = household
+    actor = ids["actor"]
+    assert _recipients(db_session, family_id, audience="family") == {ids["actor"], ids["partner"], ids["teen"]}
+    assert _recipients(db_session, family_id, audience="others", actor_id=actor) == {ids["partner"], ids["teen"]}
+    assert _recipients(db_session, family_id, audience="other_parents", actor_id=actor) == {ids["partner"]}
+    assert _recipients(db_session, family_id, audience="users", user_ids=[ids["resting"], 1]) == set()
+    # Urgente ignora o resguardo, mas nunca alcança membros removidos
+    assert _recipients(db_session, family_id, audience="parents", priority="urgent") == {
+        ids["actor"], ids["partner"], ids["resting"]
+    }
+    with pytest.raises(ValueError):
+        _recipients(db_session, family_id, audience="everyone")
+
+
+def test_notify_family_bulk_insert(db_session, household):
+    family_id, ids = household
+    created = notifier.notify_family(db_session, family_id, "Aviso", "Reunião escolar", audience="others",
+                                     actor_id=ids["actor"])
+    db_session.commit()
+    assert {user_id for _, user_id in created} == {ids["partner"], ids["teen"]}
+    rows = db_session.query(Notification).filter(Notification.id.in_([n for n, _ in created])).all()
+    assert {(row.user_id, row.family_unit_id, row.title) for row in rows} == {
+        (ids["partner"], family_id, "Aviso"), (ids["teen"], family_id, "Aviso")
+    }
+    assert notifier.notify_family(db_session, family_id, "Aviso", "x", audience="users", user_ids=[]) == []
+
+
+def test_backlog_skips_notifications_held_for_digest(db_session, make_family):
+    from routers.notifications import _backlog
+    family_id, ids = make_family({
+        "actor": "parent",
+        "resting": ("parent", {"resguardo_active": True, "resguardo_digest": True}),
+    }, name="Digest Family")
+    created = notifier.notify_family(db_session, family_id, "Aviso", "Reunião escolar", audience="others",
+                                     actor_id=ids["actor"])
+    db_session.commit()
+    assert [user_id for _, user_id in created] == [ids["resting"]]
+    # Reconexão (Last-Event-ID / long-poll) não entrega antes do resumo
+    assert _backlog(db_session, ids["resting"], 0) == []
+
+
+def test_emergency_reaches_members_in_resguardo(client, db_session, make_family):
+    _, ids = make_family({"partner": ("parent", {"resguardo_active": True})}, family_id=1)
+    response = client.post("/notifications/emergency", json={"latitude": -23.5, "longitude": -46.6})
+    assert response.status_code == 200
+    assert response.json()["receivers"] >= 1
+    assert db_session.query(Notification).filter(
+        Notification.user_id == ids["partner"], Notification.type == "error"
+    ).count() == 1
+
+
+def test_budget_proposal_reaches_only_the_other_parent(client, db_session, make_family):
+    _, ids = make_family({"partner": "parent", "teen": "child"}, family_id=1)
+    response = client.post("/budgets", json={"description": "Material escolar", "estimated_value": 150.0,
+                                             "family_unit_id": 1})
+    assert response.status_code == 200
+    received = {user_id for (user_id,) in db_session.query(Notification.user_id).filter(
+        Notification.title == "Novo Orçamento Sugerido", Notification.user_id.in_(ids.values())
+    )}
+    assert received == {ids["partner"]}
+
+
+def test_committed_notifications_are_published(db_session, household):
+    family_id, ids = household
+
+    async def scenario():
+        inbox = await pubsub.broker.subscribe(pubsub.user_topic(ids["partner"]))
+        try:
+            notifier.notify_family(db_session, family_id, "Descartada", "x", audience="family")
+            db_session.rollback()
+            created = notifier.notify_family(db_session, family_id, "Consulta", "Pediatra às 15h", audience="family")
+            db_session.commit()
+            event = await asyncio.wait_for(inbox.get(), 1)
+            return created, event, inbox.queue.qsize()
+        finally:
+            inbox.close()
+
+    created, event, remaining = asyncio.run(scenario())
+    assert event["title"] == "Consulta"
+    assert (event["id"], ids["partner"]) in created
+    assert remaining == 0
+
+
+def test_sse_stream_resumes_after_last_event_id():
+    async def scenario():
+        subscription = await pubsub.broker.subscribe(pubsub.user_topic(424242))
+        backlog = [{"id": 5, "title": "Antiga"}, {"id": 6, "title": "Perdida"}]
+        stream = notification_stream(subscription, backlog, last_id=4, heartbeat=0.05)
+        chunks = [await stream.__anext__() for _ in range(3)]
+        pubsub.broker.publish(pubsub.user_topic(424242), {"id": 6, "title": "Duplicada"})
+        pubsub.broker.publish(pubsub.user_topic(424242), {"id": 7, "title": "Nova"})
+        chunks.append(await stream.__anext__())
+        chunks.append(await stream.__anext__())  # sem eventos: heartbeat
+        await stream.aclose()
+        return chunks
+
+    chunks = asyncio.run(scenario())
+    assert chunks[0].startswith("retry:")
+    assert chunks[1].startswith("id: 5\nevent: notification\n")
+    assert chunks[2].startswith("id: 6\n")
+    assert chunks[3].startswith("id: 7\n") and '"Nova"' in chunks[3]
+    assert chunks[4] == ": keep-alive\n\n"
+
+
+def test_long_poll(client, db_session):
+    last_id = client.get("/notifications/poll?after_id=0&timeout=0").json()["last_id"]
+    assert client.get(f"/notifications/poll?after_id={last_id}&timeout=0.05").json() == {
+        "notifications": [], "last_id": last_id
+    }
+
+    create_internal_notification(db_session, 1, 1, "Troca de turno", "Busca às 17h")
+    body = client.get(f"/notifications/poll?after_id={last_id}&timeout=5").json()
+    assert [n["title"] for n in body["notifications"]] == ["Troca de turno"]
+    assert body["last_id"] > last_id
+
+
+def test_grouped_notifications_update_one_digest_row(db_session, household):
+    family_id, ids = household
+    partner = ids["partner"]
+    before = inbox_summary.get_summary(db_session, partner).unread_notifications
+
+    async def scenario():
+        inbox = await pubsub.broker.subscribe(pubsub.user_topic(partner))
+        try:
+            for name in ("Louça", "Lição", "Quarto"):
+                notifier.notify_family(db_session, family_id, "Missão Cumprida!", f"'{name}' concluída.", "success",
+                                       audience="users", user_ids=[partner], group_key="task_completed",
+                                       digest_title="{count} missões concluídas")
+                db_session.commit()
+            return [await asyncio.wait_for(inbox.get(), 1) for _ in range(3)]
+        finally:
+            inbox.close()
+
+    events = asyncio.run(scenario())
+    db_session.expire_all()
+    rows = db_session.query(Notification).filter(
+        Notification.user_id == partner, Notification.group_key == "task_completed"
+    ).all()
+    assert len(rows) == 1
+    assert (rows[0].title, rows[0].content, rows[0].occurrences) == ("3 missões concluídas", "'Quarto' concluída.", 3)
+    assert inbox_summary.get_summary(db_session, partner).unread_notifications == before + 1
+    assert [event.get("updated", False) for event in events] == [False, True, True]
+    assert events[-1]["id"] == rows[0].id and events[-1]["title"] == "3 missões concluídas"
+
+    # Lida ou fora da janela: abre uma linha nova
+    rows[0].read_at = datetime.now(timezone.utc)
+    db_session.commit()
+    notifier.notify_family(db_session, family_id, "Missão Cumprida!", "'Cama' concluída.", "success",
+                           audience="users", user_ids=[partner], group_key="task_completed",
+                           digest_title="{count} missões concluídas")
+    db_session.commit()
+    latest = db_session.query(Notification).filter(
+        Notification.user_id == partner, Notification.group_key == "task_completed"
+    ).order_by(Notification.id.desc()).first()
+    assert (latest.title, latest.occurrences) == ("Missão Cumprida!", 1)
+    latest.created_at = datetime.now(timezone.utc) - timedelta(seconds=notifier.NOTIFICATION_COALESCE_SECONDS + 60)
+    db_session.commit()
+    notifier.notify_family(db_session, family_id, "Missão Cumprida!", "'Mochila' concluída.", "success",
+                           audience="users", user_ids=[partner], group_key="task_completed")
+    db_session.commit()
+    assert db_session.query(Notification).filter(
+        Notification.user_id == partner, Notification.group_key == "task_completed"
+    ).count() == 3
+
+
+def test_updated_notification_is_streamed_without_id():
+    async def scenario():
+        subscription = await pubsub.broker.subscribe(pubsub.user_topic(434343))
+        stream = notification_stream(subscription, [], last_id=10, heartbeat=1)
+        await stream.__anext__()  # retry
+        pubsub.broker.publish(pubsub.user_topic(434343), {"id": 8, "title": "2 missões concluídas", "updated": True})
+        chunk = await stream.__anext__()
+        await stream.aclose()
+        return chunk
+
+    chunk = asyncio.run(scenario())
+    assert chunk.startswith("event: notification.updated\ndata: ")
+    assert "2 missões concluídas" in chunk
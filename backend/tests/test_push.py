@@ -0,0 +1,193 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import notifier
+import push
+from models import Notification, PushDevice, PushOutbox, User
+
+
+@pytest.fixture
+def receiver(db_session, make_family):
+    """Família com um responsável (autor) e outro com dois aparelhos registrados."""
+    family_id, ids = make_family({"autor": "parent", "receptor": "parent"}, name="Push Family")
+    now = datetime.now(timezone.utc)
+    tokens = [f"token-{uuid.uuid4().hex}" for _ in range(2)]
+    db_session.add_all([PushDevice(user_id=ids["receptor"], token=token, platform="android", created_at=now, last_seen_at=now)
+                        for token in tokens])
+    db_session.commit()
+    yield family_id, ids["autor"], ids["receptor"], tokens
+    # Não deixa pushes pendentes para os outros testes
+    db_session.query(PushOutbox).filter(PushOutbox.user_id == ids["receptor"]).update({"status": "dead"})
+    db_session.commit()
+
+
+def _notify(db_session, family_id, actor_id, title, priority="normal"):
+    created = notifier.notify_family(db_session, family_id, title, f"{title} (detalhes)", audience="others",
+                                     actor_id=actor_id, priority=priority)
+    db_session.commit()
+    return created
+
+
+def _rows(db_session, user_id):
+    db_session.expire_all()
+    return db_session.query(PushOutbox).filter(PushOutbox.user_id == user_id).order_by(PushOutbox.id).all()
+
+
+def test_outbox_written_with_notification(db_session, receiver):
+    family_id, actor_id, user_id, tokens = receiver
+    created = _notify(db_session, family_id, actor_id, "Consulta marcada")
+    rows = _rows(db_session, user_id)
+    assert len(rows) == 2  # um por aparelho
+    assert {row.notification_id for row in rows} == {created[0][0]}
+    assert all(row.status == "pending" for row in rows)
+
+    # Reenfileirar a mesma notificação não duplica
+    push.enqueue_for_notifications(db_session, [created[0][0]])
+    db_session.commit()
+    assert len(_rows(db_session, user_id)) == 2
+
+
+def test_worker_coalesces_per_device(db_session, receiver):
+    family_id, actor_id, user_id, tokens = receiver
+    for title in ("Missão Cumprida!", "Missão Cumprida!", "Orçamento aprovado"):
+        _notify(db_session, family_id, actor_id, title)
+    _notify(db_session, family_id, actor_id, "ALERTA", priority="urgent")
+
+    sender = push.FakePushSender()
+    worker = push.PushDeliveryWorker(sender=sender, batch_size=500)
+    while worker.run_once(db_session):
+        pass
+
+    mine = [message for message in sender.sent if message.token in tokens]
+    assert len(mine) == 4  # por aparelho: o urgente sozinho + um resumo dos outros três
+    summary = next(message for message in mine if message.token == tokens[0] and message.priority == "normal")
+    assert summary.title == "3 novas notificações"
+    assert "Orçamento aprovado" in summary.body
+    assert any(message.title == "ALERTA" and message.priority == "urgent" for message in mine)
+    assert all(row.status == "sent" and row.attempts == 1 for row in _rows(db_session, user_id))
+
+
+def test_worker_retries_and_disables_invalid_tokens(db_session, receiver):
+    family_id, actor_id, user_id, tokens = receiver
+    _notify(db_session, family_id, actor_id, "Troca de horário")
+
+    sender = push.FakePushSender()
+    sender.failures[tokens[0]] = push.PushResult(False, "UNAVAILABLE", True, False)
+    sender.failures[tokens[1]] = push.PushResult(False, "Unregistered", False, True)
+    worker = push.PushDeliveryWorker(sender=sender, batch_size=500, max_attempts=2)
+    worker.run_once(db_session)
+
+    retry, dead = _rows(db_session, user_id)
+    assert retry.status == "pending" and retry.attempts == 1
+    assert retry.next_attempt_at > datetime.now(timezone.utc).replace(tzinfo=None)
+    assert dead.status == "dead"
+    assert db_session.query(PushDevice).filter(PushDevice.token == tokens[1]).one().disabled_at is not None
+
+    # Vence o backoff: segunda falha atinge o limite de tentativas
+    retry.next_attempt_at = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=1)
+    db_session.commit()
+    worker.run_once(db_session)
+    assert _rows(db_session, user_id)[0].status == "dead"
+
+    # Aparelho desativado não recebe mais pushes
+    _notify(db_session, family_id, actor_id, "Nova mensagem")
+    assert [row.device_id for row in _rows(db_session, user_id)].count(dead.device_id) == 1
+
+
+def test_failed_send_calls_reach_dead(db_session, receiver):
+    family_id, actor_id, user_id, tokens = receiver
+    _notify(db_session, family_id, actor_id, "Sem provedor")
+
+    class BrokenSender(push.PushSender):
+        def send(self, messages):
+            raise RuntimeError("provedor fora do ar")
+
+    class IncompleteSender(push.PushSender):
+        pass
+
+    # Provedor sem send falha ao ser criado, não no loop do worker
+    with pytest.raises(TypeError):
+        IncompleteSender()
+
+    worker = push.PushDeliveryWorker(sender=BrokenSender(), batch_size=500, max_attempts=2)
+    worker.run_once(db_session)
+    assert all(row.status == "pending" and row.attempts == 1 for row in _rows(db_session, user_id))
+
+    # Processo cai depois da reserva: a linha volta pelo lease, mas a tentativa já contou
+    past = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=1)
+    db_session.query(PushOutbox).filter(PushOutbox.user_id == user_id).update({"next_attempt_at": past})
+    db_session.commit()
+    claimed = push._claim(db_session, 500, max_attempts=2)
+    assert {row.attempts for row in claimed if row.user_id == user_id} == {2}
+    db_session.query(PushOutbox).filter(PushOutbox.user_id == user_id).update({"next_attempt_at": past})
+    db_session.commit()
+    worker.run_once(db_session)
+    assert all(row.status == "dead" for row in _rows(db_session, user_id))
+
+
+def test_device_registration(client, db_session):
+    token = f"token-{uuid.uuid4().hex}"
+    response = client.post("/notifications/devices", json={"token": token, "platform": "ios"})
+    assert response.status_code == 200
+    assert client.post("/notifications/devices", json={"token": token}).json()["device_id"] == response.json()["device_id"]
+    assert client.delete(f"/notifications/devices/{token}").status_code == 200
+    assert db_session.query(PushDevice).filter(PushDevice.token == token).one().disabled_at is not None
+    assert client.delete("/notifications/devices/unknown").status_code == 404
+
+
+def test_grouped_notification_refreshes_pending_push(db_session, receiver):
+    family_id, actor_id, user_id, tokens = receiver
+    for comment in ("Pode ser R$ 80?", "Fechamos em R$ 90?"):
+        notifier.notify_family(db_session, family_id, "Contra-proposta de Orçamento", comment, audience="others",
+                               actor_id=actor_id, group_key="budget:1:negotiation",
+                               digest_title="{count} contrapropostas")
+        db_session.commit()
+    rows = _rows(db_session, user_id)
+    assert len(rows) == 2  # um por aparelho, sem push novo para o agrupamento
+    assert {(row.title, row.body) for row in rows} == {("2 contrapropostas", "Fechamos em R$ 90?")}
+
+
+def test_resguardo_digest(db_session, receiver):
+    family_id, actor_id, user_id, tokens = receiver
+    user = db_session.get(User, user_id)
+    user.resguardo_active, user.resguardo_digest = True, True
+    db_session.commit()
+    try:
+        for title in ("Consulta marcada", "Orçamento aprovado"):
+            _notify(db_session, family_id, actor_id, title)
+        stored = db_session.query(Notification).filter(Notification.user_id == user_id).all()
+        assert len(stored) == 2 and all(n.digest_pending for n in stored)
+        assert _rows(db_session, user_id) == []  # nada de push durante o resguardo
+
+        assert push.enqueue_digests(db_session, [user_id]) == 1
+        db_session.commit()
+        rows = _rows(db_session, user_id)
+        assert len(rows) == 2  # um resumo por aparelho
+        assert rows[0].title == "Resumo do resguardo: 2 notificações"
+        assert rows[0].body == "Consulta marcada • Orçamento aprovado"
+        assert push.enqueue_digests(db_session, [user_id]) == 0
+
+        # Urgente fura o resguardo na hora
+        _notify(db_session, family_id, actor_id, "ALERTA", priority="urgent")
+        assert len(_rows(db_session, user_id)) == 4
+    finally:
+        user.resguardo_active, user.resguardo_digest = False, False
+        db_session.commit()
+
+
+def test_leaving_resguardo_releases_digest(db_session):
+    from routers.notifications import create_internal_notification
+    from routers.users import UserProfileUpdate, get_me, update_profile
+    user = db_session.get(User, 1)
+    update_profile(UserProfileUpdate(resguardo_active=True, resguardo_digest=True), db_session, user)
+    try:
+        assert get_me(user)["resguardo_digest"] is True
+        create_internal_notification(db_session, 1, 1, "Reunião escolar", "Quinta às 19h")
+        held = db_session.query(Notification).filter(Notification.user_id == 1).order_by(Notification.id.desc()).first()
+        assert held.title == "Reunião escolar" and held.digest_pending
+    finally:
+        update_profile(UserProfileUpdate(resguardo_active=False, resguardo_digest=False), db_session, user)
+    db_session.expire_all()
+    assert not db_session.get(Notification, held.id).digest_pending
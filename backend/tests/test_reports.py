@@ -0,0 +1,227 @@
+import time
+from hashlib import sha256
+from datetime import datetime, timedelta
+
+from models import EventLog, Appointment
+
+
+def _page_count(pdf: bytes) -> int:
+    return pdf.count(b"/Type /Page\n") + pdf.count(b"/Type /Page ")
+
+
+def test_render_memory_grows_only_with_page_content(db_session):
+    import tracemalloc
+    from models import FamilyUnit
+    from report_builder import HashingBuffer, render_pdf
+    family = FamilyUnit(name="Histórico longo", mode="collaborative")
+    db_session.add(family)
+    db_session.commit()
+    base = datetime(2018, 1, 1)
+
+    def peak_with(total, already):
+        db_session.add_all([
+            EventLog(event_type="check-in", event_data={"status": f"Evento {i} " + "x" * 60},
+                     family_unit_id=family.id, created_at=base + timedelta(minutes=i))
+            for i in range(already, total)
+        ])
+        db_session.commit()
+        pdf = HashingBuffer()
+        tracemalloc.start()
+        try:
+            render_pdf(pdf, db_session, family.id, {"include_events": True}, "Memória", "Autor", None)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            pdf.close()
+
+    small, large = peak_with(1000, 0), peak_with(3000, 1000)
+    # Limite real: o reportlab guarda as páginas até o save(), então cresce com as linhas,
+    # mas só com o conteúdo impresso (~250 bytes/linha), nunca com as linhas do banco
+    assert (large - small) / 2000 < 1024
+
+
+def test_full_timeline_is_not_capped(client, db_session):
+    base = datetime(2021, 3, 1, 9, 0)
+    db_session.add_all([
+        EventLog(
+            event_type="check-in",
+            event_data=f"Registro {i} " + "com uma descrição longa que precisa quebrar em várias linhas " * 3,
+            family_unit_id=1,
+            created_at=base + timedelta(days=i)
+        )
+        for i in range(400)
+    ])
+    db_session.add(Appointment(type="consulta", description="Pediatra", scheduled_time=base, status="scheduled",
+                               family_unit_id=1, created_at=base))
+    db_session.commit()
+
+    full = client.post("/reports?inline=true", json={
+        "name": "Dossiê completo",
+        "filters": {"include_events": True, "include_appointments": True, "include_checkins": True}
+    })
+    assert full.status_code == 200
+
+    ranged = client.post("/reports?inline=true", json={
+        "name": "Dossiê março/2021",
+        "filters": {"include_events": True, "start_date": "2021-03-01", "end_date": "2021-03-10"}
+    })
+    assert ranged.status_code == 200
+
+    # 400 eventos de 2 linhas ocupam mais de 10 páginas (o limite antigo de 100 cabia em 3); o recorte cabe em uma
+    assert _page_count(full.content) > 10
+    assert _page_count(ranged.content) == 1
+
+
+def test_appointment_edit_changes_watermark(db_session):
+    from report_builder import data_watermark
+    filters = {"include_appointments": True}
+    appointment = Appointment(type="consulta", description="Pediatra", scheduled_time=datetime(2021, 4, 1, 9, 0),
+                              status="scheduled", family_unit_id=1, created_at=datetime(2021, 3, 1))
+    db_session.add(appointment)
+    db_session.commit()
+    before = data_watermark(db_session, 1, filters)
+
+    appointment.description = "Pediatra (remarcado)"
+    db_session.commit()
+    assert data_watermark(db_session, 1, filters) != before
+
+    db_session.delete(appointment)
+    db_session.commit()
+
+
+def test_invalid_date_range(client):
+    response = client.post("/reports", json={
+        "name": "Período inválido",
+        "filters": {"include_events": True, "start_date": "2024-02-01", "end_date": "2024-01-01"}
+    })
+    assert response.status_code == 400
+
+    response = client.post("/reports", json={"name": "Data inválida", "filters": {"start_date": "ontem"}})
+    assert response.status_code == 400
+
+    # Uma data com fuso e outra sem: comparadas em UTC, sem erro 500
+    response = client.post("/reports", json={
+        "name": "Fusos misturados",
+        "filters": {"start_date": "2024-02-01T12:00:00-03:00", "end_date": "2024-02-01T14:00:00"}
+    })
+    assert response.status_code == 400
+
+
+def test_parse_date_range_normalizes_to_utc():
+    from report_builder import parse_date_range
+    start, end = parse_date_range({"start_date": "2024-02-01T10:00:00-03:00", "end_date": "2024-02-01"})
+    assert start == datetime(2024, 2, 1, 13, 0) and start.tzinfo is None
+    assert end == datetime(2024, 2, 2)
+
+
+def test_batch_reports_enqueue_jobs(client, db_session):
+    from models import FamilyUnit, FamilyMember
+
+    family = FamilyUnit(name="Segunda Família", mode="collaborative")
+    db_session.add(family)
+    db_session.commit()
+    membership = FamilyMember(user_id=1, family_id=family.id, role="mediator")
+    db_session.add(membership)
+    db_session.commit()
+
+    try:
+        response = client.post("/reports/batch", json={
+            "family_ids": [1, family.id, family.id],
+            "start_date": "2021-01-01",
+            "end_date": "2021-12-31"
+        })
+        # Responde sem esperar a renderização; as famílias rodam no pool de processos
+        assert response.status_code == 202
+        status_url = response.json()["status_url"]
+        for _ in range(200):
+            manifest = client.get(status_url).json()
+            if manifest["pending"] == 0:
+                break
+            time.sleep(0.05)
+        assert manifest["completed"] == 2 and manifest["failed"] == 0
+        assert [entry["family_id"] for entry in manifest["reports"]] == [1, family.id]
+        for entry in manifest["reports"]:
+            assert len(entry["hash"]) == 64
+            # Quem pediu o lote baixa o relatório mesmo sendo de outra família
+            download = client.get(f"/attachments/reports/{entry['report_id']}")
+            assert download.status_code == 200
+            assert sha256(download.content).hexdigest() == entry["hash"]
+            assert client.get(f"/reports/jobs/{entry['job_id']}").json()["report_id"] == entry["report_id"]
+
+        # Mesmo lote de novo: tudo sai do cache, já concluído
+        again = client.get(client.post("/reports/batch", json={
+            "family_ids": [1, family.id], "start_date": "2021-01-01", "end_date": "2021-12-31"
+        }).json()["status_url"]).json()
+        assert again["pending"] == 0
+        assert [entry["report_id"] for entry in again["reports"]] == [entry["report_id"] for entry in manifest["reports"]]
+        assert client.get("/reports/batch/nao-existe").status_code == 404
+
+        response = client.post("/reports/batch", json={"family_ids": [1, 999]})
+        assert response.status_code == 403
+    finally:
+        db_session.delete(membership)
+        db_session.commit()
+    # Sem o vínculo com a família o relatório some para o mediador
+    assert client.get(f"/attachments/reports/{manifest['reports'][1]['report_id']}").status_code == 404
+
+
+def test_verify_report_by_upload_and_hash(client):
+    from report_verification import verify_limiter
+    verify_limiter.reset()
+
+    response = client.post("/reports?inline=true", json={
+        "name": "Dossiê para verificação",
+        "filters": {"include_appointments": True, "start_date": "2019-01-01", "end_date": "2019-01-31"}
+    })
+    assert response.status_code == 200
+    pdf, report_hash = response.content, response.headers["x-report-hash"]
+
+    by_upload = client.post("/reports/verify", content=pdf, headers={"Content-Type": "application/pdf"})
+    assert by_upload.status_code == 200
+    assert by_upload.json()["valid"] is True
+    assert by_upload.json()["report_id"] == int(response.headers["x-report-id"])
+
+    by_hash = client.get(f"/reports/verify/{report_hash.upper()}")
+    assert by_hash.json()["valid"] is True
+
+    tampered = client.post("/reports/verify", content=pdf + b"\n", headers={"Content-Type": "application/pdf"})
+    assert tampered.json()["valid"] is False
+    assert client.get(f"/reports/verify/{'0' * 64}").json() == {"hash": "0" * 64, "valid": False}
+    assert client.get("/reports/verify/abc").status_code == 400
+
+
+def test_verify_report_rate_limited(client, monkeypatch):
+    from report_verification import verify_limiter
+    verify_limiter.reset()
+    monkeypatch.setattr(verify_limiter, "limit", 2)
+
+    assert client.get(f"/reports/verify/{'1' * 64}").status_code == 200
+    assert client.get(f"/reports/verify/{'1' * 64}").status_code == 200
+    blocked = client.get(f"/reports/verify/{'1' * 64}")
+    assert blocked.status_code == 429
+    assert int(blocked.headers["retry-after"]) > 0
+    verify_limiter.reset()
+
+
+def test_client_ip_honors_only_trusted_proxies():
+    import ipaddress
+    from report_verification import client_ip
+    proxies = [ipaddress.ip_network("10.0.0.0/8")]
+
+    assert client_ip("10.0.0.5", "203.0.113.7", proxies) == "203.0.113.7"
+    # Entradas à esquerda podem ser forjadas: vale a última fora dos proxies
+    assert client_ip("10.0.0.5", "1.2.3.4, 203.0.113.7, 10.0.0.9", proxies) == "203.0.113.7"
+    # Conexão direta de fora: o cabeçalho é ignorado
+    assert client_ip("198.51.100.1", "203.0.113.7", proxies) == "198.51.100.1"
+    assert client_ip("10.0.0.5", None, proxies) == "10.0.0.5"
+
+
+def test_bloom_filter_has_no_false_negatives():
+    from report_verification import BloomFilter
+    bloom = BloomFilter(2000)
+    keys = [f"{i:064x}" for i in range(2000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    false_positives = sum(f"{i:064x}" in bloom for i in range(10000, 20000))
+    assert false_positives < 100
@@ -0,0 +1,55 @@
+import threading
+from datetime import datetime, timezone
+
+from models import ChatMessageRead, CheckIn, CustodyEvent, Location, LocationUsageHistory
+from write_buffer import WriteBehindBuffer, write_buffer
+
+
+def test_buffer_flushes_in_batches_and_on_stop(engine, db_session):
+    buffer = WriteBehindBuffer(max_batch=50, interval_ms=10000)
+    buffer.start(engine)
+    now = datetime(2024, 4, 1, 12, 0, tzinfo=timezone.utc)
+    for i in range(120):
+        buffer.append(db_session, ChatMessageRead, {"message_id": 900000 + i, "user_id": 1, "read_at": now})
+    buffer.stop()
+
+    assert buffer.pending() == 0
+    assert db_session.query(ChatMessageRead).filter(ChatMessageRead.message_id >= 900000).count() == 120
+
+
+def test_buffer_backpressure_falls_back_to_sync_write(engine, db_session, monkeypatch):
+    buffer = WriteBehindBuffer(max_batch=1, interval_ms=1, max_pending=1, put_timeout=0.05)
+    release = threading.Event()
+    original_flush = buffer._flush
+    monkeypatch.setattr(buffer, "_flush", lambda batch: (release.wait(5), original_flush(batch)))
+    buffer.start(engine)
+    now = datetime(2024, 4, 2, 12, 0)
+    try:
+        for i in range(3):
+            buffer.append(db_session, ChatMessageRead, {"message_id": 910000 + i, "user_id": 1, "read_at": now})
+        # O flush está travado: ao menos uma linha já foi gravada de forma síncrona
+        assert db_session.query(ChatMessageRead).filter(ChatMessageRead.message_id >= 910000).count() >= 1
+    finally:
+        release.set()
+        buffer.stop()
+    assert db_session.query(ChatMessageRead).filter(ChatMessageRead.message_id >= 910000).count() == 3
+
+
+def test_checkin_is_stored_before_the_response(client, db_session, engine):
+    assert not write_buffer.running
+    location = Location(name="Escola", type="Escola", latitude=-23.5, longitude=-46.6, family_unit_id=1)
+    db_session.add(location)
+    db_session.commit()
+    event = CustodyEvent(family_unit_id=1, child_id=1, event_date=datetime(2024, 5, 1), status="scheduled", location_id=location.id)
+    db_session.add(event)
+    db_session.commit()
+
+    # Com o buffer ativo o check-in já está no banco quando a resposta chega
+    write_buffer.start(engine)
+    try:
+        response = client.post("/checkins", json={"event_id": event.id, "latitude": -23.5, "longitude": -46.6, "status": "on_time"})
+        assert response.status_code == 200
+        assert db_session.query(CheckIn).filter(CheckIn.event_id == event.id).count() == 1
+    finally:
+        write_buffer.stop()
+    assert db_session.query(LocationUsageHistory).filter(LocationUsageHistory.location_id == location.id).count() == 1
@@ -0,0 +1,48 @@
+import os
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Pool de processos compartilhado para trabalho CPU-bound (imagens, PDFs, áudio).
+# Criado sob demanda para não custar nada em scripts e testes que não o utilizam.
+PROCESS_WORKERS = int(os.environ.get("MEDIARE_PROCESS_WORKERS", min(4, os.cpu_count() or 1)))
+# Workers de jobs em segundo plano (relatórios etc.), fora do threadpool das requisições
+JOB_WORKERS = int(os.environ.get("MEDIARE_JOB_WORKERS", 2))
+
+_process_pool = None
+_job_pool = None
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS)
+    return _process_pool
+
+
+async def run_in_process(fn, *args):
+    """Executa fn(*args) no pool de processos sem bloquear o event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), fn, *args)
+
+
+def run_in_process_sync(fn, *args):
+    """Versão para handlers síncronos (já rodando em threadpool do FastAPI)."""
+    return get_process_pool().submit(fn, *args).result()
+
+
+def submit_job(fn, *args):
+    """Agenda fn(*args) em background e retorna imediatamente o Future."""
+    global _job_pool
+    if _job_pool is None:
+        _job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="mediare-job")
+    return _job_pool.submit(fn, *args)
+
+
+def shutdown_pools():
+    global _process_pool, _job_pool
+    if _job_pool is not None:
+        _job_pool.shutdown(wait=True)
+        _job_pool = None
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=True, cancel_futures=True)
+        _process_pool = None
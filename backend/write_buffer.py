@@ -0,0 +1,128 @@
+import os
+import time
+import queue
+import threading
+from sqlalchemy.orm import Session
+
+# Buffer write-behind para tabelas só de inserção que não servem de prova. Hoje o único
+# uso é o histórico de uso de locais gravado junto com os check-ins (routers/calendar.py).
+# A requisição só enfileira; uma thread grava em lotes com executemany a cada
+# WRITE_BUFFER_BATCH linhas ou WRITE_BUFFER_INTERVAL_MS.
+# Check-ins e EventLog são registro jurídico: gravados na transação da requisição, que
+# só responde depois do commit e mantém a cadeia de auditoria sob o lock da família.
+WRITE_BUFFER_BATCH = int(os.environ.get("WRITE_BUFFER_BATCH", 500))
+WRITE_BUFFER_INTERVAL_MS = int(os.environ.get("WRITE_BUFFER_INTERVAL_MS", 200))
+WRITE_BUFFER_MAX_PENDING = int(os.environ.get("WRITE_BUFFER_MAX_PENDING", 10000))
+# Com o buffer cheio a requisição espera até isso e depois grava de forma síncrona
+WRITE_BUFFER_PUT_TIMEOUT = float(os.environ.get("WRITE_BUFFER_PUT_TIMEOUT", 2.0))
+
+_STOP = object()
+
+
+class WriteBehindBuffer:
+    def __init__(self, max_batch: int = WRITE_BUFFER_BATCH, interval_ms: int = WRITE_BUFFER_INTERVAL_MS,
+                 max_pending: int = WRITE_BUFFER_MAX_PENDING, put_timeout: float = WRITE_BUFFER_PUT_TIMEOUT):
+        self.max_batch = max_batch
+        self.interval = interval_ms / 1000
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._bind = None
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, bind):
+        if self.running:
+            return
+        self._bind = bind
+        self._thread = threading.Thread(target=self._run, name="mediare-write-buffer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Grava tudo o que estiver pendente antes de encerrar (shutdown da aplicação)."""
+        if not self.running:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def append(self, db: Session, model, values: dict):
+        """
+        Enfileira uma linha para inserção. Sem o buffer ativo (testes, scripts) ou se ele
+        continuar cheio após o timeout (backpressure), grava na hora pela sessão da requisição.
+        """
+        if self.running:
+            try:
+                self._queue.put((model, values), timeout=self.put_timeout)
+                return
+            except queue.Full:
+                print(f"WriteBuffer: buffer cheio, gravando {model.__tablename__} de forma síncrona")
+        db.add(model(**values))
+        db.commit()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            stopping = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            if stopping:
+                # Drena o restante sem esperar o intervalo
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not _STOP:
+                        batch.append(item)
+            self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, batch: list):
+        groups = {}
+        for model, values in batch:
+            groups.setdefault(model, []).append(values)
+        session = Session(bind=self._bind)
+        try:
+            for model, rows in groups.items():
+                self._insert(session, model, rows)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"WriteBuffer Erro (lote de {len(batch)}): {e}")
+            # Regrava linha a linha para não perder o lote inteiro por uma linha inválida
+            for model, values in batch:
+                try:
+                    self._insert(session, model, [values])
+                    session.commit()
+                except Exception as row_error:
+                    session.rollback()
+                    print(f"WriteBuffer Erro ({model.__tablename__}): {row_error}")
+        finally:
+            session.close()
+
+    def _insert(self, session: Session, model, rows: list):
+        session.execute(model.__table__.insert(), rows)
+
+
+write_buffer = WriteBehindBuffer()
@@ -1,5 +1,7 @@
 import sqlite3
 import os
+import ast
+import json
 
 db_path = os.path.join("backend", "mediare.db")
 conn = sqlite3.connect(db_path)
@@ -19,5 +21,106 @@ try:
 except sqlite3.OperationalError as e:
     print(f"Error or already exists: {e}")
 
+for column in ("thumbnail_url", "preview_url", "normalized_url"):
+    try:
+        print(f"Adding {column} column to expenses table...")
+        cursor.execute(f"ALTER TABLE expenses ADD COLUMN {column} VARCHAR;")
+        print("Success!")
+    except sqlite3.OperationalError as e:
+        print(f"Error or already exists: {e}")
+
+for table, column, ddl in (
+    ("expenses", "updated_at", "DATETIME"),
+    ("reports", "fingerprint", "VARCHAR"),
+    ("report_jobs", "fingerprint", "VARCHAR"),
+    ("report_jobs", "batch_id", "VARCHAR"),
+    ("event_log", "seq", "INTEGER"),
+    ("event_log", "prev_hash", "VARCHAR"),
+    ("event_log", "entry_hash", "VARCHAR"),
+    ("event_log", "child_id", "INTEGER REFERENCES children (id)"),
+    ("event_log", "actor_user_id", "INTEGER REFERENCES users (id)"),
+    ("event_log", "reference_id", "INTEGER"),
+    ("chat_messages", "edited_at", "DATETIME"),
+    ("users", "resguardo_digest", "BOOLEAN DEFAULT 0"),
+    ("notifications", "group_key", "VARCHAR"),
+    ("notifications", "occurrences", "INTEGER NOT NULL DEFAULT 1"),
+    ("notifications", "updated_at", "DATETIME"),
+    ("notifications", "digest_pending", "BOOLEAN NOT NULL DEFAULT 0"),
+    ("appointments", "updated_at", "DATETIME"),
+):
+    try:
+        print(f"Adding {column} column to {table} table...")
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl};")
+        print("Success!")
+    except sqlite3.OperationalError as e:
+        print(f"Error or already exists: {e}")
+
+cursor.execute("CREATE INDEX IF NOT EXISTS ix_reports_fingerprint ON reports (fingerprint);")
+cursor.execute("CREATE INDEX IF NOT EXISTS ix_reports_hash_sha256 ON reports (hash_sha256);")
+cursor.execute("CREATE INDEX IF NOT EXISTS ix_event_log_entry_hash ON event_log (entry_hash);")
+cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_event_log_family_seq ON event_log (family_unit_id, seq);")
+for column in ("child_id", "actor_user_id", "reference_id"):
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS ix_event_log_{column} ON event_log ({column});")
+cursor.execute("CREATE INDEX IF NOT EXISTS ix_notifications_user_group_key ON notifications (user_id, group_key);")
+cursor.execute("CREATE INDEX IF NOT EXISTS ix_notifications_digest_pending ON notifications (digest_pending, user_id);")
+cursor.execute("CREATE INDEX IF NOT EXISTS ix_event_log_family_type_created ON event_log (family_unit_id, event_type, created_at);")
+
+# event_log.event_data passou a ser JSON: converte o texto antigo gerado com str(dict)
+print("Converting event_log.event_data to JSON...")
+updates = []
+for event_id, raw, entry_hash in cursor.execute("SELECT id, event_data, entry_hash FROM event_log").fetchall():
+    try:
+        json.loads(raw)
+        continue  # já está em JSON
+    except (TypeError, ValueError):
+        pass
+    data = raw
+    # Entradas já encadeadas mantêm o texto original (como string JSON) para o hash continuar válido
+    if entry_hash is None:
+        try:
+            parsed = ast.literal_eval(raw)
+            if isinstance(parsed, dict):
+                data = parsed
+        except (ValueError, SyntaxError):
+            pass
+    keys = data if isinstance(data, dict) else {}
+    updates.append((
+        json.dumps(data, ensure_ascii=False, default=str),
+        keys.get("child_id"), keys.get("actor_user_id"), keys.get("reference_id"),
+        event_id
+    ))
+cursor.executemany(
+    "UPDATE event_log SET event_data = ?, child_id = ?, actor_user_id = ?, reference_id = ? WHERE id = ?",
+    updates
+)
+print(f"{len(updates)} events converted.")
+
+# Recibos por mensagem (chat_message_reads) viram uma marca de leitura por (chat, usuário)
+print("Migrating chat_message_reads to chat_read_watermarks...")
+cursor.execute("""
+    CREATE TABLE IF NOT EXISTS chat_read_watermarks (
+        id INTEGER NOT NULL PRIMARY KEY,
+        chat_id INTEGER NOT NULL REFERENCES family_chats (id),
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        last_read_message_id INTEGER NOT NULL,
+        updated_at DATETIME NOT NULL,
+        CONSTRAINT uq_chat_read_watermark UNIQUE (chat_id, user_id)
+    );
+""")
+cursor.execute("CREATE INDEX IF NOT EXISTS ix_chat_read_watermarks_id ON chat_read_watermarks (id);")
+cursor.execute("CREATE INDEX IF NOT EXISTS ix_chat_messages_chat_id_id ON chat_messages (chat_id, id);")
+cursor.execute("""
+    INSERT INTO chat_read_watermarks (chat_id, user_id, last_read_message_id, updated_at)
+    SELECT m.chat_id, r.user_id, MAX(r.message_id), MAX(r.read_at)
+    FROM chat_message_reads r JOIN chat_messages m ON m.id = r.message_id
+    GROUP BY m.chat_id, r.user_id
+    ON CONFLICT (chat_id, user_id) DO UPDATE SET
+        last_read_message_id = MAX(last_read_message_id, excluded.last_read_message_id),
+        updated_at = MAX(updated_at, excluded.updated_at);
+""")
+print(f"{cursor.rowcount} watermarks migrated.")
+
 conn.commit()
 conn.close()
+
+# Eventos antigos ficam sem cadeia até rodar: cd backend && python audit_chain.py
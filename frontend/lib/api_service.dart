@@ -45,13 +45,29 @@ class ApiService {
       body: jsonEncode(data),
     );
 
-    if (response.statusCode == 200 || response.statusCode == 201) {
+    if (response.statusCode == 200 || response.statusCode == 201 || response.statusCode == 202) {
       return jsonDecode(response.body);
     } else {
       throw Exception('Erro ao enviar dados: ${response.statusCode} - ${response.body}');
     }
   }
 
+  // Aguarda um job de relatório (resposta do POST /reports) até concluir ou falhar.
+  // Relatórios servidos do cache já chegam com status 'completed'.
+  static Future<dynamic> waitForReportJob(dynamic queued, {Duration interval = const Duration(seconds: 2), int maxAttempts = 90}) async {
+    if (queued['status'] == 'completed') return queued;
+    final jobId = queued['job_id'];
+    for (var attempt = 0; attempt < maxAttempts; attempt++) {
+      final job = await get('/reports/jobs/$jobId');
+      if (job['status'] == 'completed') return job;
+      if (job['status'] == 'failed') {
+        throw Exception('Falha ao gerar relatório: ${job['error']}');
+      }
+      await Future.delayed(interval);
+    }
+    throw Exception('Tempo esgotado aguardando o relatório');
+  }
+
   // Método para requisições Multipart (Upload de Arquivos)
   static Future<dynamic> postMultipart(String endpoint, Map<String, String> fields, List<int> fileBytes, String filename, {String? token}) async {
     var request = http.MultipartRequest('POST', Uri.parse('$baseUrl$endpoint'));
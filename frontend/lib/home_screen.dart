@@ -52,7 +52,7 @@ class _HomeScreenState extends State<HomeScreen> {
   void initState() {
     super.initState();
     FamilyService().fetchFamilies();
-    NotificationService().fetchNotifications();
+    NotificationService().fetchNotifications().then((_) => NotificationService().startStream());
   }
 
   void _showNotifications(BuildContext context) {
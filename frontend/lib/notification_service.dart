@@ -1,5 +1,9 @@
+import 'dart:async';
+import 'dart:convert';
 import 'package:flutter/material.dart';
+import 'package:http/http.dart' as http;
 import 'api_service.dart';
+import 'auth_service.dart';
 
 class NotificationModel {
   final int id;
@@ -39,6 +43,8 @@ class NotificationService extends ChangeNotifier {
 
   List<NotificationModel> _notifications = [];
   bool _isLoading = false;
+  http.Client? _streamClient;
+  int? _lastEventId;
 
   List<NotificationModel> get notifications => _notifications;
   bool get isLoading => _isLoading;
@@ -77,4 +83,55 @@ class NotificationService extends ChangeNotifier {
       debugPrint('Erro ao marcar como lida: $e');
     }
   }
+
+  // Recebe as notificações novas em tempo real (SSE) em vez de refazer o GET.
+  // Ao cair, reconecta com Last-Event-ID e recebe o que chegou no intervalo.
+  Future<void> startStream() async {
+    if (_streamClient != null) return;
+    final client = http.Client();
+    _streamClient = client;
+    if (_notifications.isNotEmpty) {
+      _lastEventId = _notifications.map((n) => n.id).reduce((a, b) => a > b ? a : b);
+    }
+    while (_streamClient == client) {
+      try {
+        final token = await AuthService().getIdToken();
+        final request = http.Request('GET', Uri.parse('${ApiService.baseUrl}/notifications/stream'));
+        request.headers['Accept'] = 'text/event-stream';
+        if (token != null && token.isNotEmpty) request.headers['Authorization'] = 'Bearer $token';
+        if (_lastEventId != null) request.headers['Last-Event-ID'] = '$_lastEventId';
+        final response = await client.send(request);
+        String? data;
+        String? event;
+        await for (final line in response.stream.transform(utf8.decoder).transform(const LineSplitter())) {
+          if (line.startsWith('id: ')) {
+            _lastEventId = int.tryParse(line.substring(4));
+          } else if (line.startsWith('event: ')) {
+            event = line.substring(7);
+          } else if (line.startsWith('data: ')) {
+            data = line.substring(6);
+          } else if (line.isEmpty && data != null) {
+            _addNotification(NotificationModel.fromJson(jsonDecode(data)), updated: event == 'notification.updated');
+            data = null;
+            event = null;
+          }
+        }
+      } catch (e) {
+        debugPrint('Stream de notificações interrompido: $e');
+      }
+      if (_streamClient == client) await Future.delayed(const Duration(seconds: 3));
+    }
+  }
+
+  void stopStream() {
+    _streamClient?.close();
+    _streamClient = null;
+  }
+
+  // Notificações agrupadas ("3 missões concluídas") chegam de novo com o mesmo id: substitui e sobe para o topo
+  void _addNotification(NotificationModel notification, {bool updated = false}) {
+    if (!updated && _notifications.any((n) => n.id == notification.id)) return;
+    _notifications = [notification, ..._notifications.where((n) => n.id != notification.id)];
+    notifyListeners();
+  }
 }
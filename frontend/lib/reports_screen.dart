@@ -70,7 +70,7 @@ class _ReportsScreenState extends State<ReportsScreen> {
     setState(() => _isGenerating = true);
     final familyId = FamilyService().currentFamily.id;
     try {
-      await ApiService.post('/reports', {
+      final job = await ApiService.post('/reports', {
         'name': 'Relatório ${DateFormat('MMM/yyyy').format(DateTime.now())}',
         'filters': {
           'family_unit_id': familyId,
@@ -79,6 +79,7 @@ class _ReportsScreenState extends State<ReportsScreen> {
           'include_chat': _includeChat,
         },
       });
+      await ApiService.waitForReportJob(job);
       
       ScaffoldMessenger.of(context).showSnackBar(
         const SnackBar(content: Text('Relatório gerado com sucesso!'), backgroundColor: Colors.green),
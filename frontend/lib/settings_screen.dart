@@ -17,6 +17,7 @@ class _SettingsScreenState extends State<SettingsScreen> {
   bool _isLoading = true;
   List<dynamic> _families = [];
   bool _resguardoActive = false;
+  bool _resguardoDigest = false;
 
   @override
   void initState() {
@@ -42,6 +43,7 @@ class _SettingsScreenState extends State<SettingsScreen> {
           final profileData = futures[1];
           if (profileData != null && profileData is Map) {
              _resguardoActive = profileData['resguardo_active'] == true;
+             _resguardoDigest = profileData['resguardo_digest'] == true;
           }
           
           _isLoading = false;
@@ -69,6 +71,16 @@ class _SettingsScreenState extends State<SettingsScreen> {
     }
   }
 
+  Future<void> _toggleResguardoDigest(bool newValue) async {
+    setState(() => _resguardoDigest = newValue);
+    try {
+      await ApiService.put('/users/profile', {'resguardo_digest': newValue});
+    } catch (e) {
+      setState(() => _resguardoDigest = !newValue); // Revert on failure
+      if (mounted) ScaffoldMessenger.of(context).showSnackBar(SnackBar(content: Text('Erro: $e')));
+    }
+  }
+
   void _showAddMemberDialog(int familyId) {
     showDialog(
       context: context,
@@ -102,10 +114,11 @@ class _SettingsScreenState extends State<SettingsScreen> {
      );
 
      try {
-       final response = await ApiService.post('/reports', {
+       final job = await ApiService.post('/reports', {
          'name': 'Dossier de Compliance Familiar - Automático',
          'filters': {'include_events': true, 'include_expenses': true}
        });
+       final response = await ApiService.waitForReportJob(job);
        
        if (context.mounted) Navigator.pop(context); // Close loading dialog
        
@@ -239,6 +252,28 @@ class _SettingsScreenState extends State<SettingsScreen> {
                     ),
                   ),
                 ),
+                if (_resguardoActive)
+                  Container(
+                    margin: const EdgeInsets.only(bottom: 12),
+                    decoration: BoxDecoration(
+                      color: Colors.white,
+                      borderRadius: BorderRadius.circular(16),
+                      border: Border.all(color: Colors.grey.shade100, width: 1.5),
+                    ),
+                    child: SwitchListTile(
+                      shape: RoundedRectangleBorder(borderRadius: BorderRadius.circular(16)),
+                      value: _resguardoDigest,
+                      onChanged: _toggleResguardoDigest,
+                      title: Text('Resumo do Resguardo', style: TextStyle(fontWeight: FontWeight.bold, fontSize: 16, color: Theme.of(context).primaryColor)),
+                      subtitle: const Text('Receber um resumo das notificações a cada poucas horas', style: TextStyle(fontSize: 13, color: Color(0xFF64748B))),
+                      activeColor: const Color(0xFF144BB8),
+                      secondary: Container(
+                        padding: const EdgeInsets.all(10),
+                        decoration: BoxDecoration(color: const Color(0xFFEFF6FF), borderRadius: BorderRadius.circular(12)),
+                        child: const Icon(Icons.summarize_outlined, color: Color(0xFF144BB8), size: 22),
+                      ),
+                    ),
+                  ),
 
                 _buildSettingTile(Icons.palette_outlined, 'Aparência', 'Tema claro/escuro e cores', onTap: () {}),
                 
@@ -45,7 +45,18 @@ def test_generate_report():
         print("Response Text:", response.text)
         return
         
-    assert response.status_code == 200, f"Failed to generate report: {response.text}"
+    assert response.status_code == 202, f"Failed to queue report: {response.text}"
+    assert "job_id" in data, "No job_id in response"
+
+    # A geração roda em background: acompanha o job até concluir
+    import time
+    for _ in range(60):
+        data = client.get(f"/reports/jobs/{data['job_id']}").json()
+        print(f"Job {data['status']} ({data['progress']}%)")
+        if data["status"] in ("completed", "failed"):
+            break
+        time.sleep(1)
+    assert data["status"] == "completed", f"Report job failed: {data}"
     assert "url" in data, "No URL in response"
     print("✅ Successfully generated report!")
     